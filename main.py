@@ -1,22 +1,46 @@
 # AgriWise Bot — Free (versión estable con notificaciones enriquecidas y /registrar HH.MM)
 
 import io
+import argparse
+import bisect
+import math
 import random
 import os
 import csv
+import hashlib
+import heapq
+import queue
+import asyncio
 import sqlite3
-from datetime import datetime, time as dtime
+import tempfile
+import threading
+import unicodedata
+import time
+import weakref
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from collections import OrderedDict, deque
+from datetime import datetime, date, timedelta, time as dtime
 from calendar import monthrange
 from dotenv import load_dotenv
 
+try:
+    import numpy as np  # opcional: acelera calc_riego_batch / proyecciones
+except ImportError:
+    np = None
+
 from telegram import (
     Update,
     ReplyKeyboardMarkup,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
 )
+from telegram.error import RetryAfter
 from telegram.ext import (
     ApplicationBuilder,
+    BaseRateLimiter,
     CommandHandler,
     MessageHandler,
     ConversationHandler,
@@ -31,11 +55,46 @@ from telegram.ext import (
 load_dotenv()
 BOT_TOKEN = os.getenv("TELEGRAM_TOKEN")
 
-DB_PATH   = "db.sqlite3"
+DB_PATH   = os.getenv("DB_PATH", "db.sqlite3")
 KC_CSV    = "data/agriwise_kc_table_v1.csv"
 ADJ_CSV   = "data/agriwise_adjustments_v1.csv"
 CANOPY_CSV= "data/agriwise_canopy_factors_v1.csv"
 
+# SQLite: pool y pragmas (ajustables por host vía .env)
+DB_POOL_READERS     = int(os.getenv("DB_POOL_READERS", "4"))
+DB_STMT_CACHE       = int(os.getenv("DB_STMT_CACHE", "256"))
+DB_JOURNAL_MODE     = os.getenv("DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS      = os.getenv("DB_SYNCHRONOUS", "NORMAL")               # lectores
+DB_WRITER_SYNCHRONOUS = os.getenv("DB_WRITER_SYNCHRONOUS", "FULL")       # escritor: fsync en cada commit
+DB_BUSY_TIMEOUT_MS  = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB    = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE        = int(os.getenv("DB_MMAP_SIZE", str(128 * 1024 * 1024)))
+DB_WAL_AUTOCHECKPOINT = int(os.getenv("DB_WAL_AUTOCHECKPOINT", "1000"))  # páginas
+DB_CHECKPOINT_SECS  = int(os.getenv("DB_CHECKPOINT_SECS", "300"))        # 0 = desactivado
+WRITE_BATCH_MAX     = int(os.getenv("WRITE_BATCH_MAX", "200"))            # filas por commit
+WRITE_BATCH_MS      = float(os.getenv("WRITE_BATCH_MS", "5"))             # espera máx. para agrupar
+
+# Caché en memoria del contexto de usuario (perfil + ajustes)
+USER_CACHE_SIZE     = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL      = float(os.getenv("USER_CACHE_TTL", "300"))           # segundos
+STATS_LOG_SECS      = int(os.getenv("STATS_LOG_SECS", "900"))             # 0 = desactivado
+PROJ_CACHE_SIZE     = int(os.getenv("PROJ_CACHE_SIZE", "512"))            # proyecciones /temporada
+REF_RELOAD_SECS     = int(os.getenv("REF_RELOAD_SECS", "60"))             # vigilar data/*.csv; 0 = desactivado
+
+# Notificaciones: un despachador por franja; lee suscriptores por páginas y envía por lotes
+NOTIFY_SLOTS        = ("07:00", "08:00", "20:00")
+NOTIFY_PAGE         = int(os.getenv("NOTIFY_PAGE", "1000"))               # user_ids por consulta
+NOTIFY_BATCH        = int(os.getenv("NOTIFY_BATCH", "25"))                # envíos concurrentes (y commit)
+NOTIFY_LOG_DIAS     = int(os.getenv("NOTIFY_LOG_DIAS", "14"))             # días que se guarda el registro de entregas
+NOTIF_PANEL_QUIET   = float(os.getenv("NOTIF_PANEL_QUIET", "4"))          # s sin toques antes de guardar el panel
+
+# Limitador de salida hacia Telegram (~30 msg/s global, 1 msg/s por chat, 20 msg/min en grupos)
+SEND_RPS            = float(os.getenv("SEND_RPS", "25"))                  # cubo global: tokens/s
+SEND_BURST          = int(os.getenv("SEND_BURST", "5"))                   # capacidad del cubo (pico = RPS + BURST)
+SEND_CHAT_SECS      = float(os.getenv("SEND_CHAT_SECS", "1.0"))           # separación por chat privado
+SEND_GROUP_SECS     = float(os.getenv("SEND_GROUP_SECS", "3.0"))          # separación por grupo/canal
+SEND_MAX_RETRIES    = int(os.getenv("SEND_MAX_RETRIES", "3"))             # reintentos tras RetryAfter
+
 # Estados de conversación
 (
     PERFIL_CULTIVO, PERFIL_SUELO, PERFIL_CUBIERTA, PERFIL_EFICIENCIA, PERFIL_CAUDAL,
@@ -49,49 +108,39 @@ CANOPY_CSV= "data/agriwise_canopy_factors_v1.csv"
 
 # Estados extra
 ETO_RAPIDA_VALOR, AJUAGUA_OBJ, AJUAGUA_PRECIO = range(24, 27)
+SECTOR_NOMBRE, SECTOR_CULTIVO, SECTOR_AREA, SECTOR_CAUDAL, SECTOR_COPA, SECTOR_MARCO = range(27, 33)
+TURNOS_CAUDAL, TURNOS_VALLE = range(33, 35)
+ESTACION_ELEGIR = 35
 
 # =========================
 # Carga CSV sin pandas
 # =========================
-def load_kc_rows(path: str):
+# Los loaders reciben un fichero de texto ya abierto: el registro de tablas
+# lee cada CSV una sola vez y calcula la huella sobre esos mismos bytes.
+def load_kc_rows(f):
     rows = []
-    with open(path, newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for r in reader:
-            r["crop"]         = r["crop"].strip()
-            r["start_month"]  = r["start_month"].strip()
-            r["end_month"]    = r["end_month"].strip()
-            r["kc_min"]       = float(r["kc_min"])
-            r["kc_max"]       = float(r["kc_max"])
-            r["kc_default"]   = float(r["kc_default"])
-            rows.append(r)
+    for r in csv.DictReader(f):
+        r["crop"]         = r["crop"].strip()
+        r["start_month"]  = r["start_month"].strip()
+        r["end_month"]    = r["end_month"].strip()
+        r["kc_min"]       = float(r["kc_min"])
+        r["kc_max"]       = float(r["kc_max"])
+        r["kc_default"]   = float(r["kc_default"])
+        rows.append(r)
     return rows
 
-def load_adjustments(path: str):
+def load_adjustments(f):
     d = {}
-    with open(path, newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for r in reader:
-            d[r["parameter"].strip()] = float(r["value"])
+    for r in csv.DictReader(f):
+        d[r["parameter"].strip()] = float(r["value"])
     return d
 
-def load_canopy_factors(path: str):
+def load_canopy_factors(f):
     d = {}
-    with open(path, newline="", encoding="utf-8") as f:
-        for r in csv.DictReader(f):
-            d[r["canopy_class"].strip().lower()] = float(r["f_copa"])
+    for r in csv.DictReader(f):
+        d[r["canopy_class"].strip().lower()] = float(r["f_copa"])
     return d
 
-KC_ROWS = load_kc_rows(KC_CSV)
-ADJ     = load_adjustments(ADJ_CSV)
-CANOPY  = load_canopy_factors(CANOPY_CSV)
-
-SOIL_MAP  = {"arenoso": ADJ.get("soil_factor_sandy",1.05),
-             "franco" : ADJ.get("soil_factor_loam", 1.00),
-             "arcilloso":ADJ.get("soil_factor_clay", 0.95)}
-COVER_MAP = {"si": ADJ.get("cover_crop_active",1.10), "no": 1.0}
-EFF_DEFAULT = ADJ.get("efficiency_drip_avg",0.92)
-
 MONTH_TO_IDX = {"Ene":1,"Feb":2,"Mar":3,"Abr":4,"May":5,"Jun":6,
                 "Jul":7,"Ago":8,"Sep":9,"Oct":10,"Nov":11,"Dic":12}
 
@@ -100,21 +149,216 @@ def month_in_range(start_m: str, end_m: str, target_idx: int) -> bool:
     if s <= e: return s <= target_idx <= e
     return target_idx >= s or target_idx <= e
 
-def kc_default_for(cultivo: str, month_idx: int) -> float:
-    cult = (cultivo or "").strip().lower()
-    candidates = [r for r in KC_ROWS if r["crop"].strip().lower() == cult]
-    if not candidates: return 0.6
-    matches    = [r for r in candidates if month_in_range(r["start_month"], r["end_month"], month_idx)]
-    ref        = matches if matches else candidates
-    vals       = [r["kc_default"] for r in ref]
-    return sum(vals)/len(vals) if vals else 0.6
+KC_FALLBACK = 0.6
+
+def norm_crop(cultivo: str | None) -> str:
+    # 'Viña' == 'vina', 'Cítricos' == 'citricos', espacios colapsados
+    s = unicodedata.normalize("NFKD", (cultivo or "").strip().lower())
+    s = "".join(ch for ch in s if not unicodedata.combining(ch))
+    return " ".join(s.split())
+
+# Igual que UPPER(TRIM(sector)) de SQLite (logs_mes): solo espacios y ASCII
+_ASCII_UPPER = str.maketrans("abcdefghijklmnopqrstuvwxyz", "ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+
+def norm_sector(sector: str | None) -> str:
+    return (sector or "").strip(" ").translate(_ASCII_UPPER)
+
+# Días de inicio de cada mes en un año de 365 días (1-based)
+_MONTH_START_DOY = [1, 32, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335, 366]
+
+def doy365(d: date) -> int:
+    # Día del año ignorando el 29/02 (los bisiestos reutilizan el 28/02)
+    day = 28 if (d.month == 2 and d.day == 29) else d.day
+    return _MONTH_START_DOY[d.month - 1] + day - 1
+
+def build_kc_index(rows):
+    # (cultivo_normalizado, mes) -> Kc medio de las fases que cubren el mes
+    # (o de todas las fases del cultivo si ninguna lo cubre: igual que antes).
+    by_crop = {}
+    for r in rows:
+        by_crop.setdefault(norm_crop(r["crop"]), []).append(r)
+    monthly = {}
+    daily   = {}
+    for crop, candidates in by_crop.items():
+        for month_idx in range(1, 13):
+            matches = [r for r in candidates if month_in_range(r["start_month"], r["end_month"], month_idx)]
+            ref     = matches if matches else candidates
+            vals    = [r["kc_default"] for r in ref]
+            monthly[(crop, month_idx)] = sum(vals)/len(vals)
+        daily[crop] = _kc_daily_curve(candidates)
+    return monthly, daily
+
+def _kc_daily_curve(candidates) -> tuple[float, ...]:
+    # Interpolación lineal (circular) entre los centros de cada fase
+    pts = []
+    for r in candidates:
+        s = _MONTH_START_DOY[MONTH_TO_IDX[r["start_month"]] - 1]
+        e = _MONTH_START_DOY[MONTH_TO_IDX[r["end_month"]]] - 1
+        if e < s:
+            e += 365
+        pts.append((((s + e) / 2.0 - 1) % 365 + 1, r["kc_default"]))
+    pts.sort()
+    curve = []
+    for doy in range(1, 366):
+        prev = max((p for p in pts if p[0] <= doy), default=None)
+        nxt  = min((p for p in pts if p[0] > doy),  default=None)
+        if prev is None: prev = (pts[-1][0] - 365, pts[-1][1])
+        if nxt  is None: nxt  = (pts[0][0] + 365,  pts[0][1])
+        w = (doy - prev[0]) / (nxt[0] - prev[0])
+        curve.append(prev[1] + w * (nxt[1] - prev[1]))
+    return tuple(curve)
+
+# -------------------------
+# Registro de tablas de referencia (data/*.csv). REF es una instantánea
+# inmutable (filas, índices Kc, mapas de factores y versión) que se sustituye
+# entera con una sola asignación: cada cálculo toma REF una vez y usa una
+# única versión aunque haya una recarga a mitad. _ref_reload_job vigila los
+# CSV por mtime/tamaño, confirma el cambio por hash, parsea y valida fuera del
+# event loop y solo publica la versión nueva si es válida.
+# -------------------------
+REF_FILES = {"kc": KC_CSV, "adj": ADJ_CSV, "canopy": CANOPY_CSV}   # el orden fija la huella
+REF_SETTLE_SECS = 2.0   # no leer un CSV modificado hace menos (editor a medio guardar)
+
+def _read_ref_files(paths: dict) -> tuple[dict, str]:
+    # Bytes de cada CSV + huella conjunta (la misma que guardan balances y proyecciones)
+    raw = {}
+    h = hashlib.sha1()
+    for k, p in paths.items():
+        with open(p, "rb") as f:
+            raw[k] = f.read()
+        h.update(raw[k])
+    return raw, h.hexdigest()[:10]
+
+def validate_ref(kc_rows, adj: dict, canopy: dict) -> list[str]:
+    errs = []
+    if not kc_rows:
+        errs.append("tabla Kc vacía")
+    for i, r in enumerate(kc_rows, start=2):
+        if not r["crop"]:
+            errs.append(f"kc línea {i}: cultivo vacío")
+        for col in ("start_month", "end_month"):
+            if r[col] not in MONTH_TO_IDX:
+                errs.append(f"kc línea {i}: mes '{r[col]}' no válido")
+        if not (0.0 <= r["kc_min"] <= r["kc_default"] <= r["kc_max"] <= 2.0):
+            errs.append(f"kc línea {i}: se espera 0 ≤ kc_min ≤ kc_default ≤ kc_max ≤ 2")
+    for k in ("soil_factor_sandy", "soil_factor_loam", "soil_factor_clay",
+              "cover_crop_active", "efficiency_drip_avg"):
+        if k not in adj:
+            errs.append(f"ajustes: falta '{k}'")
+    for k, v in adj.items():
+        if not (0.0 < v <= 2.0):
+            errs.append(f"ajustes: '{k}'={v} fuera de (0, 2]")
+    if not (0.0 < adj.get("efficiency_drip_avg", 1.0) <= 1.0):
+        errs.append("ajustes: efficiency_drip_avg fuera de (0, 1]")
+    for k, v in canopy.items():
+        if not (0.0 < v <= 1.5):
+            errs.append(f"copa: '{k}'={v} fuera de (0, 1.5]")
+    return errs
+
+def build_ref(raw: dict, version: str) -> dict:
+    # Parsea y valida; ValueError si las tablas no son utilizables
+    def text(k):
+        return io.StringIO(raw[k].decode("utf-8"), newline="")
+    try:
+        kc_rows = load_kc_rows(text("kc"))
+        adj     = load_adjustments(text("adj"))
+        canopy  = load_canopy_factors(text("canopy"))
+    except (KeyError, TypeError, ValueError, UnicodeDecodeError, csv.Error) as e:
+        raise ValueError(f"CSV ilegible: {e!r}") from e
+    errs = validate_ref(kc_rows, adj, canopy)
+    if errs:
+        raise ValueError("; ".join(errs[:5]) + (f" (+{len(errs)-5})" if len(errs) > 5 else ""))
+    kc_index, kc_daily = build_kc_index(kc_rows)
+    return {
+        "version": version, "kc_rows": kc_rows, "adj": adj, "canopy": canopy,
+        "soil": {"arenoso": adj.get("soil_factor_sandy",1.05),
+                 "franco" : adj.get("soil_factor_loam", 1.00),
+                 "arcilloso":adj.get("soil_factor_clay", 0.95)},
+        "cover": {"si": adj.get("cover_crop_active",1.10), "no": 1.0},
+        "eff_default": adj.get("efficiency_drip_avg",0.92),
+        "kc_index": kc_index, "kc_daily": kc_daily,
+    }
+
+def _ref_stat() -> dict:
+    return {p: (st.st_mtime_ns, st.st_size) for p in REF_FILES.values() for st in (os.stat(p),)}
+
+_ref_lock   = threading.Lock()
+_ref_seen   = _ref_stat()   # mtime/tamaño de la última versión leída
+_ref_bad    = None          # última huella rechazada (no repetir el aviso)
+_ref_stats  = {"checks": 0, "reloads": 0, "rejected": 0}
+REF = build_ref(*_read_ref_files(REF_FILES))
+
+def ref_reload(force: bool = False) -> str | None:
+    # Devuelve la versión nueva si se publicó; None si no hubo cambio o se rechazó.
+    # Se ejecuta en un hilo (nunca en el event loop): lee y parsea CSV.
+    global REF, _ref_seen, _ref_bad
+    with _ref_lock:
+        _ref_stats["checks"] += 1
+        st = _ref_stat()
+        if not force:
+            if st == _ref_seen:
+                return None
+            newest = max(m for m, _ in st.values()) / 1e9
+            if time.time() - newest < REF_SETTLE_SECS:
+                return None   # se revisará en la próxima pasada
+        raw, version = _read_ref_files(REF_FILES)
+        _ref_seen = st
+        if version == REF["version"] or (version == _ref_bad and not force):
+            return None   # solo cambió el mtime, o ya se rechazó esta versión
+        try:
+            ref = build_ref(raw, version)
+        except ValueError as e:
+            _ref_bad = version
+            _ref_stats["rejected"] += 1
+            print(f"[WARN] Tablas de referencia {version} rechazadas, sigue {REF['version']}: {e}")
+            return None
+        old, REF = REF["version"], ref   # publicación atómica
+        _ref_stats["reloads"] += 1
+    _ref_invalidate()
+    print(f"[INFO] Tablas de referencia {old} → {version}")
+    return version
+
+def _ref_invalidate():
+    # Cachés derivadas de las tablas. Los balances por sector llevan la versión
+    # en su huella y se reconstruyen solos en la siguiente lectura/registro.
+    with _proj_lock:
+        _proj_cache.clear()
+    with _etc_lock:
+        _etc_cache.clear()
+    invalidate_all_user_ctx()   # la eficiencia por defecto sale de ADJ
+
+def ref_stats() -> dict:
+    with _ref_lock:
+        return dict(_ref_stats, version=REF["version"])
+
+def kc_default_for(cultivo: str, month_idx: int, ref: dict | None = None) -> float:
+    return (ref or REF)["kc_index"].get((norm_crop(cultivo), month_idx), KC_FALLBACK)
+
+def kc_for_day(cultivo: str, d: date, ref: dict | None = None) -> float:
+    curve = (ref or REF)["kc_daily"].get(norm_crop(cultivo))
+    return curve[doy365(d) - 1] if curve else KC_FALLBACK
 
 # =========================
 # DB helpers
 # =========================
-def db():
-    conn = sqlite3.connect(DB_PATH)
+# Pool de conexiones de proceso: 1 escritora (serializada con lock) + N lectoras
+# reutilizables. Evita abrir/cerrar sqlite3 en cada helper.
+
+_db_pool_lock    = threading.Lock()
+_db_writer_lock  = threading.RLock()
+_db_writer       = None
+_db_readers      = queue.LifoQueue()
+_db_reader_count = 0
+
+# -------------------------
+# Migraciones de esquema (PRAGMA user_version)
+# Se ejecutan una vez al arrancar (build_app) o con `python main.py migrate`.
+# Para añadir columnas/tablas: nueva función _mig_NNN y entrada en MIGRATIONS.
+# -------------------------
+def _table_cols(conn, table:str) -> list[str]:
+    return [r[1] for r in conn.execute(f"PRAGMA table_info({table});").fetchall()]
 
+def _mig_001_base(conn):
     conn.execute("""
     CREATE TABLE IF NOT EXISTS profiles (
         user_id INTEGER PRIMARY KEY,
@@ -191,140 +435,931 @@ def db():
         notif_last_idx INTEGER DEFAULT -1
     );""")
 
-    # Compatibilidad: añade columnas si faltan
-    try:
-        cols = [r[1] for r in conn.execute("PRAGMA table_info(sys_estado);").fetchall()]
-        if "valvulas" not in cols:
-            conn.execute("ALTER TABLE sys_estado ADD COLUMN valvulas TEXT;")
-        if "goteros" not in cols:
-            conn.execute("ALTER TABLE sys_estado ADD COLUMN goteros TEXT;")
-        conn.commit()
-    except Exception:
-        pass
+# Compatibilidad: BDs antiguas sin valvulas/goteros en sys_estado
+def _mig_002_sys_estado_cols(conn):
+    cols = _table_cols(conn, "sys_estado")
+    if "valvulas" not in cols:
+        conn.execute("ALTER TABLE sys_estado ADD COLUMN valvulas TEXT;")
+    if "goteros" not in cols:
+        conn.execute("ALTER TABLE sys_estado ADD COLUMN goteros TEXT;")
+
+# Compatibilidad: BDs antiguas sin notif_last_idx
+def _mig_003_notif_last_idx(conn):
+    if "notif_last_idx" not in _table_cols(conn, "user_settings"):
+        conn.execute("ALTER TABLE user_settings ADD COLUMN notif_last_idx INTEGER DEFAULT -1;")
+
+# Índices por usuario: "últimos N" → (user_id, id DESC); sumas por rango → (user_id, fecha, horas)
+def _mig_004_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_user_id       ON logs(user_id, id DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_user_fecha    ON logs(user_id, fecha, horas)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sys_estado_user_id ON sys_estado(user_id, id DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sys_mant_user_id   ON sys_mant(user_id, id DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sys_alerta_user_id ON sys_alerta(user_id, id DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_settings_notify    ON user_settings(notify_enabled)")
+
+# logs.fecha_dia: fecha como día entero desde 1970-01-01 (el texto queda como legado).
+# Las filas antiguas se rellenan con backfill_fecha_dia(); el índice parcial
+# idx_logs_sin_dia hace que localizarlas no recorra toda la tabla.
+def _mig_005_logs_fecha_dia(conn):
+    if "fecha_dia" not in _table_cols(conn, "logs"):
+        conn.execute("ALTER TABLE logs ADD COLUMN fecha_dia INTEGER;")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_user_dia ON logs(user_id, fecha_dia, horas)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_sin_dia  ON logs(id) WHERE fecha_dia IS NULL")
+    conn.execute("DROP INDEX IF EXISTS idx_logs_user_fecha")
+
+# logs_mes: horas acumuladas por usuario/mes (AAAAMM)/sector, mantenidas en la
+# misma transacción que cada alta/baja en logs. Reconstruible con rebuild_logs_mes().
+SQL_LOGS_MES_REBUILD = """
+    INSERT INTO logs_mes(user_id, mes, sector, horas, n)
+    SELECT user_id,
+           CAST(strftime('%Y%m', fecha_dia*86400, 'unixepoch') AS INTEGER),
+           UPPER(TRIM(COALESCE(sector,''))),
+           COALESCE(SUM(horas),0), COUNT(*)
+      FROM logs
+     WHERE fecha_dia IS NOT NULL {filtro}
+     GROUP BY 1, 2, 3"""
+SQL_LOGS_MES_UPSERT = """
+    INSERT INTO logs_mes(user_id, mes, sector, horas, n)
+    VALUES (?, ?, UPPER(TRIM(COALESCE(?,''))), ?, 1)
+    ON CONFLICT(user_id, mes, sector) DO UPDATE SET
+      horas = horas + excluded.horas,
+      n     = n + 1"""
+
+def _mig_006_logs_mes(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS logs_mes (
+        user_id INTEGER NOT NULL,
+        mes INTEGER NOT NULL,
+        sector TEXT NOT NULL,
+        horas REAL NOT NULL DEFAULT 0,
+        n INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, mes, sector)
+    ) WITHOUT ROWID;""")
+    conn.execute("DELETE FROM logs_mes")
+    conn.execute(SQL_LOGS_MES_REBUILD.format(filtro=""))
+
+# Buzón local de telemetría: eventos que no se pudieron enviar al endpoint web
+def _mig_007_telemetry_outbox(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS telemetry_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created TEXT,
+        body TEXT NOT NULL
+    );""")
+
+# Balance hídrico por sector (FAO-56): estado incremental por (usuario, sector)
+# y ETo introducidas por el usuario. Se calcula al primer /balance de cada
+# usuario (get_balance) o con backfill-fechas / rebuild-aggregates.
+def _mig_008_balance_sector(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS balance_sector (
+        user_id INTEGER NOT NULL,
+        sector TEXT NOT NULL,
+        dia INTEGER NOT NULL,        -- último día aplicado (días desde 1970-01-01)
+        dr_ini REAL NOT NULL,        -- agotamiento al cierre del día anterior (mm)
+        riego_mm REAL NOT NULL,      -- riego neto acumulado en `dia` (mm)
+        huella TEXT NOT NULL,        -- parámetros de perfil/tablas con que se calculó
+        PRIMARY KEY (user_id, sector)
+    ) WITHOUT ROWID;""")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS eto_usuario (
+        user_id INTEGER NOT NULL,
+        dia INTEGER NOT NULL,
+        eto REAL NOT NULL,
+        PRIMARY KEY (user_id, dia)
+    ) WITHOUT ROWID;""")
+
+# sectors: datos propios de cada sector (lo que quede a NULL se hereda del perfil).
+# Se siembra con los sectores que ya aparecen en logs (no en logs_mes: los
+# registros antiguos aún sin fecha_dia no cuentan allí hasta el backfill).
+def _mig_009_sectors(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS sectors (
+        user_id INTEGER NOT NULL,
+        sector TEXT NOT NULL,        -- UPPER(TRIM()), como logs_mes
+        cultivo TEXT,
+        area_ha REAL,
+        caudal_m3h_ha REAL,
+        canopy_class TEXT,
+        spacing_x_m REAL,
+        spacing_y_m REAL,
+        plants_per_ha REAL,
+        PRIMARY KEY (user_id, sector)
+    ) WITHOUT ROWID;""")
+    conn.execute("""
+        INSERT OR IGNORE INTO sectors(user_id, sector)
+        SELECT DISTINCT user_id, UPPER(TRIM(sector)) FROM logs
+         WHERE TRIM(COALESCE(sector,''))<>''""")
+
+# Turnos de riego: caudal máximo del cabezal (m³/h) y franjas de tarifa valle
+def _mig_010_turnos_settings(conn):
+    cols = _table_cols(conn, "user_settings")
+    if "caudal_max_m3h" not in cols:
+        conn.execute("ALTER TABLE user_settings ADD COLUMN caudal_max_m3h REAL;")
+    if "tarifa_valle" not in cols:
+        conn.execute("ALTER TABLE user_settings ADD COLUMN tarifa_valle TEXT;")
+
+# ETo diaria de estaciones meteorológicas (importada de CSV) y estación de cada usuario.
+# estaciones resume cada serie para listarlas sin recorrer eto_estacion.
+def _mig_011_eto_estacion(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS eto_estacion (
+        estacion TEXT NOT NULL,      -- código en mayúsculas, sin espacios alrededor
+        dia INTEGER NOT NULL,        -- días desde 1970-01-01
+        eto REAL NOT NULL,           -- mm/día
+        PRIMARY KEY (estacion, dia)
+    ) WITHOUT ROWID;""")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS estaciones (
+        estacion TEXT PRIMARY KEY,
+        primer_dia INTEGER,
+        ultimo_dia INTEGER,
+        filas INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID;""")
+    if "estacion" not in _table_cols(conn, "user_settings"):
+        conn.execute("ALTER TABLE user_settings ADD COLUMN estacion TEXT;")
+
+# Notificaciones por franja: un despachador por hora (07:00/08:00/20:00) lee los
+# suscriptores de su franja con este índice parcial, paginando por user_id.
+# notify_weekday fija el día de las semanales (antes, el del último arranque).
+def _mig_012_notify_slots(conn):
+    if "notify_weekday" not in _table_cols(conn, "user_settings"):
+        conn.execute("ALTER TABLE user_settings ADD COLUMN notify_weekday INTEGER;")
+    conn.execute("UPDATE user_settings SET notify_weekday=? WHERE notify_weekday IS NULL",
+                 (datetime.now().weekday(),))
+    conn.execute(f"""
+        UPDATE user_settings SET notify_time='08:00'
+         WHERE notify_time IS NULL OR notify_time NOT IN ({",".join("?" * len(NOTIFY_SLOTS))})""", NOTIFY_SLOTS)
+    conn.execute("DROP INDEX IF EXISTS idx_settings_notify")
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_settings_slot
+            ON user_settings(notify_time, user_id) WHERE notify_enabled=1""")
+
+# Registro de entregas por (día, franja, usuario): idempotencia del despacho
+# y punto de reanudación (notif_despacho.ultimo_uid) si el bot cae a mitad.
+def _mig_013_notif_entregas(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS notif_entregas (
+            dia     TEXT    NOT NULL,
+            franja  TEXT    NOT NULL,
+            user_id INTEGER NOT NULL,
+            nid     INTEGER NOT NULL,
+            PRIMARY KEY (dia, franja, user_id)
+        ) WITHOUT ROWID;""")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS notif_despacho (
+            dia        TEXT    NOT NULL,
+            franja     TEXT    NOT NULL,
+            ultimo_uid INTEGER NOT NULL DEFAULT 0,
+            enviadas   INTEGER NOT NULL DEFAULT 0,
+            inicio     TEXT,
+            fin        TEXT,
+            PRIMARY KEY (dia, franja)
+        ) WITHOUT ROWID;""")
+
+# Pares clave/valor internos (p. ej. hasta qué logs.id llegó backfill_fecha_dia)
+def _mig_014_db_meta(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS db_meta (
+            clave TEXT PRIMARY KEY,
+            valor TEXT
+        ) WITHOUT ROWID;""")
+
+MIGRATIONS = [
+    (1, "tablas base",                       _mig_001_base),
+    (2, "sys_estado.valvulas/goteros",       _mig_002_sys_estado_cols),
+    (3, "user_settings.notif_last_idx",      _mig_003_notif_last_idx),
+    (4, "índices por usuario",               _mig_004_indexes),
+    (5, "logs.fecha_dia (día entero)",       _mig_005_logs_fecha_dia),
+    (6, "agregados mensuales logs_mes",      _mig_006_logs_mes),
+    (7, "telemetry_outbox",                  _mig_007_telemetry_outbox),
+    (8, "balance hídrico por sector",        _mig_008_balance_sector),
+    (9, "sectors",                           _mig_009_sectors),
+    (10, "user_settings: cabezal y tarifa",  _mig_010_turnos_settings),
+    (11, "ETo por estación",                 _mig_011_eto_estacion),
+    (12, "notificaciones por franja",        _mig_012_notify_slots),
+    (13, "registro de entregas",             _mig_013_notif_entregas),
+    (14, "db_meta",                          _mig_014_db_meta),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def schema_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate_db(verbose:bool=True) -> int:
+    # Cada paso va en su propia transacción junto con el salto de user_version
+    with db_write() as conn:
+        current = schema_version(conn)
+        if current > SCHEMA_VERSION:
+            raise RuntimeError(f"BD en versión {current}, más nueva que el código ({SCHEMA_VERSION})")
+        for ver, desc, fn in MIGRATIONS:
+            if ver <= current:
+                continue
+            conn.execute("BEGIN")
+            try:
+                fn(conn)
+                conn.execute(f"PRAGMA user_version={ver}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            if verbose:
+                print(f"[db] migración {ver:03d} aplicada: {desc}")
+            current = ver
+    return current
+
+def _connect(synchronous:str=DB_SYNCHRONOUS):
+    # check_same_thread=False: las conexiones del pool se comparten entre hilos
+    # (nunca a la vez: cada una está prestada a un único usuario del pool).
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=DB_STMT_CACHE,
+                           timeout=DB_BUSY_TIMEOUT_MS / 1000.0)
+    # WAL: lectores y escritor no se bloquean entre sí (/registrar vs /resumen)
+    conn.execute(f"PRAGMA journal_mode={DB_JOURNAL_MODE}")
+    conn.execute(f"PRAGMA synchronous={synchronous}")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute(f"PRAGMA wal_autocheckpoint={DB_WAL_AUTOCHECKPOINT}")
+    return conn
 
-    # Añadir notif_last_idx si falta
+def _get_writer():
+    global _db_writer
+    with _db_pool_lock:
+        if _db_writer is None:
+            # FULL: en WAL, NORMAL no hace fsync al confirmar y un corte de luz
+            # podría deshacer un commit ya confirmado al usuario
+            _db_writer = _connect(DB_WRITER_SYNCHRONOUS)
+        return _db_writer
+
+def _acquire_reader():
+    global _db_reader_count
     try:
-        cols = [r[1] for r in conn.execute("PRAGMA table_info(user_settings);").fetchall()]
-        if "notif_last_idx" not in cols:
-            conn.execute("ALTER TABLE user_settings ADD COLUMN notif_last_idx INTEGER DEFAULT -1;")
-        conn.commit()
-    except Exception:
+        return _db_readers.get_nowait()
+    except queue.Empty:
         pass
+    with _db_pool_lock:
+        if _db_reader_count < DB_POOL_READERS:
+            _db_reader_count += 1
+            return _connect()
+    return _db_readers.get()
+
+@contextmanager
+def db_read():
+    conn = _acquire_reader()
+    try:
+        yield conn
+    finally:
+        _db_readers.put(conn)
 
-    return conn
+@contextmanager
+def db_write():
+    # Un único escritor: commit al salir, rollback si algo falla
+    with _db_writer_lock:
+        conn = _get_writer()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+def db_checkpoint(mode:str="PASSIVE"):
+    # Vuelca el WAL a la BD principal sin bloquear a los lectores (PASSIVE)
+    with db_write() as conn:
+        return conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+
+# -------------------------
+# Cola de escritura con commit agrupado (group commit)
+# Cada alta espera en un Future que se resuelve tras el commit de su lote:
+# el handler solo responde "✅ registrado" cuando el dato ya está en disco
+# (el escritor usa synchronous=FULL: cada commit del lote paga un fsync).
+# -------------------------
+_wq         = queue.Queue()
+_wq_thread  = None
+_wq_lock    = threading.Lock()
+_WQ_STOP    = object()
+
+def _wq_flush(batch):
+    # La escritura se aplica aunque quien espera se haya cancelado (p. ej. una
+    # tarea asyncio interrumpida); solo se omite avisarle del resultado.
+    vivos = [fut.set_running_or_notify_cancel() for _, _, fut in batch]
+    with _db_writer_lock:
+        conn = _get_writer()
+        try:
+            results = [fn(conn, *args) for fn, args, _ in batch]
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            results = None
+        if results is None:
+            # Un elemento ha fallado: se reintenta uno a uno para aislarlo
+            for (fn, args, fut), vivo in zip(batch, vivos):
+                try:
+                    with db_write() as c:
+                        r = fn(c, *args)
+                except Exception as e:
+                    if vivo:
+                        fut.set_exception(e)
+                else:
+                    if vivo:
+                        fut.set_result(r)
+            return
+    for (_, _, fut), r, vivo in zip(batch, results, vivos):
+        if vivo:
+            fut.set_result(r)
+
+def _wq_loop():
+    stop = False
+    while not stop:
+        item = _wq.get()
+        if item is _WQ_STOP:
+            break
+        batch = [item]
+        deadline = time.monotonic() + WRITE_BATCH_MS / 1000.0
+        while len(batch) < WRITE_BATCH_MAX:
+            wait = deadline - time.monotonic()
+            if wait <= 0:
+                break
+            try:
+                item = _wq.get(timeout=wait)
+            except queue.Empty:
+                break
+            if item is _WQ_STOP:
+                stop = True
+                break
+            batch.append(item)
+        _wq_flush(batch)
+
+def write_behind(fn, *args) -> Future:
+    global _wq_thread
+    with _wq_lock:
+        if _wq_thread is None:
+            _wq_thread = threading.Thread(target=_wq_loop, name="agriwise-writer", daemon=True)
+            _wq_thread.start()
+    fut = Future()
+    _wq.put((fn, args, fut))
+    return fut
+
+def write_queue_drain():
+    # Procesa lo pendiente y para el hilo (apagado limpio)
+    global _wq_thread
+    with _wq_lock:
+        if _wq_thread is None:
+            return
+        _wq.put(_WQ_STOP)
+        _wq_thread.join()
+        _wq_thread = None
+
+def db_close_all():
+    global _db_writer, _db_reader_count
+    write_queue_drain()
+    with _db_pool_lock:
+        while True:
+            try:
+                _db_readers.get_nowait().close()
+            except queue.Empty:
+                break
+        _db_reader_count = 0
+        if _db_writer is not None:
+            with _db_writer_lock:
+                _db_writer.close()
+            _db_writer = None
+
+@contextmanager
+def db_temporal():
+    # Benchmarks: el pool pasa a una BD desechable con el esquema al día y, al
+    # salir (también si falla), vuelve a DB_PATH. La BD real no se toca.
+    global DB_PATH, _scache_epoch
+    original = DB_PATH
+    db_close_all()
+    with tempfile.TemporaryDirectory() as tmp:
+        DB_PATH = os.path.join(tmp, "bench.sqlite3")
+        try:
+            migrate_db(verbose=False)
+            yield DB_PATH
+        finally:
+            db_close_all()
+            DB_PATH = original
+            invalidate_all_user_ctx()
+            with _scache_lock:
+                _scache_epoch += 1
+                _scache.clear()
+
+# Acceso no bloqueante desde handlers async: el trabajo SQLite corre en hilos
+# dedicados y el event loop sigue atendiendo al resto de usuarios.
+_DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_POOL_READERS + 1, thread_name_prefix="agriwise-db")
+
+async def run_db(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_DB_EXECUTOR, partial(fn, *args, **kwargs))
+
+async def run_write(fn, *args):
+    # Encola una escritura _tx_* y espera a su commit sin bloquear el loop
+    return await asyncio.wrap_future(write_behind(fn, *args))
+
+# -------------------------
+# Consultas por usuario (registradas en HOT_QUERIES para `python main.py check-plans`)
+# -------------------------
+SQL_LOGS_ULTIMOS = "SELECT fecha, cultivo, sector, horas, nota FROM logs WHERE user_id=? ORDER BY id DESC LIMIT ?"
+SQL_AGUA_MESES = "SELECT mes, sector, horas FROM logs_mes WHERE user_id=? AND mes IN (?,?)"
+SQL_ESTADO_ULTIMOS = """
+    SELECT fecha, presion, filtros, COALESCE(valvulas,''), COALESCE(goteros,''), COALESCE(nota,'')
+      FROM sys_estado
+     WHERE user_id=?
+     ORDER BY id DESC LIMIT ?"""
+SQL_MANT_ULTIMOS = """
+    SELECT fecha, tarea, COALESCE(comentario,'')
+      FROM sys_mant
+     WHERE user_id=?
+     ORDER BY id DESC LIMIT ?"""
+SQL_ALERTA_ULTIMOS = """
+    SELECT fecha, descripcion, COALESCE(sector,''), COALESCE(resuelta,0)
+      FROM sys_alerta
+     WHERE user_id=?
+     ORDER BY id DESC LIMIT ?"""
+SQL_NOTIFY_SLOT = """
+    SELECT user_id, COALESCE(notify_kind,'mixto'), COALESCE(notif_last_idx,-1)
+      FROM user_settings
+     WHERE notify_enabled=1 AND notify_time=? AND user_id>?
+       AND (COALESCE(notify_freq,'diaria')<>'semanal' OR notify_weekday=?)
+       AND NOT EXISTS (SELECT 1 FROM notif_entregas e
+                        WHERE e.dia=? AND e.franja=? AND e.user_id=user_settings.user_id)
+     ORDER BY user_id LIMIT ?"""
+SQL_NOTIFY_RESUMEN = "SELECT notify_time, COUNT(*) FROM user_settings WHERE notify_enabled=1 GROUP BY notify_time"
+SQL_DESPACHO_PENDIENTES = "SELECT franja, ultimo_uid FROM notif_despacho WHERE dia=? AND fin IS NULL"
+SQL_BALANCE_USUARIO = "SELECT sector, dia, dr_ini, riego_mm, huella FROM balance_sector WHERE user_id=?"
+SQL_ETO_DESDE = "SELECT dia, eto FROM eto_usuario WHERE user_id=? AND dia>=?"
+SQL_LOGS_HAY = "SELECT 1 FROM logs WHERE user_id=? LIMIT 1"
+SQL_PERFIL = """
+    SELECT cultivo, suelo, cubierta, eficiencia, caudal_m3h_ha,
+           canopy_class, spacing_x_m, spacing_y_m, plants_per_ha
+      FROM profiles WHERE user_id=?"""
+SQL_SECTORES_NOMBRES = "SELECT sector FROM sectors WHERE user_id=? ORDER BY sector"
+SQL_SECTORES_USUARIO = """
+    SELECT sector, cultivo, area_ha, caudal_m3h_ha, canopy_class, spacing_x_m, spacing_y_m, plants_per_ha
+      FROM sectors WHERE user_id=?"""
+SQL_SECTOR_UNO = SQL_SECTORES_USUARIO + " AND sector=?"
+SQL_ETO_ESTACION_RANGO = "SELECT dia, eto FROM eto_estacion WHERE estacion=? AND dia BETWEEN ? AND ? ORDER BY dia"
+SQL_ESTACIONES = "SELECT estacion, primer_dia, ultimo_dia, filas FROM estaciones ORDER BY estacion LIMIT ?"
+SQL_ESTACION_UNA = "SELECT estacion, primer_dia, ultimo_dia, filas FROM estaciones WHERE estacion=?"
+
+# -------------------------
+# Caché de contexto de usuario (perfil + avanzado + ajustes), LRU con TTL.
+# Los save_* / reset_user la invalidan tras el commit. Los dicts devueltos
+# son compartidos: tratarlos como solo lectura.
+# -------------------------
+_ucache       = OrderedDict()   # uid -> (expira_monotonic, ctx)
+_ucache_lock  = threading.Lock()
+_ucache_epoch = 0               # sube con invalidate_all_user_ctx: descarta toda carga en vuelo
+_ucache_vuelo: dict = {}        # uid -> [cargas en vuelo, época del uid]; solo mientras hay cargas
+_ucache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+_SETTINGS_DEFAULT = {"objetivo":None,"precio":None,
+                     "notify_enabled":0,"notify_time":"08:00",
+                     "notify_kind":"mixto","notify_freq":"diaria",
+                     "notif_last_idx":-1,
+                     "caudal_max":None,"tarifa_valle":None,"estacion":None}
+
+def _profile_from_row(p) -> tuple[dict | None, tuple]:
+    # Fila de SQL_PERFIL -> (perfil base, (canopy, marco_x, marco_y, plantas/ha))
+    if not p:
+        return None, (None, None, None, None)
+    profile = {"cultivo": p[0] or "",
+               "suelo":   p[1] or "",
+               "cubierta":p[2] or "no",
+               "eficiencia": p[3] or REF["eff_default"],
+               "caudal_m3h_ha": p[4] or 0.0}
+    return profile, tuple(p[5:9])
+
+def _load_user_ctx(uid:int) -> dict:
+    with db_read() as conn:
+        p = conn.execute(SQL_PERFIL, (uid,)).fetchone()
+        sectores = tuple(r[0] for r in conn.execute(SQL_SECTORES_NOMBRES, (uid,)))
+        r = conn.execute("""
+            SELECT objetivo_m3ha_mes, precio_m3,
+                   COALESCE(notify_enabled,0),
+                   COALESCE(notify_time,'08:00'),
+                   COALESCE(notify_kind,'mixto'),
+                   COALESCE(notify_freq,'diaria'),
+                   COALESCE(notif_last_idx,-1),
+                   caudal_max_m3h, tarifa_valle, estacion
+              FROM user_settings
+             WHERE user_id=?""",(uid,)).fetchone()
+    profile, adv = _profile_from_row(p)
+    if not r:
+        settings = dict(_SETTINGS_DEFAULT)
+    else:
+        settings = {"objetivo":r[0], "precio":r[1],
+                    "notify_enabled":int(r[2] or 0), "notify_time":r[3],
+                    "notify_kind":r[4], "notify_freq":r[5],
+                    "notif_last_idx": int(r[6] if r[6] is not None else -1),
+                    "caudal_max":r[7], "tarifa_valle":r[8], "estacion":r[9] or None}
+    return {"profile": profile, "adv": adv, "settings": settings, "sectores": sectores}
+
+def get_user_ctx(uid:int) -> dict:
+    now = time.monotonic()
+    with _ucache_lock:
+        hit = _ucache.get(uid)
+        if hit and hit[0] > now:
+            _ucache.move_to_end(uid)
+            _ucache_stats["hits"] += 1
+            return hit[1]
+        _ucache_stats["misses"] += 1
+        vuelo = _ucache_vuelo.setdefault(uid, [0, 0])
+        vuelo[0] += 1
+        epoch = (_ucache_epoch, vuelo[1])
+    ctx = None
+    try:
+        ctx = _load_user_ctx(uid)
+    finally:
+        with _ucache_lock:
+            vuelo[0] -= 1
+            if not vuelo[0]:
+                del _ucache_vuelo[uid]
+            if ctx is not None and epoch == (_ucache_epoch, vuelo[1]):
+                _ucache[uid] = (now + USER_CACHE_TTL, ctx)
+                _ucache.move_to_end(uid)
+                while len(_ucache) > USER_CACHE_SIZE:
+                    _ucache.popitem(last=False)
+    return ctx
+
+def invalidate_user_ctx(uid:int):
+    # Solo descarta las cargas en vuelo de este uid: las de otros usuarios
+    # (p. ej. durante un envío masivo) siguen entrando en la caché
+    with _ucache_lock:
+        vuelo = _ucache_vuelo.get(uid)
+        if vuelo:
+            vuelo[1] += 1
+        _ucache.pop(uid, None)
+        _ucache_stats["invalidations"] += 1
+
+def invalidate_all_user_ctx():
+    global _ucache_epoch
+    with _ucache_lock:
+        _ucache_epoch += 1
+        _ucache.clear()
+        _ucache_stats["invalidations"] += 1
+
+def user_cache_stats() -> dict:
+    with _ucache_lock:
+        st = dict(_ucache_stats, size=len(_ucache))
+    total = st["hits"] + st["misses"]
+    st["hit_ratio"] = (st["hits"] / total) if total else 0.0
+    return st
 
 def get_profile(user_id: int):
-    conn = db()
-    row  = conn.execute(
-        "SELECT cultivo, suelo, cubierta, eficiencia, caudal_m3h_ha FROM profiles WHERE user_id=?",
-        (user_id,)
-    ).fetchone()
-    conn.close()
-    if row:
-        return {"cultivo": row[0] or "",
-                "suelo":   row[1] or "",
-                "cubierta":row[2] or "no",
-                "eficiencia": row[3] or EFF_DEFAULT,
-                "caudal_m3h_ha": row[4] or 0.0}
-    return None
+    return get_user_ctx(user_id)["profile"]
 
 def save_profile(user_id: int, cultivo, suelo, cubierta, eficiencia, caudal):
-    conn = db()
-    conn.execute("""
-    INSERT INTO profiles(user_id, cultivo, suelo, cubierta, eficiencia, caudal_m3h_ha)
-    VALUES (?,?,?,?,?,?)
-    ON CONFLICT(user_id) DO UPDATE SET
-      cultivo=excluded.cultivo,
-      suelo=excluded.suelo,
-      cubierta=excluded.cubierta,
-      eficiencia=excluded.eficiencia,
-      caudal_m3h_ha=excluded.caudal_m3h_ha
-    """,(user_id, cultivo, suelo, cubierta, eficiencia, caudal))
-    conn.commit(); conn.close()
+    with db_write() as conn:
+        conn.execute("""
+        INSERT INTO profiles(user_id, cultivo, suelo, cubierta, eficiencia, caudal_m3h_ha)
+        VALUES (?,?,?,?,?,?)
+        ON CONFLICT(user_id) DO UPDATE SET
+          cultivo=excluded.cultivo,
+          suelo=excluded.suelo,
+          cubierta=excluded.cubierta,
+          eficiencia=excluded.eficiencia,
+          caudal_m3h_ha=excluded.caudal_m3h_ha
+        """,(user_id, cultivo, suelo, cubierta, eficiencia, caudal))
+    invalidate_user_ctx(user_id)
 
 def save_profile_adv(user_id:int, canopy_class, spacing_x_m, spacing_y_m, plants_per_ha):
-    conn = db()
-    if conn.execute("SELECT 1 FROM profiles WHERE user_id=?",(user_id,)).fetchone() is None:
-        conn.execute("INSERT INTO profiles(user_id, cultivo, suelo, cubierta, eficiencia, caudal_m3h_ha) VALUES (?,?,?,?,?,?)",
-                     (user_id,"","","no",EFF_DEFAULT,0.0))
-    conn.execute("""
-        UPDATE profiles
-           SET canopy_class=?,
-               spacing_x_m=?,
-               spacing_y_m=?,
-               plants_per_ha=?
-         WHERE user_id=?""",
-        (canopy_class, spacing_x_m, spacing_y_m, plants_per_ha, user_id))
-    conn.commit(); conn.close()
-
-def add_log(user_id:int, fecha:str, cultivo:str, sector:str, horas:float, nota:str):
-    conn = db()
-    conn.execute("INSERT INTO logs(user_id, fecha, cultivo, sector, horas, nota) VALUES (?,?,?,?,?,?)",
-                 (user_id, fecha, cultivo, sector, horas, nota))
-    conn.commit(); conn.close()
-
-def get_logs(user_id:int, limit=10):
-    conn = db()
-    rows = conn.execute("SELECT fecha, cultivo, sector, horas, nota FROM logs WHERE user_id=? ORDER BY id DESC LIMIT ?",
-                        (user_id, limit)).fetchall()
-    conn.close()
-    return rows
+    with db_write() as conn:
+        if conn.execute("SELECT 1 FROM profiles WHERE user_id=?",(user_id,)).fetchone() is None:
+            conn.execute("INSERT INTO profiles(user_id, cultivo, suelo, cubierta, eficiencia, caudal_m3h_ha) VALUES (?,?,?,?,?,?)",
+                         (user_id,"","","no",REF["eff_default"],0.0))
+        conn.execute("""
+            UPDATE profiles
+               SET canopy_class=?,
+                   spacing_x_m=?,
+                   spacing_y_m=?,
+                   plants_per_ha=?
+             WHERE user_id=?""",
+            (canopy_class, spacing_x_m, spacing_y_m, plants_per_ha, user_id))
+    invalidate_user_ctx(user_id)
 
-def add_estado(user_id:int, presion:str, filtros:str, valvulas:str, goteros:str, nota:str):
-    conn = db()
+# -------------------------
+# Sectores: la lista de nombres va en el contexto de usuario; los datos de cada
+# sector, en su propia entrada LRU (uid, sector). Editar un sector solo invalida
+# su entrada; crear o borrar uno invalida además la lista (contexto de usuario).
+# Lo que falte en caché se carga en una sola consulta.
+# -------------------------
+_scache       = OrderedDict()   # (uid, sector) -> (expira_monotonic, dict)
+_scache_lock  = threading.Lock()
+_scache_epoch = 0
+_scache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+def _sector_from_row(r) -> dict:
+    return {"sector": r[0], "cultivo": r[1], "area_ha": r[2], "caudal_m3h_ha": r[3],
+            "canopy_class": r[4], "spacing_x_m": r[5], "spacing_y_m": r[6], "plants_per_ha": r[7]}
+
+def get_sectors(uid:int) -> list[dict]:
+    nombres = get_user_ctx(uid)["sectores"]
+    now = time.monotonic()
+    found, faltan = {}, []
+    with _scache_lock:
+        for n in nombres:
+            hit = _scache.get((uid, n))
+            if hit and hit[0] > now:
+                _scache.move_to_end((uid, n))
+                found[n] = hit[1]
+            else:
+                faltan.append(n)
+        _scache_stats["hits"] += len(found)
+        _scache_stats["misses"] += len(faltan)
+        epoch = _scache_epoch
+    if faltan:
+        with db_read() as conn:
+            if len(faltan) == len(nombres):
+                rows = conn.execute(SQL_SECTORES_USUARIO, (uid,)).fetchall()
+            else:
+                marks = ",".join("?" * len(faltan))
+                rows = conn.execute(SQL_SECTORES_USUARIO + f" AND sector IN ({marks})", (uid, *faltan)).fetchall()
+        cargados = {r[0]: _sector_from_row(r) for r in rows}
+        found.update(cargados)
+        with _scache_lock:
+            if epoch == _scache_epoch:
+                for n, sec in cargados.items():
+                    _scache[(uid, n)] = (now + USER_CACHE_TTL, sec)
+                    _scache.move_to_end((uid, n))
+                while len(_scache) > USER_CACHE_SIZE:
+                    _scache.popitem(last=False)
+    return [found[n] for n in nombres if n in found]
+
+def invalidate_sector(uid:int, sector:str|None=None):
+    # sector=None: todos los del usuario (reset)
+    global _scache_epoch
+    with _scache_lock:
+        _scache_epoch += 1
+        if sector is None:
+            for key in [k for k in _scache if k[0] == uid]:
+                del _scache[key]
+        else:
+            _scache.pop((uid, sector), None)
+        _scache_stats["invalidations"] += 1
+
+def sector_cache_stats() -> dict:
+    with _scache_lock:
+        return dict(_scache_stats, size=len(_scache))
+
+def save_sector(user_id:int, sector:str, cultivo=None, area_ha=None, caudal=None,
+                canopy_class=None, spacing_x_m=None, spacing_y_m=None, plants_per_ha=None):
+    sector = norm_sector(sector)
+    with db_write() as conn:
+        nuevo = conn.execute("SELECT 1 FROM sectors WHERE user_id=? AND sector=?", (user_id, sector)).fetchone() is None
+        conn.execute("""
+        INSERT INTO sectors(user_id, sector, cultivo, area_ha, caudal_m3h_ha, canopy_class,
+                            spacing_x_m, spacing_y_m, plants_per_ha)
+        VALUES (?,?,?,?,?,?,?,?,?)
+        ON CONFLICT(user_id, sector) DO UPDATE SET
+          cultivo=excluded.cultivo,
+          area_ha=excluded.area_ha,
+          caudal_m3h_ha=excluded.caudal_m3h_ha,
+          canopy_class=excluded.canopy_class,
+          spacing_x_m=excluded.spacing_x_m,
+          spacing_y_m=excluded.spacing_y_m,
+          plants_per_ha=excluded.plants_per_ha
+        """, (user_id, sector, cultivo, area_ha, caudal, canopy_class, spacing_x_m, spacing_y_m, plants_per_ha))
+    invalidate_sector(user_id, sector)
+    if nuevo:
+        invalidate_user_ctx(user_id)
+
+def sector_efectivo(profile:dict, adv:tuple, sec:dict|None) -> dict:
+    # Valores con los que se calcula un sector: los suyos o, si faltan, los del perfil
+    sec = sec or {}
+    return {"sector": sec.get("sector", ""),
+            "cultivo": sec.get("cultivo") or profile["cultivo"],
+            "suelo": profile["suelo"],
+            "cubierta": profile["cubierta"],
+            "eficiencia": profile["eficiencia"],
+            "caudal_m3h_ha": sec.get("caudal_m3h_ha") or profile["caudal_m3h_ha"],
+            "canopy_class": sec.get("canopy_class") or adv[0],
+            "plants_per_ha": sec.get("plants_per_ha") or adv[3],
+            "area_ha": sec.get("area_ha")}
+
+# Altas de registros: funciones _tx_* que escriben sin commit; la cola de
+# escritura las agrupa y hace un único commit por lote.
+def _tx_add_log(conn, user_id:int, fecha:str, cultivo:str, sector:str, horas:float, nota:str) -> bool:
+    # Devuelve True si el sector es nuevo (hay que invalidar el contexto del usuario)
+    d = parse_fecha(fecha)
+    if d is None:
+        raise ValueError(f"fecha no válida: {fecha!r}")
+    conn.execute("INSERT INTO logs(user_id, fecha, fecha_dia, cultivo, sector, horas, nota) VALUES (?,?,?,?,?,?,?)",
+                 (user_id, d.isoformat(), epoch_day(d), cultivo, sector, horas, nota))
+    conn.execute(SQL_LOGS_MES_UPSERT, (user_id, mes_key(d), sector, horas or 0.0))
+    nuevo = bool(norm_sector(sector)) and conn.execute(
+        "INSERT OR IGNORE INTO sectors(user_id, sector) VALUES (?,?)", (user_id, norm_sector(sector))).rowcount == 1
+    _tx_balance_riego(conn, user_id, sector, epoch_day(d), horas or 0.0)
+    return nuevo
+
+def _tx_add_estado(conn, user_id:int, presion:str, filtros:str, valvulas:str, goteros:str, nota:str):
     conn.execute("""
         INSERT INTO sys_estado(user_id, fecha, presion, filtros, valvulas, goteros, nota)
         VALUES (?,?,?,?,?,?,?)
     """,(user_id, datetime.now().strftime("%Y-%m-%d"), presion, filtros, valvulas, goteros, nota))
-    conn.commit(); conn.close()
 
-def add_mant(user_id:int, tarea:str, comentario:str):
-    conn = db()
+def _tx_add_mant(conn, user_id:int, tarea:str, comentario:str):
     conn.execute("""
         INSERT INTO sys_mant(user_id, fecha, tarea, comentario)
         VALUES (?,?,?,?)
     """,(user_id, datetime.now().strftime("%Y-%m-%d"), tarea, comentario))
-    conn.commit(); conn.close()
+
+def _tx_add_alerta(conn, user_id:int, descripcion:str, sector:str):
+    conn.execute("INSERT INTO sys_alerta(user_id, fecha, descripcion, sector) VALUES (?,?,?,?)",
+                 (user_id, datetime.now().strftime("%Y-%m-%d"), descripcion, sector))
+
+BACKFILL_EJEMPLOS = 10   # filas no interpretables que se listan; del resto solo el total
+BACKFILL_VECINOS  = 50   # filas a cada lado en las que buscar fecha para 'hoy'/'ayer' antiguos
+
+def _fecha_vecinos(conn, rid:int) -> date | None:
+    # Un 'hoy' antiguo se fechó al escribirse, que no quedó guardado. Los ids son
+    # correlativos: si la fila con fecha explícita más cercana por debajo y por
+    # encima coinciden, esa es la fecha de alta; si no, no se puede saber.
+    def primera(sql):
+        for (txt,) in conn.execute(sql, (rid, BACKFILL_VECINOS)):
+            s = (txt or "").strip().lower()
+            if s not in _FECHA_RELATIVAS:
+                d = _parse_fecha_abs(s)
+                if d is not None:
+                    return d
+        return None
+    antes = primera("SELECT fecha FROM logs WHERE id<? ORDER BY id DESC LIMIT ?")
+    despues = primera("SELECT fecha FROM logs WHERE id>? ORDER BY id LIMIT ?")
+    return antes if antes is not None and antes == despues else None
+
+def backfill_fecha_dia(batch:int=5000, todo:bool=False) -> tuple[int, int]:
+    # Rellena fecha_dia en filas antiguas por lotes (keyset por id); normaliza
+    # también el texto a YYYY-MM-DD. 'hoy'/'ayer' se fechan por sus vecinas
+    # (_fecha_vecinos), nunca con la fecha actual. Las que no se pueden
+    # interpretar se quedan en NULL: fuera de logs_mes y del balance.
+    # Hasta dónde se ha revisado queda en db_meta: cada arranque solo mira filas
+    # nuevas (las altas ya llevan fecha_dia) y no repite las no interpretables.
+    # todo=True vuelve a revisar desde el principio (p. ej. si mejora parse_fecha).
+    ok = bad = 0
+    last_id = 0
+    if not todo:
+        with db_read() as conn:
+            r = conn.execute("SELECT valor FROM db_meta WHERE clave='backfill_fecha_dia_id'").fetchone()
+        last_id = int(r[0]) if r else 0
+    usuarios = set()
+    while True:
+        with db_read() as conn:
+            rows = conn.execute("""
+                SELECT id, fecha, user_id, sector, horas FROM logs
+                 WHERE fecha_dia IS NULL AND id>? ORDER BY id LIMIT ?""", (last_id, batch)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        updates, agregados = [], []
+        for rid, fecha, uid, sector, horas in rows:
+            s = (fecha or "").strip().lower()
+            if s in _FECHA_RELATIVAS:
+                with db_read() as conn:
+                    d = _fecha_vecinos(conn, rid)
+                if d is not None:
+                    d -= timedelta(days=_FECHA_RELATIVAS[s])
+            else:
+                d = _parse_fecha_abs(s)
+            if d is None:
+                bad += 1
+                if bad <= BACKFILL_EJEMPLOS:
+                    print(f"[db] fecha no interpretable en logs.id={rid}: {fecha!r}")
+                continue
+            updates.append((d.isoformat(), epoch_day(d), rid))
+            agregados.append((uid, mes_key(d), sector, horas or 0.0))
+            usuarios.add(uid)
+        with db_write() as conn:
+            conn.executemany("UPDATE logs SET fecha=?, fecha_dia=? WHERE id=?", updates)
+            conn.executemany(SQL_LOGS_MES_UPSERT, agregados)
+            conn.execute("""
+                INSERT INTO db_meta(clave, valor) VALUES ('backfill_fecha_dia_id', ?)
+                ON CONFLICT(clave) DO UPDATE SET valor=excluded.valor""", (str(last_id),))
+        ok += len(updates)
+    # Los riegos recuperados pueden ser anteriores al estado guardado: se rehace
+    if usuarios:
+        with db_write() as conn:
+            for uid in usuarios:
+                _tx_rebuild_balance(conn, uid)
+    return ok, bad
+
+def get_logs(user_id:int, limit=10):
+    with db_read() as conn:
+        return conn.execute(SQL_LOGS_ULTIMOS, (user_id, limit)).fetchall()
+
+def add_waitlist(user_id:int, name:str):
+    with db_write() as conn:
+        conn.execute("INSERT OR IGNORE INTO waitlist(user_id, name, date) VALUES (?,?,?)",
+                     (user_id, name, datetime.now().strftime("%Y-%m-%d")))
+
+def get_sistema(user_id:int, limit=5):
+    # Últimos registros de estado, mantenimiento y alertas (para /resumen y exportación)
+    with db_read() as conn:
+        est  = conn.execute(SQL_ESTADO_ULTIMOS, (user_id, limit)).fetchall()
+        mant = conn.execute(SQL_MANT_ULTIMOS,   (user_id, limit)).fetchall()
+        alr  = conn.execute(SQL_ALERTA_ULTIMOS, (user_id, limit)).fetchall()
+    return est, mant, alr
+
+def agua_meses(user_id:int, mes:int, mes_ref:int) -> dict[int, dict[str, float]]:
+    # Horas por sector de dos meses (p. ej. actual y mismo mes del año anterior)
+    out = {mes: {}, mes_ref: {}}
+    with db_read() as conn:
+        for m, sector, horas in conn.execute(SQL_AGUA_MESES, (user_id, mes, mes_ref)):
+            out[m][sector] = horas
+    return out
+
+def rebuild_logs_mes(user_id:int|None=None):
+    with db_write() as conn:
+        if user_id is None:
+            conn.execute("DELETE FROM logs_mes")
+            conn.execute(SQL_LOGS_MES_REBUILD.format(filtro=""))
+        else:
+            conn.execute("DELETE FROM logs_mes WHERE user_id=?", (user_id,))
+            conn.execute(SQL_LOGS_MES_REBUILD.format(filtro="AND user_id=?"), (user_id,))
+
+def reset_user(user_id:int, todo:bool=False):
+    with db_write() as conn:
+        conn.execute("DELETE FROM logs WHERE user_id=?", (user_id,))
+        conn.execute("DELETE FROM logs_mes WHERE user_id=?", (user_id,))
+        conn.execute("DELETE FROM balance_sector WHERE user_id=?", (user_id,))
+        conn.execute("DELETE FROM eto_usuario WHERE user_id=?", (user_id,))
+        conn.execute("DELETE FROM sys_estado WHERE user_id=?", (user_id,))
+        conn.execute("DELETE FROM sys_mant WHERE user_id=?", (user_id,))
+        conn.execute("DELETE FROM sys_alerta WHERE user_id=?", (user_id,))
+        if todo:
+            conn.execute("DELETE FROM profiles WHERE user_id=?", (user_id,))
+            conn.execute("DELETE FROM user_settings WHERE user_id=?", (user_id,))
+            conn.execute("DELETE FROM notif_entregas WHERE user_id=?", (user_id,))
+            conn.execute("DELETE FROM sectors WHERE user_id=?", (user_id,))
+    invalidate_user_ctx(user_id)
+    invalidate_sector(user_id)
 
 # Ajustes de usuario (agua y notificaciones)
 def get_settings(uid:int):
-    conn = db()
-    r = conn.execute("""
-        SELECT objetivo_m3ha_mes, precio_m3,
-               COALESCE(notify_enabled,0),
-               COALESCE(notify_time,'08:00'),
-               COALESCE(notify_kind,'mixto'),
-               COALESCE(notify_freq,'diaria'),
-               COALESCE(notif_last_idx,-1)
-          FROM user_settings
-         WHERE user_id=?""",(uid,)).fetchone()
-    conn.close()
-    if not r:
-        return {"objetivo":None,"precio":None,
-                "notify_enabled":0,"notify_time":"08:00",
-                "notify_kind":"mixto","notify_freq":"diaria",
-                "notif_last_idx":-1}
-    return {"objetivo":r[0], "precio":r[1],
-            "notify_enabled":int(r[2] or 0), "notify_time":r[3],
-            "notify_kind":r[4], "notify_freq":r[5],
-            "notif_last_idx": int(r[6] if r[6] is not None else -1)}
+    return get_user_ctx(uid)["settings"]
 
 def save_settings(uid:int, objetivo=None, precio=None,
-                  notify_enabled=None, notify_time=None, notify_kind=None, notify_freq=None):
-    conn = db()
-    conn.execute("""
-      INSERT INTO user_settings(user_id, objetivo_m3ha_mes, precio_m3, notify_enabled, notify_time, notify_kind, notify_freq)
-      VALUES (?,?,?,?,?,?,?)
-      ON CONFLICT(user_id) DO UPDATE SET
-        objetivo_m3ha_mes = COALESCE(?, objetivo_m3ha_mes),
-        precio_m3         = COALESCE(?, precio_m3),
-        notify_enabled    = COALESCE(?, notify_enabled),
-        notify_time       = COALESCE(?, notify_time),
-        notify_kind       = COALESCE(?, notify_kind),
-        notify_freq       = COALESCE(?, notify_freq)
-    """,(uid, objetivo, precio, notify_enabled, notify_time, notify_kind, notify_freq,
-         objetivo, precio, notify_enabled, notify_time, notify_kind, notify_freq))
-    conn.commit(); conn.close()
+                  notify_enabled=None, notify_time=None, notify_kind=None, notify_freq=None,
+                  caudal_max=None, tarifa_valle=None, estacion=None, notify_weekday=None):
+    # estacion='' desvincula la estación (None = no tocar, como el resto)
+    with db_write() as conn:
+        conn.execute("""
+          INSERT INTO user_settings(user_id, objetivo_m3ha_mes, precio_m3, notify_enabled, notify_time, notify_kind, notify_freq,
+                                    caudal_max_m3h, tarifa_valle, estacion, notify_weekday)
+          VALUES (?,?,?,?,COALESCE(?,'08:00'),?,?,?,?,?,?)
+          ON CONFLICT(user_id) DO UPDATE SET
+            objetivo_m3ha_mes = COALESCE(?, objetivo_m3ha_mes),
+            precio_m3         = COALESCE(?, precio_m3),
+            notify_enabled    = COALESCE(?, notify_enabled),
+            notify_time       = COALESCE(?, notify_time, '08:00'),
+            notify_kind       = COALESCE(?, notify_kind),
+            notify_freq       = COALESCE(?, notify_freq),
+            caudal_max_m3h    = COALESCE(?, caudal_max_m3h),
+            tarifa_valle      = COALESCE(?, tarifa_valle),
+            estacion          = COALESCE(?, estacion),
+            notify_weekday    = COALESCE(?, notify_weekday)
+        """,(uid, objetivo, precio, notify_enabled, notify_time, notify_kind, notify_freq, caudal_max, tarifa_valle, estacion,
+             notify_weekday,
+             objetivo, precio, notify_enabled, notify_time, notify_kind, notify_freq, caudal_max, tarifa_valle, estacion,
+             notify_weekday))
+    invalidate_user_ctx(uid)
+
+def get_notify_slot_page(slot:str, weekday:int, fecha:str, after:int, limit:int) -> list[tuple]:
+    # Suscriptores de una franja (diarios + semanales de hoy) aún sin entrega
+    # registrada ese día, por páginas de user_id
+    with db_read() as conn:
+        return conn.execute(SQL_NOTIFY_SLOT, (slot, after, weekday, fecha, slot, limit)).fetchall()
+
+# Consultas calientes: nombre → (sql, parámetros de ejemplo). Toda consulta nueva
+# por usuario debe añadirse aquí; check_query_plans() falla si alguna recorre
+# una tabla entera (SCAN) u ordena sin índice (TEMP B-TREE).
+HOT_QUERIES = {
+    "logs_ultimos":     (SQL_LOGS_ULTIMOS,     (1, 10)),
+    "agua_meses":       (SQL_AGUA_MESES,       (1, 202510, 202410)),
+    "estado_ultimos":   (SQL_ESTADO_ULTIMOS,   (1, 5)),
+    "mant_ultimos":     (SQL_MANT_ULTIMOS,     (1, 5)),
+    "alerta_ultimos":   (SQL_ALERTA_ULTIMOS,   (1, 5)),
+    "notify_slot":      (SQL_NOTIFY_SLOT,      ("08:00", 0, 3, "2025-06-02", "08:00", 500)),
+    "balance_usuario":  (SQL_BALANCE_USUARIO,  (1,)),
+    "eto_desde":        (SQL_ETO_DESDE,        (1, 20000)),
+    "logs_hay":         (SQL_LOGS_HAY,         (1,)),
+    "perfil":           (SQL_PERFIL,           (1,)),
+    "sectores_nombres": (SQL_SECTORES_NOMBRES, (1,)),
+    "sectores_usuario": (SQL_SECTORES_USUARIO, (1,)),
+    "sector_uno":       (SQL_SECTOR_UNO,       (1, "S1")),
+    "eto_estacion":     (SQL_ETO_ESTACION_RANGO, ("E1", 20000, 20006)),
+    "estacion_una":     (SQL_ESTACION_UNA,     ("E1",)),
+}
+
+def check_query_plans() -> list[tuple[str, str]]:
+    bad = []
+    with db_read() as conn:
+        for name, (sql, params) in HOT_QUERIES.items():
+            for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall():
+                detail = row[-1]
+                if detail.startswith("SCAN") or "TEMP B-TREE" in detail:
+                    bad.append((name, detail))
+    return bad
 
 # =========================
 # Helpers de cálculo / formato
@@ -337,28 +1372,48 @@ def calc_plants_per_ha(spacing_x_m: float, spacing_y_m: float):
         pass
     return None
 
-def canopy_factor(canopy_class: str | None) -> float:
+def canopy_factor(canopy_class: str | None, ref: dict | None = None) -> float:
     if not canopy_class: return 1.0
-    return CANOPY.get(canopy_class.strip().lower(), 1.0)
+    return (ref or REF)["canopy"].get(canopy_class.strip().lower(), 1.0)
 
 def fmt_horas_min(h):
     if h is None: return None
     total_min = int(round(h*60))
     return f"{total_min//60} h {total_min%60:02d} min"
 
+TG_MSG_MAX = 4000   # margen bajo el límite de 4096 caracteres de Telegram
+
+def split_msg(lines: list[str], limit: int = TG_MSG_MAX) -> list[str]:
+    # Agrupa líneas en el mínimo de mensajes que caben en Telegram
+    chunks, cur, size = [], [], 0
+    for ln in lines:
+        if cur and size + len(ln) + 1 > limit:
+            chunks.append("\n".join(cur))
+            cur, size = [], 0
+        cur.append(ln)
+        size += len(ln) + 1
+    if cur:
+        chunks.append("\n".join(cur))
+    return chunks
+
 def calc_riego(eto: float, cultivo: str, month_num: int,
                suelo: str, cubierta: str, eficiencia: float,
                stress_factor: float = 1.0,
                caudal_m3h_ha: float | None = None,
-               f_copa: float = 1.0):
-    kc = kc_default_for(cultivo, month_num)
+               f_copa: float = 1.0,
+               dia: date | None = None,
+               ref: dict | None = None):
+    # dia: Kc interpolado a resolución diaria en lugar del Kc mensual
+    # ref: instantánea de tablas a usar (por defecto la vigente)
+    ref = ref or REF
+    kc = kc_for_day(cultivo, dia, ref) if dia else kc_default_for(cultivo, month_num, ref)
     kc = kc * (f_copa if f_copa and f_copa > 0 else 1.0)
-    soil_factor  = SOIL_MAP.get((suelo or "").lower(), 1.0)
-    cover_factor = COVER_MAP.get((cubierta or "").lower(), 1.0)
+    soil_factor  = ref["soil"].get((suelo or "").lower(), 1.0)
+    cover_factor = ref["cover"].get((cubierta or "").lower(), 1.0)
     etc     = eto * kc
     etc_adj = etc * soil_factor * cover_factor * stress_factor
     if eficiencia <= 0 or eficiencia > 1.0:
-        eficiencia = EFF_DEFAULT
+        eficiencia = ref["eff_default"]
     riego_mm   = etc_adj / eficiencia
     m3_ha_dia  = riego_mm * 10.0
     horas = None
@@ -367,8 +1422,114 @@ def calc_riego(eto: float, cultivo: str, month_num: int,
     return {
         "kc": kc, "soil_factor": soil_factor, "cover_factor": cover_factor,
         "efficiency": eficiencia, "eto": eto, "etc": etc, "etc_adj": etc_adj,
-        "riego_mm": riego_mm, "m3_ha_dia": m3_ha_dia, "horas_dia": horas
+        "riego_mm": riego_mm, "m3_ha_dia": m3_ha_dia, "horas_dia": horas,
+        "ref_version": ref["version"]
     }
+
+# --- Cálculo en lote (muchos sectores × días). Mismas operaciones y en el mismo
+# orden que calc_riego, así que los resultados coinciden bit a bit. Con NumPy
+# devuelve arrays (horas_dia = NaN sin caudal); sin NumPy, listas (None).
+# "ref_version" (escalar) indica la versión de tablas usada por todo el lote.
+RIEGO_KEYS = ("kc", "soil_factor", "cover_factor", "efficiency", "eto", "etc",
+              "etc_adj", "riego_mm", "m3_ha_dia", "horas_dia")
+
+def _bcast(v, n:int) -> list:
+    if v is None or isinstance(v, (str, bytes, int, float)):
+        return [v] * n
+    v = list(v)
+    if len(v) != n:
+        raise ValueError(f"longitud {len(v)} != {n}")
+    return v
+
+def _batch_len(*vals) -> int:
+    n = 1
+    for v in vals:
+        if v is not None and not isinstance(v, (str, bytes, int, float)):
+            n = max(n, len(v))
+    return n
+
+def _lookup(vals:list, fn) -> list:
+    # Aplica fn una vez por valor distinto (cultivos/suelos se repiten mucho)
+    memo = {}
+    out = []
+    for v in vals:
+        r = memo.get(v)
+        if r is None:
+            r = memo[v] = fn(v)
+        out.append(r)
+    return out
+
+def calc_riego_batch(eto, cultivo, month_num, suelo, cubierta, eficiencia,
+                     stress_factor=1.0, caudal_m3h_ha=None, f_copa=1.0, ref=None) -> dict:
+    ref = ref or REF
+    n = _batch_len(eto, cultivo, month_num, suelo, cubierta, eficiencia, stress_factor, caudal_m3h_ha, f_copa)
+    if np is None:
+        cols = {k: [] for k in RIEGO_KEYS}
+        for args in zip(_bcast(eto, n), _bcast(cultivo, n), _bcast(month_num, n), _bcast(suelo, n),
+                        _bcast(cubierta, n), _bcast(eficiencia, n), _bcast(stress_factor, n),
+                        _bcast(caudal_m3h_ha, n), _bcast(f_copa, n)):
+            res = calc_riego(*args, ref=ref)
+            for k in RIEGO_KEYS:
+                cols[k].append(res[k])
+        cols["ref_version"] = ref["version"]
+        return cols
+
+    crops  = _lookup(_bcast(cultivo, n), norm_crop)
+    crop_ids = {}
+    crop_idx = np.fromiter((crop_ids.setdefault(c, len(crop_ids)) for c in crops), dtype=np.int64, count=n)
+    table  = np.array([[ref["kc_index"].get((c, m), KC_FALLBACK) for m in range(1, 13)] for c in crop_ids], dtype=np.float64)
+    months = np.asarray(_bcast(month_num, n), dtype=np.int64)
+    kc_base = table[crop_idx, months - 1]
+
+    fc = np.asarray([v if v else 0.0 for v in _bcast(f_copa, n)], dtype=np.float64)
+    kc = kc_base * np.where(fc > 0, fc, 1.0)
+    soil  = np.asarray(_lookup(_bcast(suelo, n),    lambda s: ref["soil"].get((s or "").lower(), 1.0)),  dtype=np.float64)
+    cover = np.asarray(_lookup(_bcast(cubierta, n), lambda s: ref["cover"].get((s or "").lower(), 1.0)), dtype=np.float64)
+    eto_a = np.asarray(_bcast(eto, n), dtype=np.float64)
+    sf    = np.asarray(_bcast(stress_factor, n), dtype=np.float64)
+    etc     = eto_a * kc
+    etc_adj = etc * soil * cover * sf
+    eff = np.asarray(_bcast(eficiencia, n), dtype=np.float64)
+    eff = np.where((eff <= 0) | (eff > 1.0), ref["eff_default"], eff)
+    riego_mm  = etc_adj / eff
+    m3_ha_dia = riego_mm * 10.0
+    caudal = np.asarray([v if v else 0.0 for v in _bcast(caudal_m3h_ha, n)], dtype=np.float64)
+    con_caudal = caudal > 0
+    horas = np.where(con_caudal, m3_ha_dia / np.where(con_caudal, caudal, 1.0), np.nan)
+    return {
+        "kc": kc, "soil_factor": soil, "cover_factor": cover,
+        "efficiency": eff, "eto": eto_a, "etc": etc, "etc_adj": etc_adj,
+        "riego_mm": riego_mm, "m3_ha_dia": m3_ha_dia, "horas_dia": horas,
+        "ref_version": ref["version"]
+    }
+
+def bench_riego(n:int=100_000, seed:int=1) -> dict:
+    rnd = random.Random(seed)
+    crops = ["Almendro", "Olivo", "Viña", "Cítricos", "Pistacho", "Aguacate", "otro"]
+    args = dict(
+        eto=[rnd.uniform(0.5, 8.0) for _ in range(n)],
+        cultivo=[rnd.choice(crops) for _ in range(n)],
+        month_num=[rnd.randint(1, 12) for _ in range(n)],
+        suelo=[rnd.choice(["arenoso", "franco", "arcilloso", ""]) for _ in range(n)],
+        cubierta=[rnd.choice(["si", "no"]) for _ in range(n)],
+        eficiencia=[rnd.choice([0.0, 0.8, 0.88, 0.92, 1.2]) for _ in range(n)],
+        stress_factor=[rnd.choice([1.0, 0.95, 0.90]) for _ in range(n)],
+        caudal_m3h_ha=[rnd.choice([0.0, None, 25.0, 32.5]) for _ in range(n)],
+        f_copa=[rnd.choice([0.55, 0.8, 1.0, None]) for _ in range(n)],
+    )
+    t0 = time.perf_counter()
+    loop = [calc_riego(*row) for row in zip(*args.values())]
+    t_loop = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    batch = calc_riego_batch(**args)
+    t_batch = time.perf_counter() - t0
+
+    # None (sin caudal) equivale a NaN en la versión NumPy
+    mismatches = sum(
+        1 for i, res in enumerate(loop) for k in RIEGO_KEYS
+        if not (res[k] == batch[k][i] or (res[k] is None and (batch[k][i] is None or batch[k][i] != batch[k][i])))
+    )
+    return {"n": n, "numpy": np is not None, "t_loop": t_loop, "t_batch": t_batch, "mismatches": mismatches}
 # =========================
 # Consejos diarios (breves)
 # =========================
@@ -420,6 +1581,37 @@ def consejo_del_dia() -> str:
     idx = datetime.now().toordinal() % len(TIPS_DIARIOS)
     return f"💡 Consejo de hoy: {TIPS_DIARIOS[idx]}"
 
+# --- Parser de fechas (para /registrar y el backfill de logs.fecha)
+_EPOCH_ORD = date(1970, 1, 1).toordinal()
+_FECHA_FMTS = ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y", "%Y/%m/%d", "%d/%m/%y")
+
+def epoch_day(d: date) -> int:
+    return d.toordinal() - _EPOCH_ORD
+
+def mes_key(d: date) -> int:
+    return d.year * 100 + d.month
+
+def from_epoch_day(n: int) -> date:
+    return date.fromordinal(n + _EPOCH_ORD)
+
+_FECHA_RELATIVAS = {"hoy": 0, "today": 0, "ayer": 1, "yesterday": 1}   # días hacia atrás
+
+def parse_fecha(txt: str, hoy: date | None = None) -> date | None:
+    # Entrada del usuario: 'hoy'/'ayer' se resuelven respecto a hoy. Para filas
+    # antiguas no sirve (no guardan cuándo se escribieron): ver backfill_fecha_dia.
+    s = (txt or "").strip().lower()
+    if s in _FECHA_RELATIVAS:
+        return (hoy or datetime.now().date()) - timedelta(days=_FECHA_RELATIVAS[s])
+    return _parse_fecha_abs(s)
+
+def _parse_fecha_abs(s: str) -> date | None:
+    for fmt in _FECHA_FMTS:
+        try:
+            return datetime.strptime(s, fmt).date()
+        except ValueError:
+            pass
+    return None
+
 # --- Parser HH.MM a horas decimales (para /registrar)
 def parse_horas_dotmin(txt: str) -> float | None:
     s = txt.strip().replace(",", ".")
@@ -510,11 +1702,15 @@ async def finca_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• /perfil – datos base\n"
         "• /avanzado – tamaño de copa y marco\n"
         "• /ajustes_agua – objetivo (m³/ha/mes) y €/m³\n"
-        "• /perfil_ver – ver tu perfil guardado"
+        "• /perfil_ver – ver tu perfil guardado\n"
+        "• /sectores – tus sectores · /sector – crear o editar uno\n"
+        "• /estacion – estación meteorológica para la ETo diaria"
     )
     kb = kb_with_cancel([
         ["/perfil", "/avanzado"],
-        ["/ajustes_agua", "/perfil_ver"]
+        ["/ajustes_agua", "/perfil_ver"],
+        ["/sectores", "/sector"],
+        ["/estacion"]
     ])
     await update.message.reply_text(txt, reply_markup=kb)
 
@@ -544,7 +1740,7 @@ async def perfil_eficiencia(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         eficiencia = float(update.message.text.replace(",", "."))
     except:
-        eficiencia = EFF_DEFAULT
+        eficiencia = REF["eff_default"]
     context.user_data["eficiencia"] = eficiencia
     await update.message.reply_text("Caudal del sistema en m³/h/ha (si no sabes, pulsa Omitir):",
                                     reply_markup=kb_with_cancel([["Omitir"]]))
@@ -563,7 +1759,7 @@ async def perfil_caudal(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return PERFIL_CAUDAL
     context.user_data["caudal_m3h_ha"] = caudal
     user_id = update.message.from_user.id
-    save_profile(user_id,
+    await run_db(save_profile, user_id,
                  context.user_data["cultivo"],
                  context.user_data["suelo"],
                  context.user_data["cubierta"],
@@ -587,7 +1783,7 @@ async def perfil_canopy(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def perfil_marco_x(update: Update, context: ContextTypes.DEFAULT_TYPE):
     txt = update.message.text.strip().lower()
     if txt == "saltar":
-        save_profile_adv(update.message.from_user.id, context.user_data.get("canopy_class"), None, None, None)
+        await run_db(save_profile_adv, update.message.from_user.id, context.user_data.get("canopy_class"), None, None, None)
         await update.message.reply_text("✅ Perfil avanzado guardado (solo copa).", reply_markup=kb_main())
         return ConversationHandler.END
     try:
@@ -607,7 +1803,7 @@ async def perfil_marco_y(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return PERFIL_MARCO_Y
     x = context.user_data.get("spacing_x_m")
     ppha = calc_plants_per_ha(x, y)
-    save_profile_adv(update.message.from_user.id, context.user_data.get("canopy_class"), x, y, ppha)
+    await run_db(save_profile_adv, update.message.from_user.id, context.user_data.get("canopy_class"), x, y, ppha)
     fin = f"✅ Perfil avanzado guardado. Marco: {x}×{y} m"
     if ppha:
         fin += f" ({ppha:.0f} plantas/ha)."
@@ -617,17 +1813,14 @@ async def perfil_marco_y(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # /perfil_ver
 async def perfil_ver(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    profile = get_profile(user_id)
+    uctx    = await run_db(get_user_ctx, user_id)
+    profile = uctx["profile"]
     if not profile:
         await update.message.reply_text("No tienes perfil aún. Usa /perfil.", reply_markup=kb_main())
         return
-    conn = db()
-    adv = conn.execute("SELECT canopy_class, spacing_x_m, spacing_y_m, plants_per_ha FROM profiles WHERE user_id=?",
-                       (user_id,)).fetchone()
-    conn.close()
-    canopy, sx, sy, ppha = (adv if adv else (None, None, None, None))
+    canopy, sx, sy, ppha = uctx["adv"]
 
-    s = get_settings(user_id)
+    s = uctx["settings"]
     objetivo = s.get("objetivo")
     precio   = s.get("precio")
 
@@ -655,6 +1848,99 @@ async def perfil_ver(update: Update, context: ContextTypes.DEFAULT_TYPE):
     kb = kb_with_cancel([["/ajustes_agua"], ["/menu_finca"]])
     await update.message.reply_text(txt, reply_markup=kb)
 
+# /sectores y /sector: lo que no se indique se toma del perfil
+COMO_PERFIL = "Como el perfil"
+
+async def sectores(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid  = update.message.from_user.id
+    secs = await run_db(get_sectors, uid)
+    if not secs:
+        await update.message.reply_text("Aún no tienes sectores. Crea uno con /sector o registra un riego.",
+                                        reply_markup=kb_main())
+        return
+    lines = [f"🧩 *Sectores* ({len(secs)}) — «perfil» = se usa el valor del /perfil"]
+    for s in secs:
+        partes = [s["cultivo"] or "cultivo: perfil"]
+        partes.append(f"{s['area_ha']:g} ha" if s["area_ha"] else "sin superficie")
+        partes.append(f"{s['caudal_m3h_ha']:g} m³/h/ha" if s["caudal_m3h_ha"] else "caudal: perfil")
+        partes.append(f"copa {s['canopy_class']}" if s["canopy_class"] else "copa: perfil")
+        if s["spacing_x_m"] and s["spacing_y_m"]:
+            partes.append(f"marco {s['spacing_x_m']:g}×{s['spacing_y_m']:g} m")
+        lines.append(f"- {s['sector']}: " + " · ".join(partes))
+    chunks = split_msg(lines)
+    for chunk in chunks[:-1]:
+        await update.message.reply_text(chunk)
+    await update.message.reply_text(chunks[-1], reply_markup=kb_with_cancel([["/sector", "/riego_todos"]]))
+
+async def sector_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("Nombre del sector (ej. S3). Si ya existe, se actualiza:", reply_markup=kb_cancel_only())
+    return SECTOR_NOMBRE
+
+async def sector_nombre(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    nombre = norm_sector(update.message.text)
+    if not nombre:
+        await update.message.reply_text("Escribe un nombre, ej. S3.", reply_markup=kb_cancel_only())
+        return SECTOR_NOMBRE
+    context.user_data["sector"] = {"sector": nombre}
+    kb = kb_with_cancel([["Almendro","Olivo","Viña"],["Cítricos","Pistacho","Aguacate"],[COMO_PERFIL]])
+    await update.message.reply_text(f"Cultivo del sector {nombre}:", reply_markup=kb)
+    return SECTOR_CULTIVO
+
+async def sector_cultivo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    txt = update.message.text.strip()
+    context.user_data["sector"]["cultivo"] = None if txt == COMO_PERFIL else txt
+    await update.message.reply_text("Superficie en ha (ej. 2.5) o pulsa Omitir:", reply_markup=kb_with_cancel([["Omitir"]]))
+    return SECTOR_AREA
+
+async def sector_area(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    txt = update.message.text.strip()
+    area = None
+    if txt.lower() != "omitir":
+        try:
+            area = float(txt.replace(",", "."))
+        except:
+            await update.message.reply_text("Número no válido. Escribe 2.5 o pulsa Omitir.", reply_markup=kb_with_cancel([["Omitir"]]))
+            return SECTOR_AREA
+    context.user_data["sector"]["area_ha"] = area
+    await update.message.reply_text("Caudal del sector en m³/h/ha:", reply_markup=kb_with_cancel([[COMO_PERFIL]]))
+    return SECTOR_CAUDAL
+
+async def sector_caudal(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    txt = update.message.text.strip()
+    caudal = None
+    if txt != COMO_PERFIL:
+        try:
+            caudal = float(txt.replace(",", "."))
+        except:
+            await update.message.reply_text("Número no válido. Escribe un valor o pulsa «Como el perfil».",
+                                            reply_markup=kb_with_cancel([[COMO_PERFIL]]))
+            return SECTOR_CAUDAL
+    context.user_data["sector"]["caudal"] = caudal
+    kb = kb_with_cancel([["joven","desarrollo","adulta"],[COMO_PERFIL]])
+    await update.message.reply_text("Tamaño de copa del sector:", reply_markup=kb)
+    return SECTOR_COPA
+
+async def sector_copa(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    txt = update.message.text.strip()
+    context.user_data["sector"]["canopy_class"] = None if txt == COMO_PERFIL else txt.lower()
+    await update.message.reply_text("Marco de plantación en m (ej. 6x4) o pulsa Omitir:", reply_markup=kb_with_cancel([["Omitir"]]))
+    return SECTOR_MARCO
+
+async def sector_marco(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    txt = update.message.text.strip().lower()
+    sx = sy = None
+    if txt != "omitir":
+        try:
+            sx, sy = (float(v.replace(",", ".")) for v in txt.replace("×", "x").replace("*", "x").split("x"))
+        except:
+            await update.message.reply_text("Formato no válido. Escribe 6x4 o pulsa Omitir.", reply_markup=kb_with_cancel([["Omitir"]]))
+            return SECTOR_MARCO
+    d = context.user_data.pop("sector")
+    await run_db(save_sector, update.message.from_user.id, d["sector"], d["cultivo"], d["area_ha"], d["caudal"],
+                 d["canopy_class"], sx, sy, calc_plants_per_ha(sx, sy))
+    await update.message.reply_text(f"✅ Sector {d['sector']} guardado. Míralos en /sectores.", reply_markup=kb_main())
+    return ConversationHandler.END
+
 # =========================
 # RIEGO
 # =========================
@@ -670,43 +1956,58 @@ async def riego_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     txt = (
         "💧 **RIEGO**\n"
         "El agua no perdona errores. Si no sabes lo que  aplicas, ni por qué, el problema no está en el clima.\n"
-        "• /riego – calcular riego (introduces ETo)\n"
+        "• /riego – calcular riego (ETo de tu /estacion o la que introduzcas)\n"
         "• /eto_rapida – atajos ETo por mes (rápido)\n"
         "• /registrar – guardar un riego\n"
         "• /historial – ver últimos riegos\n"
-        "• /mi_agua – objetivo mensual vs consumo"
+        "• /mi_agua – objetivo mensual vs consumo\n"
+        "• /temporada – previsión de agua y coste a 12 meses\n"
+        "• /balance – agua en el suelo y próximo riego por sector\n"
+        "• /riego_todos – riego de hoy para todos tus sectores\n"
+        "• /turnos – turnos de bombeo según el caudal del cabezal"
     )
     kb = kb_with_cancel([
         ["/riego", "/eto_rapida"],
         ["/registrar", "/historial"],
-        ["/mi_agua"]
+        ["/mi_agua", "/temporada"],
+        ["/balance", "/riego_todos"],
+        ["/turnos"]
     ])
     await update.message.reply_text(txt, reply_markup=kb)
 
 async def riego_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Introduce la ETo (mm/día) para hoy o media de la semana (ej. 6.2):",
-                                    reply_markup=kb_cancel_only())
+    filas, aviso = await _eto_opciones(update.message.from_user.id, context)
+    await update.message.reply_text(aviso + "Introduce la ETo (mm/día) para hoy o media de la semana (ej. 6.2):",
+                                    reply_markup=kb_with_cancel(filas) if filas else kb_cancel_only())
     return RIEGO_ETO
 
 async def riego_eto(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        eto = float(update.message.text.replace(",", "."))
-    except:
-        await update.message.reply_text("Valor no válido. Prueba con un número, ej. 5.8", reply_markup=kb_cancel_only())
-        return RIEGO_ETO
+    # Botón de la estación (/estacion) o valor escrito a mano
+    eto = context.user_data.get("eto_opciones", {}).get(update.message.text.strip())
+    if eto is None:
+        try:
+            eto = float(update.message.text.replace(",", "."))
+        except:
+            await update.message.reply_text("Valor no válido. Prueba con un número, ej. 5.8", reply_markup=kb_cancel_only())
+            return RIEGO_ETO
     context.user_data["eto"] = eto
     reply_kb = kb_with_cancel([["sin_estres","leve","moderado"]])
     await update.message.reply_text("Nivel de estrés hídrico (déficit controlado):", reply_markup=reply_kb)
     return RIEGO_STRESS
 
+def stress_factor_de(txt: str, ref: dict | None = None) -> float:
+    adj = (ref or REF)["adj"]
+    stress_map = {"sin_estres":1.0, "leve":adj.get("stress_reduction_mild",0.95),
+                  "moderado":adj.get("stress_reduction_moderate",0.90)}
+    return stress_map.get(txt.strip().lower(), 1.0)
+
 async def riego_calc(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    stress = update.message.text.strip().lower()
-    stress_map = {"sin_estres":1.0, "leve":ADJ.get("stress_reduction_mild",0.95),
-                  "moderado":ADJ.get("stress_reduction_moderate",0.90)}
-    sf = stress_map.get(stress, 1.0)
+    ref = REF   # misma versión de tablas para estrés, copa y Kc
+    sf  = stress_factor_de(update.message.text, ref)
 
     user_id = update.message.from_user.id
-    profile = get_profile(user_id)
+    uctx    = await run_db(get_user_ctx, user_id)
+    profile = uctx["profile"]
     if not profile:
         await update.message.reply_text("Primero configura tu /perfil.", reply_markup=kb_main())
         return ConversationHandler.END
@@ -714,12 +2015,8 @@ async def riego_calc(update: Update, context: ContextTypes.DEFAULT_TYPE):
     eto       = context.user_data["eto"]
     month_num = datetime.now().month
 
-    conn = db()
-    adv  = conn.execute("SELECT canopy_class, spacing_x_m, spacing_y_m, plants_per_ha FROM profiles WHERE user_id=?",
-                        (user_id,)).fetchone()
-    conn.close()
-    canopy, sx, sy, ppha = (adv if adv else (None, None, None, None))
-    f_copa = canopy_factor(canopy)
+    canopy, sx, sy, ppha = uctx["adv"]
+    f_copa = canopy_factor(canopy, ref)
 
     res = calc_riego(
         eto=eto,
@@ -730,8 +2027,11 @@ async def riego_calc(update: Update, context: ContextTypes.DEFAULT_TYPE):
         eficiencia=profile["eficiencia"],
         stress_factor=sf,
         caudal_m3h_ha=profile["caudal_m3h_ha"],
-        f_copa=f_copa
+        f_copa=f_copa,
+        ref=ref
     )
+    # La ETo del día alimenta el balance hídrico por sector (/balance)
+    await run_write(_tx_set_eto, user_id, epoch_day(datetime.now().date()), eto)
 
     msg = (
         f"📍 Cultivo: {profile['cultivo']} | Mes: {month_num}\n"
@@ -751,11 +2051,73 @@ async def riego_calc(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if ppha and ppha > 0:
         l_planta_dia = (res['m3_ha_dia'] * 1000.0) / ppha
         msg += f"🌳 Dosis ~{l_planta_dia:.0f} L/planta/día (con {ppha:.0f} plantas/ha).\n"
-    msg += "💡 Consejo: divide en 1–3 turnos según infiltración y presión."
+    msg += "💡 Consejo: divide en 1–3 turnos según infiltración y presión.\n"
+    msg += f"📚 Tablas de referencia: {res['ref_version']}"
 
     await update.message.reply_text(msg, reply_markup=kb_main())
     return ConversationHandler.END
 
+# /riego_todos: misma ETo y estrés para todos los sectores, en una sola pasada
+async def riego_todos_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    filas, aviso = await _eto_opciones(update.message.from_user.id, context)
+    await update.message.reply_text(aviso + "ETo (mm/día) para todos tus sectores (ej. 6.2):",
+                                    reply_markup=kb_with_cancel(filas) if filas else kb_cancel_only())
+    return RIEGO_ETO
+
+async def riego_todos_calc(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    ref = REF
+    sf  = stress_factor_de(update.message.text, ref)
+    user_id = update.message.from_user.id
+    uctx    = await run_db(get_user_ctx, user_id)
+    profile = uctx["profile"]
+    if not profile:
+        await update.message.reply_text("Primero configura tu /perfil.", reply_markup=kb_main())
+        return ConversationHandler.END
+    secs = await run_db(get_sectors, user_id)
+    if not secs:
+        await update.message.reply_text("Aún no tienes sectores. Créalos con /sector o registrando un riego.",
+                                        reply_markup=kb_main())
+        return ConversationHandler.END
+
+    eto       = context.user_data["eto"]
+    month_num = datetime.now().month
+    efs = [sector_efectivo(profile, uctx["adv"], s) for s in secs]
+    res = calc_riego_batch(
+        eto=eto,
+        cultivo=[e["cultivo"] for e in efs],
+        month_num=month_num,
+        suelo=profile["suelo"],
+        cubierta=profile["cubierta"],
+        eficiencia=profile["eficiencia"],
+        stress_factor=sf,
+        caudal_m3h_ha=[e["caudal_m3h_ha"] for e in efs],
+        f_copa=[canopy_factor(e["canopy_class"], ref) for e in efs],
+        ref=ref,
+    )
+    await run_write(_tx_set_eto, user_id, epoch_day(datetime.now().date()), eto)
+
+    lines = [f"💧 Riego de hoy — {len(efs)} sectores · ETo {eto:.2f} mm/día · estrés {sf:.2f}"]
+    total_m3 = total_ha = 0.0
+    for i, e in enumerate(efs):
+        mm, m3ha, h = res["riego_mm"][i], res["m3_ha_dia"][i], res["horas_dia"][i]
+        linea = f"- {e['sector'] or 's/sector'} ({e['cultivo'] or '—'}): {mm:.1f} mm · {m3ha:.0f} m³/ha"
+        if h is not None and h == h:   # NaN = sin caudal
+            linea += f" · {fmt_horas_min(h)}"
+        if e["area_ha"]:
+            linea += f" · {m3ha * e['area_ha']:.0f} m³"
+            total_m3 += m3ha * e["area_ha"]
+            total_ha += e["area_ha"]
+        lines.append(linea)
+    if total_ha:
+        lines.append(f"Total: {total_m3:.0f} m³/día en {total_ha:.1f} ha")
+    lines.append("ℹ️ Cultivo, caudal y copa de cada sector (/sectores); suelo y eficiencia del /perfil.")
+    lines.append(f"📚 Tablas de referencia: {res['ref_version']}")
+    chunks = split_msg(lines)
+    for chunk in chunks[:-1]:
+        await update.message.reply_text(chunk)
+    await update.message.reply_text(chunks[-1], reply_markup=kb_main())
+    return ConversationHandler.END
+
 # =========================
 # Registro de riego (SIN pedir cultivo)
 # =========================
@@ -769,11 +2131,12 @@ async def reg_sector(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return REG_FECHA
 
 async def reg_fecha(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    txt = update.message.text.strip()
-    if txt.lower() in ("hoy","today"):
-        context.user_data["reg_fecha"] = datetime.now().strftime("%Y-%m-%d")
-    else:
-        context.user_data["reg_fecha"] = txt
+    d = parse_fecha(update.message.text)
+    if d is None:
+        await update.message.reply_text("Fecha no válida. Usa YYYY-MM-DD o DD/MM/YYYY, o pulsa **Hoy**.",
+                                        reply_markup=kb_with_cancel([["Hoy"]]))
+        return REG_FECHA
+    context.user_data["reg_fecha"] = d.isoformat()
     await update.message.reply_text("Horas de riego en formato HH.MM (ej. 2.20, 1.05, 3.00):", reply_markup=kb_cancel_only())
     return REG_HORAS
 
@@ -792,19 +2155,21 @@ async def reg_nota(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if nota.lower() == "omitir":
         nota = ""
     user_id = update.message.from_user.id
-    prof = get_profile(user_id)
+    prof = await run_db(get_profile, user_id)
     cultivo = (prof["cultivo"] if prof else "") or ""
-    add_log(user_id,
+    nuevo = await run_write(_tx_add_log, user_id,
             context.user_data["reg_fecha"],
             cultivo,
             context.user_data["reg_sector"],
             context.user_data["reg_horas"],
             nota)
+    if nuevo:
+        invalidate_user_ctx(user_id)
     await update.message.reply_text("✅ Riego registrado.", reply_markup=kb_main())
     return ConversationHandler.END
 
 async def historial(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    rows = get_logs(update.message.from_user.id, 10)
+    rows = await run_db(get_logs, update.message.from_user.id, 10)
     if not rows:
         await update.message.reply_text("No hay registros aún. Usa /registrar para añadir el primero.", reply_markup=kb_main())
         return
@@ -820,7 +2185,7 @@ async def historial(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def exportar_txt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.message.from_user.id
     # Últimos 10 riegos (puedes cambiar el límite si quieres)
-    rows = get_logs(uid, limit=10)
+    rows = await run_db(get_logs, uid, limit=10)
     if not rows:
         await update.message.reply_text("No hay registros para exportar. Usa /registrar para añadir el primero.", reply_markup=kb_main())
         return
@@ -894,7 +2259,7 @@ async def estado_nota(update: Update, context: ContextTypes.DEFAULT_TYPE):
     filtros  = context.user_data.get("filtros","")
     valvulas = context.user_data.get("valvulas","")
     goteros  = context.user_data.get("goteros","")
-    add_estado(user_id, presion, filtros, valvulas, goteros, nota)
+    await run_write(_tx_add_estado, user_id, presion, filtros, valvulas, goteros, nota)
     await update.message.reply_text("✅ Estado guardado.", reply_markup=kb_main())
     return ConversationHandler.END
 
@@ -919,7 +2284,7 @@ async def mant_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     comentario = update.message.text or ""
     if comentario.lower() == "omitir":
         comentario = ""
-    add_mant(update.message.from_user.id, context.user_data["tarea"], comentario)
+    await run_write(_tx_add_mant, update.message.from_user.id, context.user_data["tarea"], comentario)
     await update.message.reply_text("✅ Mantenimiento registrado.", reply_markup=kb_main())
     return ConversationHandler.END
 
@@ -940,11 +2305,7 @@ async def alerta_sector(update: Update, context: ContextTypes.DEFAULT_TYPE):
     sector = update.message.text or ""
     if sector.lower() == "omitir":
         sector = ""
-    conn = db()
-    conn.execute("INSERT INTO sys_alerta(user_id, fecha, descripcion, sector) VALUES (?,?,?,?)",
-                 (update.message.from_user.id, datetime.now().strftime("%Y-%m-%d"),
-                  context.user_data["alerta_desc"], sector))
-    conn.commit(); conn.close()
+    await run_write(_tx_add_alerta, update.message.from_user.id, context.user_data["alerta_desc"], sector)
     await update.message.reply_text("✅ Alerta registrada.", reply_markup=kb_main())
     return ConversationHandler.END
 
@@ -958,27 +2319,7 @@ def short(s: str | None, n: int) -> str:
 
 async def resumen(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.message.from_user.id
-    conn = db()
-
-    est = conn.execute("""
-        SELECT fecha, presion, filtros, COALESCE(valvulas,''), COALESCE(goteros,''), COALESCE(nota,'')
-          FROM sys_estado
-         WHERE user_id=?
-         ORDER BY id DESC LIMIT 5""",(uid,)).fetchall()
-
-    mant = conn.execute("""
-        SELECT fecha, tarea, COALESCE(comentario,'')
-          FROM sys_mant
-         WHERE user_id=?
-         ORDER BY id DESC LIMIT 5""",(uid,)).fetchall()
-
-    alr = conn.execute("""
-        SELECT fecha, descripcion, COALESCE(sector,''), resuelta
-          FROM sys_alerta
-         WHERE user_id=?
-         ORDER BY id DESC LIMIT 5""",(uid,)).fetchall()
-
-    conn.close()
+    est, mant, alr = await run_db(get_sistema, uid, 5)
 
     lines = ["📊 **RESUMEN DEL SISTEMA (últimas 5 por cada apartado)**"]
 
@@ -1044,10 +2385,7 @@ async def waitlist_pro(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await q.answer()
     uid  = q.from_user.id
     name = q.from_user.first_name or ""
-    conn = db()
-    conn.execute("INSERT OR IGNORE INTO waitlist(user_id, name, date) VALUES (?,?,?)",
-                 (uid, name, datetime.now().strftime("%Y-%m-%d")))
-    conn.commit(); conn.close()
+    await run_db(add_waitlist, uid, name)
     await q.edit_message_text("✅ Te aviso al lanzar Pro. ¡Gracias! 🌱")
 
 async def proposito(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1061,8 +2399,9 @@ async def proposito(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # =========================
 async def mi_agua(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid  = update.message.from_user.id
-    s    = get_settings(uid)
-    prof = get_profile(uid)
+    uctx = await run_db(get_user_ctx, uid)
+    s    = uctx["settings"]
+    prof = uctx["profile"]
 
     if not prof or (prof.get("caudal_m3h_ha") or 0) <= 0:
         await update.message.reply_text("Falta el caudal del sistema en tu perfil. Ve a /perfil (m³/h/ha).", reply_markup=kb_main())
@@ -1071,17 +2410,13 @@ async def mi_agua(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Vamos a configurarlo primero en /ajustes_agua.", reply_markup=kb_main())
         return
 
-    hoy = datetime.now(); y, m = hoy.year, hoy.month
-    ini = f"{y}-{m:02d}-01"
-    fin = f"{y}-{m:02d}-{monthrange(y,m)[1]:02d}"
-
-    conn = db()
-    rows = conn.execute("SELECT horas FROM logs WHERE user_id=? AND fecha>=? AND fecha<=?",
-                        (uid, ini, fin)).fetchall()
-    conn.close()
+    hoy = datetime.now().date()
+    mes, mes_ant = mes_key(hoy), mes_key(hoy) - 100
+    agua = await run_db(agua_meses, uid, mes, mes_ant)
+    caudal = float(prof["caudal_m3h_ha"] or 0.0)
 
-    horas_tot = sum((r[0] or 0) for r in rows) if rows else 0.0
-    m3ha      = horas_tot * float(prof["caudal_m3h_ha"] or 0.0)
+    horas_tot = sum(agua[mes].values())
+    m3ha      = horas_tot * caudal
     obj       = float(s["objetivo"])
     pct       = (m3ha/obj*100) if obj>0 else 0
 
@@ -1098,6 +2433,14 @@ async def mi_agua(update: Update, context: ContextTypes.DEFAULT_TYPE):
         coste = m3ha * float(s["precio"])
         txt  += f"- Coste estimado: ~{coste:.0f} € (a {float(s['precio']):.3f} €/m³)\n"
 
+    if len(agua[mes]) > 1:
+        txt += "— Por sector:\n"
+        for sector, h in sorted(agua[mes].items()):
+            txt += f"  · {sector or 's/sector'}: {h*caudal:.0f} m³/ha ({fmt_horas_min(h)})\n"
+    if agua[mes_ant]:
+        m3ha_ant = sum(agua[mes_ant].values()) * caudal
+        txt += f"- Mismo mes del año pasado: {m3ha_ant:.0f} m³/ha\n"
+
     await update.message.reply_text(txt, reply_markup=kb_main())
 
 # /ajustes_agua: objetivo -> precio
@@ -1111,7 +2454,7 @@ async def ajustes_agua_obj(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except:
         await update.message.reply_text("Número inválido. Escribe solo el objetivo en m³/ha (ej: 1200).", reply_markup=kb_cancel_only())
         return AJUAGUA_OBJ
-    save_settings(update.message.from_user.id, objetivo=objetivo)
+    await run_db(save_settings, update.message.from_user.id, objetivo=objetivo)
     await update.message.reply_text("Precio del agua en €/m³. Ej: 0.12", reply_markup=kb_cancel_only())
     return AJUAGUA_PRECIO
 
@@ -1121,31 +2464,1384 @@ async def ajustes_agua_precio(update: Update, context: ContextTypes.DEFAULT_TYPE
     except:
         await update.message.reply_text("Número inválido. Escribe el precio en €/m³ (ej: 0.12).", reply_markup=kb_cancel_only())
         return AJUAGUA_PRECIO
-    save_settings(update.message.from_user.id, precio=precio)
+    await run_db(save_settings, update.message.from_user.id, precio=precio)
     await update.message.reply_text("✅ Ajustes guardados. Ya puedes ver /mi_agua.", reply_markup=kb_main())
     return ConversationHandler.END
 
+# =========================
+# TEMPORADA (previsión 12 meses)
+# =========================
+# La proyección solo depende del perfil, del precio, de las tablas de referencia
+# y del día de inicio: se calcula una vez por huella y la comparten todos los
+# usuarios con el mismo perfil.
+MESES_CORTOS = ["Ene","Feb","Mar","Abr","May","Jun","Jul","Ago","Sep","Oct","Nov","Dic"]
+
+_proj_cache = OrderedDict()   # huella -> proyección
+_proj_lock  = threading.Lock()
+
+def proyeccion_huella(uctx:dict, inicio:date, ref:dict) -> tuple:
+    p  = uctx["profile"]
+    s  = uctx["settings"]
+    return (norm_crop(p["cultivo"]), (p["suelo"] or "").lower(), (p["cubierta"] or "").lower(),
+            float(p["eficiencia"] or 0), float(p["caudal_m3h_ha"] or 0),
+            canopy_factor(uctx["adv"][0], ref), float(s["precio"] or 0), inicio.isoformat(), ref["version"])
+
+def _calc_proyeccion(huella:tuple, ref:dict) -> dict:
+    cultivo, suelo, cubierta, eficiencia, caudal, f_copa, precio, inicio, version = huella
+    d0 = date.fromisoformat(inicio)
+    dias, meses = [], {}
+    for i in range(365):
+        d   = d0 + timedelta(days=i)
+        eto = ETO_MESES[d.month][1]
+        r   = calc_riego(eto, cultivo, d.month, suelo, cubierta, eficiencia,
+                         caudal_m3h_ha=caudal, f_copa=f_copa, dia=d, ref=ref)
+        horas = r["horas_dia"] or 0.0
+        coste = r["m3_ha_dia"] * precio
+        dias.append((d, eto, r["kc"], r["riego_mm"], r["m3_ha_dia"], horas, coste))
+        acc = meses.setdefault((d.year, d.month), [0.0, 0.0, 0.0])
+        acc[0] += r["m3_ha_dia"]; acc[1] += horas; acc[2] += coste
+    return {"dias": dias, "meses": meses, "ref_version": version,
+            "total": tuple(sum(v[i] for v in meses.values()) for i in range(3))}
+
+def get_proyeccion(uctx:dict, inicio:date) -> dict:
+    ref    = REF   # una sola versión de tablas para huella y cálculo
+    huella = proyeccion_huella(uctx, inicio, ref)
+    with _proj_lock:
+        hit = _proj_cache.get(huella)
+        if hit is not None:
+            _proj_cache.move_to_end(huella)
+            return hit
+    proj = _calc_proyeccion(huella, ref)
+    with _proj_lock:
+        _proj_cache[huella] = proj
+        while len(_proj_cache) > PROJ_CACHE_SIZE:
+            _proj_cache.popitem(last=False)
+    return proj
+
+async def temporada(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid  = update.message.from_user.id
+    uctx = await run_db(get_user_ctx, uid)
+    prof = uctx["profile"]
+    if not prof or not prof["cultivo"]:
+        await update.message.reply_text("Primero configura tu /perfil.", reply_markup=kb_main())
+        return
+    hoy  = datetime.now().date()
+    proj = await run_db(get_proyeccion, uctx, hoy)
+    precio = uctx["settings"]["precio"]
+    con_horas = (prof["caudal_m3h_ha"] or 0) > 0
+
+    lines = [f"📅 Previsión 12 meses — {prof['cultivo']} (por ha, ETo media mensual)"]
+    for (y, mo), (m3, horas, coste) in proj["meses"].items():
+        linea = f"- {MESES_CORTOS[mo-1]} {y}: {m3:.0f} m³/ha"
+        if con_horas: linea += f" · {fmt_horas_min(horas)}"
+        if precio:    linea += f" · {coste:.0f} €"
+        lines.append(linea)
+    m3, horas, coste = proj["total"]
+    total = f"Total: {m3:.0f} m³/ha"
+    if con_horas: total += f" · {horas:.0f} h"
+    if precio:    total += f" · {coste:.0f} €/ha"
+    lines.append(total)
+    if not con_horas:
+        lines.append("ℹ️ Añade el caudal en /perfil para ver horas.")
+    if not precio:
+        lines.append("ℹ️ Añade el precio del agua en /ajustes_agua para ver el coste.")
+    await update.message.reply_text("\n".join(lines), reply_markup=kb_main())
+
+    out = io.StringIO()
+    w = csv.writer(out)
+    w.writerow(["fecha", "eto_mm", "kc", "riego_mm", "m3_ha", "horas", "coste_eur_ha"])
+    for d, eto, kc, mm, m3d, h, c in proj["dias"]:
+        w.writerow([d.isoformat(), f"{eto:.2f}", f"{kc:.3f}", f"{mm:.2f}", f"{m3d:.1f}", f"{h:.2f}", f"{c:.2f}"])
+    buf = io.BytesIO(out.getvalue().encode("utf-8"))
+    buf.name = f"agriwise_temporada_{hoy.strftime('%Y%m%d')}.csv"
+    await update.message.reply_document(document=buf, caption=f"📄 Detalle diario de la previsión (CSV) · tablas {proj['ref_version']}")
+
+# =========================
+# BALANCE HÍDRICO POR SECTOR (FAO-56)
+# =========================
+# Agotamiento de la zona radicular Dr (mm): 0 = capacidad de campo, TAW = punto
+# de marchitez. Cada día suma la ETc de calc_riego (con la ETo que dio el usuario
+# ese día o, si no, la media mensual) y resta el riego neto de los registros
+# (horas × caudal / 10 × eficiencia). Toca regar cuando Dr supera RAW = p·TAW.
+#
+# balance_sector guarda por sector (dia, dr_ini, riego_mm): un riego nuevo solo
+# avanza ese estado con acumulados anuales de ETc, sin releer el historial.
+# _tx_rebuild_balance() rehace el estado desde logs con los mismos pasos; se usa
+# con riegos atrasados, sectores nuevos o si cambian perfil o tablas (huella).
+SUELO_AGUA_MM_M = {"arenoso": 80.0, "franco": 130.0, "arcilloso": 160.0}   # θFC−θWP (FAO-56, tabla 19)
+SUELO_AGUA_DEFAULT = 130.0
+RAIZ_CULTIVO = {   # Zr (m), fracción p (FAO-56, tabla 22)
+    "almendro": (1.5, 0.40), "olivo": (1.4, 0.65), "vina": (1.5, 0.45),
+    "citricos": (1.3, 0.50), "pistacho": (1.2, 0.40), "aguacate": (0.8, 0.70),
+}
+RAIZ_DEFAULT = (1.0, 0.50)
+BALANCE_HORIZONTE = 365   # días máximos para buscar el próximo riego
+
+SQL_BALANCE_UPSERT = """
+    INSERT INTO balance_sector(user_id, sector, dia, dr_ini, riego_mm, huella)
+    VALUES (?,?,?,?,?,?)
+    ON CONFLICT(user_id, sector) DO UPDATE SET
+      dia=excluded.dia, dr_ini=excluded.dr_ini,
+      riego_mm=excluded.riego_mm, huella=excluded.huella"""
+
+def balance_params(cultivo, suelo, cubierta, eficiencia, caudal, canopy_class,
+                   ref: dict | None = None) -> tuple | None:
+    # Sin caudal no se sabe cuánta agua aporta cada hora registrada
+    ref = ref or REF
+    caudal = float(caudal or 0)
+    if caudal <= 0:
+        return None
+    ef = float(eficiencia or 0)
+    if ef <= 0 or ef > 1.0:
+        ef = ref["eff_default"]
+    return (norm_crop(cultivo), (suelo or "").lower(), (cubierta or "no").lower(),
+            ef, caudal, canopy_factor(canopy_class, ref), ref["version"])
+
+def balance_huella(params: tuple) -> str:
+    return hashlib.sha1(repr(params).encode("utf-8")).hexdigest()[:10]
+
+def balance_taw(params: tuple) -> tuple[float, float]:
+    # (TAW, RAW) en mm
+    zr, p = RAIZ_CULTIVO.get(params[0], RAIZ_DEFAULT)
+    taw = SUELO_AGUA_MM_M.get(params[1], SUELO_AGUA_DEFAULT) * zr
+    return taw, p * taw
+
+def riego_neto_mm(params: tuple, horas: float) -> float:
+    # 1 mm = 10 m³/ha; solo la fracción útil (eficiencia) llega a la raíz
+    return horas * params[4] / 10.0 * params[3]
+
+def etc_dia(params: tuple, dia: int, eto: float | None = None) -> float:
+    d = from_epoch_day(dia)
+    if eto is None:
+        eto = ETO_MESES[d.month][1]
+    return calc_riego(eto, params[0], d.month, params[1], params[2], params[3],
+                      f_copa=params[5], dia=d)["etc_adj"]
+
+_etc_cache = OrderedDict()   # (params, año) -> ETc climatológica acumulada día a día
+_etc_lock  = threading.Lock()
+
+def _etc_acum(params: tuple, year: int) -> list[float]:
+    key = (params, year)
+    with _etc_lock:
+        acc = _etc_cache.get(key)
+        if acc is not None:
+            _etc_cache.move_to_end(key)
+            return acc
+    acc = [0.0]
+    for j in range(epoch_day(date(year, 1, 1)), epoch_day(date(year + 1, 1, 1))):
+        acc.append(acc[-1] + etc_dia(params, j))
+    with _etc_lock:
+        _etc_cache[key] = acc
+        while len(_etc_cache) > PROJ_CACHE_SIZE:
+            _etc_cache.popitem(last=False)
+    return acc
+
+def etc_rango(params: tuple, a: int, b: int) -> float:
+    # ETc climatológica de los días a ≤ j < b en O(1)
+    if b <= a:
+        return 0.0
+    da, db = from_epoch_day(a), from_epoch_day(b)
+    ia, ib = da.timetuple().tm_yday - 1, db.timetuple().tm_yday - 1
+    acc = _etc_acum(params, da.year)
+    if da.year == db.year:
+        return acc[ib] - acc[ia]
+    total = acc[-1] - acc[ia]
+    for y in range(da.year + 1, db.year):
+        total += _etc_acum(params, y)[-1]
+    return total + _etc_acum(params, db.year)[ib]
+
+def balance_cierre(params: tuple, taw: float, estado: tuple, etos: dict) -> float:
+    # Dr al final del día del estado
+    dia, dr_ini, riego = estado
+    return min(taw, max(0.0, dr_ini + etc_dia(params, dia, etos.get(dia)) - riego))
+
+def balance_avanza(params: tuple, taw: float, estado: tuple, hasta: int, etos: dict) -> tuple:
+    # Sin riegos entre medias Dr solo crece: basta sumar la ETc y topar una vez en TAW
+    dia = estado[0]
+    dr = balance_cierre(params, taw, estado, etos) + etc_rango(params, dia + 1, hasta)
+    for j, eto in etos.items():
+        if dia < j < hasta:
+            dr += etc_dia(params, j, eto) - etc_dia(params, j)
+    return (hasta, min(taw, dr), 0.0)
+
+def balance_riego(params: tuple, taw: float, estado: tuple | None, dia: int, mm: float, etos: dict) -> tuple | None:
+    # Aplica un riego; None si es anterior al estado (hay que reconstruir)
+    if estado is None:
+        return (dia, 0.0, mm)   # primer riego del sector: se parte de capacidad de campo
+    if dia < estado[0]:
+        return None
+    if dia > estado[0]:
+        estado = balance_avanza(params, taw, estado, dia, etos)
+    return (dia, estado[1], estado[2] + mm)
+
+def balance_proximo_riego(params: tuple, raw: float, dia: int, dr: float) -> int | None:
+    # Primer día en que Dr alcanza RAW con ETc climatológica (búsqueda binaria)
+    if dr >= raw:
+        return dia
+    if dr + etc_rango(params, dia + 1, dia + 1 + BALANCE_HORIZONTE) < raw:
+        return None
+    lo, hi = 1, BALANCE_HORIZONTE
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if dr + etc_rango(params, dia + 1, dia + 1 + mid) >= raw:
+            hi = mid
+        else:
+            lo = mid + 1
+    return dia + lo
+
+def _balance_params_de(e: dict, ref: dict | None = None) -> tuple | None:
+    return balance_params(e["cultivo"], e["suelo"], e["cubierta"], e["eficiencia"],
+                          e["caudal_m3h_ha"], e["canopy_class"], ref)
+
+def _tx_balance_params(conn, uid: int, sector: str | None = None) -> tuple[tuple | None, dict]:
+    # (parámetros del perfil, {sector: parámetros}); sector=None carga todos.
+    # Una sola instantánea de tablas para todos los sectores: una recarga a
+    # mitad no deja huellas de versiones distintas en la misma pasada
+    ref = REF
+    profile, adv = _profile_from_row(conn.execute(SQL_PERFIL, (uid,)).fetchone())
+    if profile is None:
+        return None, {}
+    if sector is None:
+        rows = conn.execute(SQL_SECTORES_USUARIO, (uid,)).fetchall()
+    else:
+        rows = conn.execute(SQL_SECTOR_UNO, (uid, sector)).fetchall()
+    base = _balance_params_de(sector_efectivo(profile, adv, None), ref)
+    return base, {r[0]: _balance_params_de(sector_efectivo(profile, adv, _sector_from_row(r)), ref) for r in rows}
+
+def _tx_rebuild_balance(conn, uid: int, sectores: set | None = None):
+    # sectores=None: todos los del usuario
+    if sectores is None:
+        conn.execute("DELETE FROM balance_sector WHERE user_id=?", (uid,))
+    else:
+        conn.executemany("DELETE FROM balance_sector WHERE user_id=? AND sector=?", [(uid, s) for s in sectores])
+    base, por_sector = _tx_balance_params(conn, uid)
+    etos = dict(conn.execute(SQL_ETO_DESDE, (uid, 0)).fetchall())
+    params, taws, estados = {}, {}, {}
+    for sector, dia, horas in conn.execute("""
+            SELECT sector, fecha_dia, horas FROM logs
+             WHERE user_id=? AND fecha_dia IS NOT NULL ORDER BY fecha_dia""", (uid,)):
+        s = norm_sector(sector)
+        if sectores is not None and s not in sectores:
+            continue
+        if s not in params:
+            params[s] = por_sector.get(s, base)
+            if params[s] is not None:
+                taws[s] = balance_taw(params[s])[0]
+        p = params[s]
+        if p is None:
+            continue
+        estados[s] = balance_riego(p, taws[s], estados.get(s), dia, riego_neto_mm(p, horas or 0.0), etos)
+    conn.executemany(SQL_BALANCE_UPSERT,
+                     [(uid, s, *e, balance_huella(params[s])) for s, e in estados.items()])
+
+def _tx_balance_riego(conn, uid: int, sector: str, dia: int, horas: float):
+    sector = norm_sector(sector)
+    base, por_sector = _tx_balance_params(conn, uid, sector)
+    params = por_sector.get(sector, base)
+    if params is None:
+        return
+    row = conn.execute("SELECT dia, dr_ini, riego_mm, huella FROM balance_sector WHERE user_id=? AND sector=?",
+                       (uid, sector)).fetchone()
+    huella = balance_huella(params)
+    estado = None
+    if row is not None and row[3] == huella:
+        taw, _ = balance_taw(params)
+        etos = dict(conn.execute(SQL_ETO_DESDE, (uid, row[0])).fetchall())
+        estado = balance_riego(params, taw, row[:3], dia, riego_neto_mm(params, horas), etos)
+    if estado is None:
+        # Sector nuevo, riego atrasado o sector/perfil/tablas cambiados: se rehace desde logs
+        _tx_rebuild_balance(conn, uid, {sector})
+        return
+    conn.execute(SQL_BALANCE_UPSERT, (uid, sector, *estado, huella))
+
+def _tx_set_eto(conn, uid: int, dia: int, eto: float):
+    conn.execute("""
+        INSERT INTO eto_usuario(user_id, dia, eto) VALUES (?,?,?)
+        ON CONFLICT(user_id, dia) DO UPDATE SET eto=excluded.eto""", (uid, dia, eto))
+    # Los estados ya avanzados más allá de ese día la contaron con otra ETo
+    pasados = {r[0] for r in conn.execute("SELECT sector FROM balance_sector WHERE user_id=? AND dia>?", (uid, dia))}
+    if pasados:
+        _tx_rebuild_balance(conn, uid, pasados)
+
+def rebuild_balance(user_id: int | None = None):
+    with db_write() as conn:
+        if user_id is None:
+            conn.execute("DELETE FROM balance_sector")
+            uids = [r[0] for r in conn.execute("SELECT user_id FROM profiles").fetchall()]
+        else:
+            uids = [user_id]
+        for uid in uids:
+            _tx_rebuild_balance(conn, uid)
+
+def get_balance(uid: int, hoy: date) -> list[dict] | None:
+    with db_read() as conn:
+        base, por_sector = _tx_balance_params(conn, uid)
+        if base is None and not any(por_sector.values()):
+            return None
+        rows = conn.execute(SQL_BALANCE_USUARIO, (uid,)).fetchall()
+        if not rows and conn.execute(SQL_LOGS_HAY, (uid,)).fetchone() is not None:
+            stale = None    # nunca calculado: todo el usuario
+        else:
+            stale = set()
+            for sector, *_, huella in rows:
+                p = por_sector.get(sector, base)
+                if p is None or huella != balance_huella(p):
+                    stale.add(sector)
+    if stale is None or stale:
+        # Solo se rehacen los sectores cuyo perfil/tablas han cambiado
+        write_behind(_tx_rebuild_balance, uid, stale).result()
+    with db_read() as conn:
+        if stale is None or stale:
+            rows = conn.execute(SQL_BALANCE_USUARIO, (uid,)).fetchall()
+        desde = min((r[1] for r in rows), default=epoch_day(hoy))
+        etos = dict(conn.execute(SQL_ETO_DESDE, (uid, desde)).fetchall())
+
+    hoy_n = epoch_day(hoy)
+    out = []
+    for sector, dia, dr_ini, riego, _ in sorted(rows):
+        params = por_sector.get(sector, base)
+        taw, raw = balance_taw(params)
+        estado = (dia, dr_ini, riego)
+        if hoy_n > dia:
+            estado = balance_avanza(params, taw, estado, hoy_n, etos)
+        dr = balance_cierre(params, taw, estado, etos)
+        prox = balance_proximo_riego(params, raw, estado[0], dr)
+        out.append({"sector": sector, "cultivo": params[0], "dr": dr, "taw": taw, "raw": raw,
+                    "eficiencia": params[3], "caudal": params[4],
+                    "ultimo_riego": from_epoch_day(dia),
+                    "proximo_riego": from_epoch_day(prox) if prox is not None else None})
+    return out
+
+async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.message.from_user.id
+    hoy = datetime.now().date()
+    bal = await run_db(get_balance, uid, hoy)
+    if bal is None:
+        await update.message.reply_text("Completa tu /perfil (cultivo, suelo y caudal) para calcular el balance.",
+                                        reply_markup=kb_main())
+        return
+    if not bal:
+        await update.message.reply_text("Aún no hay riegos registrados. Usa /registrar.", reply_markup=kb_main())
+        return
+
+    lines = ["🌱 *Balance hídrico por sector* (FAO-56, cierre de hoy)"]
+    for s in bal:
+        dr, taw, raw = s["dr"], s["taw"], s["raw"]
+        sem = "🟢" if dr < raw * 0.5 else ("🟡" if dr < raw else "🟥")
+        lines.append(f"- {s['sector'] or 's/sector'}: agotamiento {dr:.0f}/{taw:.0f} mm ({dr/taw*100:.0f}%) {sem}"
+                     f" · umbral {raw:.0f} mm")
+        prox = s["proximo_riego"]
+        if prox is None:
+            lines.append("  · Próximo riego: no previsto en 12 meses")
+        elif prox <= hoy:
+            lines.append("  · Próximo riego: hoy")
+        else:
+            lines.append(f"  · Próximo riego: ~{prox.isoformat()} ({(prox - hoy).days} días)")
+        if dr > 0:
+            horas = dr / s["eficiencia"] * 10.0 / s["caudal"]
+            lines.append(f"  · Reponer a capacidad de campo: {fmt_horas_min(horas)}")
+        lines.append(f"  · Último riego: {s['ultimo_riego'].isoformat()}")
+    lines.append("ℹ️ Sin lluvia; usa la ETo que introduces en /riego o la media del mes.")
+    chunks = split_msg(lines)
+    for chunk in chunks[:-1]:
+        await update.message.reply_text(chunk)
+    await update.message.reply_text(chunks[-1], reply_markup=kb_main())
+
+# =========================
+# TURNOS (bombeo con caudal máximo del cabezal)
+# =========================
+# Un turno = sectores que riegan a la vez: su caudal sumado no puede pasar del
+# máximo del cabezal y dura lo que su sector más largo. El bombeo total es la
+# suma de los turnos, así que los sectores van de más a menos horas y cada uno
+# entra en el turno abierto donde menos caudal sobra (best fit decreasing); solo
+# se abre turno nuevo si no cabe en ninguno. Después los turnos, de mayor a
+# menor, ocupan la primera franja de tarifa valle con hueco; los que no caben
+# van a continuación de la última franja.
+TURNOS_INICIO_SIN_TARIFA = 0.0   # hora de arranque si no hay franjas valle
+
+def _hora_dec(t: str) -> float:
+    hh, _, mm = t.strip().partition(":")
+    h = int(hh) + int(mm or 0) / 60.0
+    if not 0 <= h <= 24:
+        raise ValueError(t)
+    return h
+
+def parse_ventanas(txt: str) -> list[tuple[float, float]] | None:
+    # "00:00-08:00" o "22-06, 14:00-16:00" -> [(0.0, 8.0), (14.0, 16.0), (22.0, 30.0)]
+    out = []
+    for parte in (txt or "").replace(";", ",").split(","):
+        if not parte.strip():
+            continue
+        try:
+            a, b = parte.split("-")
+            ha, hb = _hora_dec(a), _hora_dec(b)
+        except ValueError:
+            return None
+        out.append((ha, hb if hb > ha else hb + 24.0))
+    return _fusionar_ventanas(out)
+
+def _fusionar_ventanas(vs) -> list[tuple[float, float]]:
+    # Une franjas solapadas o repetidas ("00-08, 04-10" -> 00–10), también a
+    # través de medianoche; si no, plan_turnos contaría dos veces esas horas
+    out = []
+    for a, b in sorted((a % 24, a % 24 + (b - a)) for a, b in vs):
+        if out and a <= out[-1][1]:
+            out[-1][1] = max(out[-1][1], b)
+        else:
+            out.append([a, b])
+    while len(out) > 1 and out[0][0] + 24 <= out[-1][1]:
+        a, b = out.pop(0)
+        out[-1][1] = max(out[-1][1], b + 24)
+    if len(out) == 1:
+        out[0][1] = min(out[0][1], out[0][0] + 24)
+    return [(a, b) for a, b in out]
+
+def fmt_hora(h: float) -> str:
+    total_min = int(round(h * 60))
+    return f"{(total_min // 60) % 24:02d}:{total_min % 60:02d}"
+
+def _anclar_ventanas(ventanas) -> list[tuple[float, float]]:
+    # Franjas en un único ciclo de 24 h que empieza tras el mayor hueco sin franja
+    # (p. ej. 00–02 y 22–23 → 22–23, 24–26): así los turnos nunca se solapan
+    vs = sorted((a % 24, a % 24 + (b - a)) for a, b in ventanas)
+    if not vs:
+        return []
+    _, k = max((vs[i][0] - (vs[i - 1][1] if i else vs[-1][1] - 24), i) for i in range(len(vs)))
+    ancla = vs[k][0]
+    return sorted((a + (24 if a < ancla else 0), b + (24 if a < ancla else 0)) for a, b in vs)
+
+def plan_turnos(sectores, caudal_max: float, ventanas=()) -> dict:
+    # sectores: [(nombre, caudal m³/h, horas)]; ventanas: [(inicio, fin)] en horas
+    items = sorted((s for s in sectores if s[2] > 0), key=lambda s: (-s[2], -s[1]))
+    turnos, libres, excedidos = [], [], []   # libres: [(caudal libre, turno)] ordenada
+    for nombre, q, h in items:
+        if q > caudal_max:
+            excedidos.append(nombre)
+            turnos.append([h, q, [nombre]])
+            continue
+        i = bisect.bisect_left(libres, (q - 1e-9, -1))
+        if i == len(libres):
+            turnos.append([h, q, [nombre]])
+            bisect.insort(libres, (caudal_max - q, len(turnos) - 1))
+        else:
+            libre, k = libres.pop(i)
+            turnos[k][1] += q
+            turnos[k][2].append(nombre)
+            bisect.insort(libres, (libre - q, k))
+
+    ventanas = _anclar_ventanas(ventanas)
+    huecos = [[a, b] for a, b in ventanas]
+    inicio = ventanas[0][0] if ventanas else TURNOS_INICIO_SIN_TARIFA
+    cursor = ventanas[-1][1] if ventanas else inicio
+    plan, fuera = [], 0.0
+    for h, q, nombres in turnos:   # ya van de mayor a menor duración
+        hueco = next((w for w in huecos if w[1] - w[0] >= h - 1e-9), None)
+        if hueco is not None:
+            ini, hueco[0] = hueco[0], hueco[0] + h
+        else:
+            ini, cursor = cursor, cursor + h
+            fuera += h
+        plan.append({"inicio": ini, "fin": ini + h, "horas": h, "caudal": q,
+                     "sectores": nombres, "valle": hueco is not None})
+    plan.sort(key=lambda t: t["inicio"])
+
+    total = sum(t["horas"] for t in plan)
+    # Cota inferior: el sector más largo o el volumen total al caudal máximo
+    cota = max((h for _, _, h in items), default=0.0)
+    if caudal_max > 0:
+        cota = max(cota, sum(min(q, caudal_max) * h for _, q, h in items) / caudal_max)
+    return {"turnos": plan, "horas_bombeo": total, "cota_inferior": cota, "fuera_valle": fuera,
+            "excedidos": excedidos,
+            "duracion": max((t["fin"] for t in plan), default=inicio) - inicio}
+
+def bench_turnos(n:int=250, granjas:int=20, seed:int=1) -> dict:
+    # Fincas sintéticas: caudal 20–45 m³/h/ha × 0,5–5 ha, 0,3–4 h/día, valle 00–08
+    rnd = random.Random(seed)
+    tiempos, ratios = [], []
+    for _ in range(granjas):
+        secs = [(f"S{i}", rnd.uniform(20, 45) * rnd.uniform(0.5, 5.0), rnd.uniform(0.3, 4.0)) for i in range(n)]
+        cap = rnd.uniform(200, 800)
+        t0 = time.perf_counter()
+        plan = plan_turnos(secs, cap, [(0.0, 8.0)])
+        tiempos.append(time.perf_counter() - t0)
+        ratios.append(plan["horas_bombeo"] / plan["cota_inferior"])
+    return {"n": n, "granjas": granjas, "t_medio": sum(tiempos) / granjas, "t_max": max(tiempos),
+            "ratio_medio": sum(ratios) / granjas, "ratio_max": max(ratios)}
+
+def get_etos(uid: int, desde: int) -> dict[int, float]:
+    with db_read() as conn:
+        return dict(conn.execute(SQL_ETO_DESDE, (uid, desde)).fetchall())
+
+async def _turnos_responder(update: Update, uid: int):
+    ref = REF               # misma instantánea de tablas para todo el plan
+    uctx = await run_db(get_user_ctx, uid)
+    profile, s = uctx["profile"], uctx["settings"]
+    if not profile:
+        await update.message.reply_text("Primero configura tu /perfil.", reply_markup=kb_main())
+        return
+    secs = await run_db(get_sectors, uid)
+    if not secs:
+        await update.message.reply_text("Aún no tienes sectores. Créalos con /sector.", reply_markup=kb_main())
+        return
+    hoy = datetime.now().date()
+    eto = (await run_db(get_etos, uid, epoch_day(hoy))).get(epoch_day(hoy))
+    fuente = "tu ETo de hoy" if eto is not None else "media del mes"
+    if eto is None:
+        eto = ETO_MESES[hoy.month][1]
+
+    efs = [sector_efectivo(profile, uctx["adv"], sec) for sec in secs]
+    res = calc_riego_batch(eto, [e["cultivo"] for e in efs], hoy.month, profile["suelo"], profile["cubierta"],
+                           profile["eficiencia"], caudal_m3h_ha=[e["caudal_m3h_ha"] for e in efs],
+                           f_copa=[canopy_factor(e["canopy_class"], ref) for e in efs], ref=ref)
+    items, sin_datos = [], []
+    for i, e in enumerate(efs):
+        h = res["horas_dia"][i]
+        if not e["area_ha"] or h is None or h != h:
+            sin_datos.append(e["sector"])
+            continue
+        items.append((e["sector"], e["caudal_m3h_ha"] * e["area_ha"], float(h)))
+    cap = float(s["caudal_max"])
+    ventanas = parse_ventanas(s["tarifa_valle"] or "") or []
+    plan = plan_turnos(items, cap, ventanas)
+
+    lines = [f"⏱️ *Turnos de hoy* — {len(items)} sectores en {len(plan['turnos'])} turnos · cabezal {cap:g} m³/h",
+             f"ETo {eto:.1f} mm/día ({fuente})"]
+    for k, t in enumerate(plan["turnos"], 1):
+        marca = "🌙" if t["valle"] else "☀️"
+        lines.append(f"T{k} {fmt_hora(t['inicio'])}–{fmt_hora(t['fin'])} {marca if ventanas else ''}"
+                     f" · {t['caudal']:.0f} m³/h · {', '.join(t['sectores'])}")
+    lines.append(f"Bombeo total: {fmt_horas_min(plan['horas_bombeo'])} "
+                 f"(mínimo teórico {fmt_horas_min(plan['cota_inferior'])})")
+    if ventanas:
+        lines.append(f"Fuera de tarifa valle: {fmt_horas_min(plan['fuera_valle'])}")
+    if plan["duracion"] > 24:
+        lines.append("⚠️ El plan no cabe en 24 h: sube el caudal del cabezal o reparte sectores en días.")
+    if plan["excedidos"]:
+        lines.append("⚠️ Superan el caudal del cabezal y riegan solos: " + ", ".join(plan["excedidos"]))
+    if sin_datos:
+        lines.append("ℹ️ Sin superficie o caudal (complétalos en /sector): " + ", ".join(sin_datos))
+    chunks = split_msg(lines)
+    for chunk in chunks[:-1]:
+        await update.message.reply_text(chunk)
+    await update.message.reply_text(chunks[-1], reply_markup=kb_main())
+
+async def turnos(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.message.from_user.id
+    s = await run_db(get_settings, uid)
+    if s.get("caudal_max"):
+        await _turnos_responder(update, uid)
+        return ConversationHandler.END
+    return await ajustes_turnos(update, context)
+
+async def ajustes_turnos(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("Caudal máximo del cabezal/bomba en m³/h (ej. 120):", reply_markup=kb_cancel_only())
+    return TURNOS_CAUDAL
+
+async def turnos_caudal(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        cap = float(update.message.text.replace(",", "."))
+        if cap <= 0:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("Número no válido. Escribe el caudal en m³/h (ej. 120).", reply_markup=kb_cancel_only())
+        return TURNOS_CAUDAL
+    await run_db(save_settings, update.message.from_user.id, caudal_max=cap)
+    await update.message.reply_text("Franjas de tarifa valle (ej. 00:00-08:00 o 22-06, 14-16) o pulsa «Sin tarifa»:",
+                                    reply_markup=kb_with_cancel([["00:00-08:00", "Sin tarifa"]]))
+    return TURNOS_VALLE
+
+async def turnos_valle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    txt = update.message.text.strip()
+    if txt.lower() == "sin tarifa":
+        txt = ""
+    elif not parse_ventanas(txt):
+        await update.message.reply_text("Formato no válido. Usa HH:MM-HH:MM separadas por comas, o «Sin tarifa».",
+                                        reply_markup=kb_with_cancel([["00:00-08:00", "Sin tarifa"]]))
+        return TURNOS_VALLE
+    uid = update.message.from_user.id
+    await run_db(save_settings, uid, tarifa_valle=txt)
+    await _turnos_responder(update, uid)
+    return ConversationHandler.END
+
+# =========================
+# ETo POR ESTACIÓN (series diarias importadas)
+# =========================
+# Exportaciones CSV de estaciones meteorológicas: una fila por día con fecha y
+# ETo y, opcionalmente, el código de estación (si no viene, se usa --estacion o
+# el nombre del fichero). Se leen en streaming y se escriben por lotes con
+# executemany; el UPSERT permite reimportar un fichero para corregir valores.
+# Con una estación vinculada (/estacion), /riego ofrece la ETo de hoy y la
+# media de 7 días con una sola consulta por rango de la clave (estacion, dia).
+ETO_IMPORT_BATCH = 10_000   # filas por commit: la escritora no queda bloqueada todo el fichero
+_ETO_COLS = {
+    "estacion": ("estacion", "station", "codigo", "id_estacion", "station_id"),
+    "fecha":    ("fecha", "date", "dia", "day"),
+    "eto":      ("eto", "et0", "eto_mm", "et0_mm", "eto_pm", "et0_pm"),
+}
+SQL_ETO_ESTACION_UPSERT = """
+    INSERT INTO eto_estacion(estacion, dia, eto) VALUES (?,?,?)
+    ON CONFLICT(estacion, dia) DO UPDATE SET eto=excluded.eto"""
+SQL_ESTACION_RESUMEN = """
+    INSERT INTO estaciones(estacion, primer_dia, ultimo_dia, filas)
+    SELECT estacion, MIN(dia), MAX(dia), COUNT(*) FROM eto_estacion WHERE estacion=? GROUP BY estacion
+    ON CONFLICT(estacion) DO UPDATE SET
+      primer_dia=excluded.primer_dia, ultimo_dia=excluded.ultimo_dia, filas=excluded.filas"""
+
+def norm_estacion(codigo: str | None) -> str:
+    return " ".join((codigo or "").split()).upper()
+
+def _eto_col(header: list[str], clave: str, cols: dict = _ETO_COLS) -> int | None:
+    # 'ETo (mm)', 'Estación', 'station_id'… → índice de la columna o None
+    nombres = [norm_crop(h.split("(")[0]).replace(" ", "_") for h in header]
+    for alias in cols[clave]:
+        if alias in nombres:
+            return nombres.index(alias)
+    return None
+
+def _fecha_eto(txt: str) -> date | None:
+    # Atajos sin strptime para los formatos de exportación habituales
+    # (YYYY-MM-DD y DD/MM/YYYY); el resto pasa por parse_fecha
+    if len(txt) == 10 and txt[2] in "/-." and txt[5] == txt[2] and txt[:2].isdigit():
+        try:
+            return date(int(txt[6:]), int(txt[3:5]), int(txt[:2]))
+        except ValueError:
+            return None
+    try:
+        return date.fromisoformat(txt)
+    except ValueError:
+        return parse_fecha(txt)
+
+def iter_eto_csv(f, estacion: str | None = None, stats: dict | None = None):
+    # Genera (estacion, dia, eto) fila a fila. Separador ',', ';' o tabulador
+    # (decimales con coma si no es ','). estacion solo se usa si el fichero no
+    # trae columna de estación. Filas sin fecha o ETo válidas (huecos de la
+    # estación) se cuentan en stats["descartadas"].
+    stats = stats if stats is not None else {}
+    stats.setdefault("descartadas", 0)
+    cabecera = f.readline()
+    sep = max((";", ",", "\t"), key=cabecera.count)
+    header = next(csv.reader([cabecera], delimiter=sep), [])
+    c_est, c_fecha, c_eto = (_eto_col(header, k) for k in ("estacion", "fecha", "eto"))
+    if c_fecha is None or c_eto is None:
+        raise ValueError(f"cabecera sin columnas de fecha y ETo: {header}")
+    if c_est is None and not estacion:
+        raise ValueError("el fichero no trae columna de estación: indica una")
+    fija = norm_estacion(estacion) if c_est is None else None
+    coma = sep != ","
+    for row in csv.reader(f, delimiter=sep):
+        if not row:
+            continue
+        try:
+            d = _fecha_eto(row[c_fecha].strip())
+            v = row[c_eto].strip()
+            eto = float(v.replace(",", ".") if coma else v)
+            est = fija or norm_estacion(row[c_est])
+        except (IndexError, ValueError):
+            stats["descartadas"] += 1
+            continue
+        if d is None or not est or not (0.0 <= eto < 25.0):   # NaN también falla
+            stats["descartadas"] += 1
+            continue
+        yield est, epoch_day(d), eto
+
+def _guardar_eto(filas, batch: int, st: dict, tocadas: set):
+    # (estacion, dia, eto) → eto_estacion, un commit por lote
+    filas = iter(filas)
+    while True:
+        lote = list(islice(filas, batch))
+        if not lote:
+            break
+        with db_write() as conn:
+            conn.executemany(SQL_ETO_ESTACION_UPSERT, lote)
+        st["filas"] += len(lote)
+        tocadas.update(r[0] for r in lote)
+
+def _resumir_estaciones(tocadas: set):
+    if tocadas:
+        with db_write() as conn:
+            conn.executemany(SQL_ESTACION_RESUMEN, [(e,) for e in sorted(tocadas)])
+
+def import_eto(paths, estacion: str | None = None, batch: int = ETO_IMPORT_BATCH) -> dict:
+    st = {"ficheros": 0, "filas": 0, "descartadas": 0, "estaciones": 0}
+    tocadas = set()
+    for path in paths:
+        defecto = estacion or os.path.splitext(os.path.basename(path))[0]
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            _guardar_eto(iter_eto_csv(f, defecto, st), batch, st, tocadas)
+        st["ficheros"] += 1
+    _resumir_estaciones(tocadas)
+    st["estaciones"] = len(tocadas)
+    return st
+
+def get_estaciones(limit: int = 60) -> list[tuple]:
+    with db_read() as conn:
+        return conn.execute(SQL_ESTACIONES, (limit,)).fetchall()
+
+def get_estacion(estacion: str) -> tuple | None:
+    with db_read() as conn:
+        return conn.execute(SQL_ESTACION_UNA, (estacion,)).fetchone()
+
+def eto_estacion_reciente(estacion: str, hoy: date, dias: int = 7) -> dict | None:
+    # ETo de hoy (o la última disponible) y media de los últimos `dias` días
+    h = epoch_day(hoy)
+    with db_read() as conn:
+        rows = conn.execute(SQL_ETO_ESTACION_RANGO, (estacion, h - dias + 1, h)).fetchall()
+    if not rows:
+        return None
+    ultimo_dia, ultimo = rows[-1]
+    return {"hoy": ultimo if ultimo_dia == h else None,
+            "ultimo": (from_epoch_day(ultimo_dia), ultimo),
+            "media": sum(r[1] for r in rows) / len(rows), "n": len(rows)}
+
+async def _eto_opciones(uid: int, context: ContextTypes.DEFAULT_TYPE) -> tuple[list[list[str]], str]:
+    # Botones con la ETo de la estación vinculada; riego_eto los traduce a valor
+    context.user_data.pop("eto_opciones", None)
+    est = (await run_db(get_user_ctx, uid))["settings"]["estacion"]
+    if not est:
+        return [], ""
+    r = await run_db(eto_estacion_reciente, est, datetime.now().date())
+    if r is None:
+        return [], f"ℹ️ Tu estación {est} no tiene datos de los últimos 7 días.\n"
+    opciones = {}
+    if r["hoy"] is not None:
+        opciones[f"Hoy {r['hoy']:.1f}"] = r["hoy"]
+    else:
+        d, v = r["ultimo"]
+        opciones[f"{d.strftime('%d/%m')} {v:.1f}"] = v
+    opciones[f"Media {r['n']} d {r['media']:.1f}"] = r["media"]
+    context.user_data["eto_opciones"] = opciones
+    return [list(opciones)], f"📡 Estación {est}: elige su ETo o escribe otra.\n"
+
+async def estacion_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid    = update.message.from_user.id
+    actual = (await run_db(get_user_ctx, uid))["settings"]["estacion"]
+    ests   = await run_db(get_estaciones)
+    if not ests:
+        await update.message.reply_text("Aún no hay estaciones con datos de ETo en este servidor.", reply_markup=kb_main())
+        return ConversationHandler.END
+    lines = [f"📡 Estación actual: {actual or 'ninguna'}", "Estaciones con datos:"]
+    for est, d0, d1, n in ests:
+        lines.append(f"- {est}: {from_epoch_day(d0).strftime('%d/%m/%Y')}–{from_epoch_day(d1).strftime('%d/%m/%Y')} ({n} días)")
+    lines.append("Escribe el código de tu estación o pulsa «Ninguna»:")
+    codigos = [e[0] for e in ests[:12]]
+    kb = kb_with_cancel([codigos[i:i+3] for i in range(0, len(codigos), 3)] + [["Ninguna"]])
+    chunks = split_msg(lines)
+    for chunk in chunks[:-1]:
+        await update.message.reply_text(chunk)
+    await update.message.reply_text(chunks[-1], reply_markup=kb)
+    return ESTACION_ELEGIR
+
+async def estacion_elegir(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.message.from_user.id
+    txt = update.message.text
+    if norm_crop(txt) == "ninguna":
+        await run_db(save_settings, uid, estacion="")
+        await update.message.reply_text("Estación desvinculada: /riego volverá a pedirte la ETo.", reply_markup=kb_main())
+        return ConversationHandler.END
+    est  = norm_estacion(txt)
+    info = await run_db(get_estacion, est)
+    if info is None:
+        await update.message.reply_text(f"No hay datos de «{est}». Escribe un código de la lista o «Ninguna».",
+                                        reply_markup=kb_with_cancel([["Ninguna"]]))
+        return ESTACION_ELEGIR
+    await run_db(save_settings, uid, estacion=est)
+    await update.message.reply_text(
+        f"✅ Estación {est} vinculada ({info[3]} días, hasta {from_epoch_day(info[2]).strftime('%d/%m/%Y')}).\n"
+        "/riego y /riego_todos te ofrecerán su ETo.", reply_markup=kb_main())
+    return ConversationHandler.END
+
+def bench_eto(estaciones: int = 50, anios: int = 10, seed: int = 1) -> dict:
+    # Importa series sintéticas (mitad con ';' y decimales con coma, sin columna
+    # de estación) en una BD temporal (db_temporal), nunca en la real.
+    with db_temporal():
+        rnd = random.Random(seed)
+        d0 = date(2015, 1, 1)
+        dias = anios * 365
+        codigos = [f"BENCH-{i:03d}" for i in range(estaciones)]
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for i, cod in enumerate(codigos):
+                path = os.path.join(tmp, f"{cod}.csv")
+                with open(path, "w", newline="", encoding="utf-8") as f:
+                    if i % 2:
+                        f.write("Fecha;ETo (mm)\n")
+                        for k in range(dias):
+                            d = d0 + timedelta(days=k)
+                            eto = f"{ETO_MESES[d.month][1] + rnd.uniform(-1, 1):.2f}".replace(".", ",")
+                            f.write(f"{d.strftime('%d/%m/%Y')};{eto}\n")
+                    else:
+                        f.write("station,date,et0\n")
+                        for k in range(dias):
+                            d = d0 + timedelta(days=k)
+                            f.write(f"{cod},{d.isoformat()},{ETO_MESES[d.month][1] + rnd.uniform(-1, 1):.2f}\n")
+                paths.append(path)
+            t0 = time.perf_counter()
+            st = import_eto(paths)
+            t_import = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        r = eto_estacion_reciente(codigos[-1], d0 + timedelta(days=dias - 1))
+        t_lookup = time.perf_counter() - t0
+        return dict(st, esperadas=estaciones * dias, t_import=t_import, t_lookup=t_lookup, media_ok=r is not None and r["n"] == 7)
+
+# =========================
+# ETo PENMAN-MONTEITH (FAO-56) desde datos horarios
+# =========================
+# Registros horarios de estación (temperatura, HR, viento, radiación) → ETo
+# diaria con la ecuación 6 de FAO-56 sobre los agregados del día (Tmax/Tmin,
+# HRmax/HRmin, viento medio, Rs = media × 24 h; G = 0). El fichero se lee por
+# bloques de PM_CHUNK_FILAS: con NumPy cada bloque se reduce por día con
+# reduceat y la ecuación se evalúa en un solo paso vectorizado; en memoria solo
+# quedan el bloque en curso y los agregados por (estación, día). Sin NumPy,
+# mismo cálculo fila a fila. El resultado va a eto_estacion (/riego, /eto_rapida).
+# `python main.py check-eto` contrasta con los ejemplos resueltos de FAO-56.
+PM_CHUNK_FILAS = 50_000
+PM_HORAS_MIN   = 18     # registros con dato para aceptar un día
+PM_U2_DEFECTO  = 2.0    # m/s: valor de FAO-56 si no hay anemómetro
+PM_KRS         = 0.16   # Hargreaves (ec. 50, interior) si no hay piranómetro
+_PM_COLS = {
+    "estacion": _ETO_COLS["estacion"],
+    "fecha":    ("fecha_hora", "timestamp", "datetime", "fecha", "date", "dia"),
+    "t":        ("temp", "temperatura", "t", "tair", "t_aire", "tmed", "ta"),
+    "hr":       ("hr", "rh", "humedad", "humedad_relativa", "hum", "hrmed"),
+    "u":        ("viento", "wind", "u", "vv", "velviento", "velocidad_viento", "ws", "u2"),
+    "rs":       ("rs", "radiacion", "rad", "radiation", "radiacion_solar", "ghi"),
+}
+
+def pm_presion(alt_m: float) -> float:
+    return 101.3 * ((293.0 - 0.0065 * alt_m) / 293.0) ** 5.26          # ec. 7, kPa
+
+def pm_e0(t: float) -> float:
+    return 0.6108 * math.exp(17.27 * t / (t + 237.3))                  # ec. 11, kPa
+
+def pm_ra(lat_deg: float, doy: int) -> float:
+    # Radiación extraterrestre diaria (ec. 21), MJ/m²/día
+    phi = math.radians(lat_deg)
+    dr  = 1 + 0.033 * math.cos(2 * math.pi * doy / 365)
+    dec = 0.409 * math.sin(2 * math.pi * doy / 365 - 1.39)
+    ws  = math.acos(max(-1.0, min(1.0, -math.tan(phi) * math.tan(dec))))
+    return 24 * 60 / math.pi * 0.0820 * dr * (ws * math.sin(phi) * math.sin(dec)
+                                              + math.cos(phi) * math.cos(dec) * math.sin(ws))
+
+def pm_u2(uz: float, z: float) -> float:
+    return uz * 4.87 / math.log(67.8 * z - 5.42)                       # ec. 47
+
+def eto_pm_dia(tmax, tmin, hrmax, hrmin, u2, rs, lat_deg, alt_m, doy) -> float:
+    # FAO-56 ec. 6 a escala diaria; rs en MJ/m²/día (None o NaN → ec. 50)
+    ra = pm_ra(lat_deg, doy)
+    if rs is None or rs != rs:
+        rs = PM_KRS * math.sqrt(max(tmax - tmin, 0.0)) * ra
+    t     = (tmax + tmin) / 2
+    gamma = 0.665e-3 * pm_presion(alt_m)
+    delta = 4098 * pm_e0(t) / (t + 237.3) ** 2
+    e_max, e_min = pm_e0(tmax), pm_e0(tmin)
+    es  = (e_max + e_min) / 2
+    ea  = (e_min * hrmax / 100 + e_max * hrmin / 100) / 2
+    rso = (0.75 + 2e-5 * alt_m) * ra
+    rel = min(rs / rso, 1.0) if rso > 0 else 1.0
+    rnl = 4.903e-9 * ((tmax + 273.16) ** 4 + (tmin + 273.16) ** 4) / 2 * (0.34 - 0.14 * math.sqrt(ea)) * (1.35 * rel - 0.35)
+    rn  = (1 - 0.23) * rs - rnl
+    eto = (0.408 * delta * rn + gamma * 900 / (t + 273) * u2 * (es - ea)) / (delta + gamma * (1 + 0.34 * u2))
+    return max(eto, 0.0)
+
+def eto_pm_batch(tmax, tmin, hrmax, hrmin, u2, rs, lat_deg, alt_m, doy):
+    # eto_pm_dia sobre arrays NumPy, mismas operaciones en el mismo orden
+    tmax, tmin, hrmax, hrmin, u2, rs, doy = (np.asarray(v, dtype=np.float64)
+                                              for v in (tmax, tmin, hrmax, hrmin, u2, rs, doy))
+    phi = math.radians(lat_deg)
+    dr  = 1 + 0.033 * np.cos(2 * math.pi * doy / 365)
+    dec = 0.409 * np.sin(2 * math.pi * doy / 365 - 1.39)
+    ws  = np.arccos(np.clip(-math.tan(phi) * np.tan(dec), -1.0, 1.0))
+    ra  = 24 * 60 / math.pi * 0.0820 * dr * (ws * math.sin(phi) * np.sin(dec)
+                                             + math.cos(phi) * np.cos(dec) * np.sin(ws))
+    rs  = np.where(np.isnan(rs), PM_KRS * np.sqrt(np.maximum(tmax - tmin, 0.0)) * ra, rs)
+    t     = (tmax + tmin) / 2
+    gamma = 0.665e-3 * pm_presion(alt_m)
+    e_t   = 0.6108 * np.exp(17.27 * t / (t + 237.3))
+    delta = 4098 * e_t / (t + 237.3) ** 2
+    e_max = 0.6108 * np.exp(17.27 * tmax / (tmax + 237.3))
+    e_min = 0.6108 * np.exp(17.27 * tmin / (tmin + 237.3))
+    es  = (e_max + e_min) / 2
+    ea  = (e_min * hrmax / 100 + e_max * hrmin / 100) / 2
+    rso = (0.75 + 2e-5 * alt_m) * ra
+    rel = np.where(rso > 0, np.minimum(rs / np.where(rso > 0, rso, 1.0), 1.0), 1.0)
+    rnl = 4.903e-9 * ((tmax + 273.16) ** 4 + (tmin + 273.16) ** 4) / 2 * (0.34 - 0.14 * np.sqrt(ea)) * (1.35 * rel - 0.35)
+    rn  = (1 - 0.23) * rs - rnl
+    eto = (0.408 * delta * rn + gamma * 900 / (t + 273) * u2 * (es - ea)) / (delta + gamma * (1 + 0.34 * u2))
+    return np.maximum(eto, 0.0)
+
+def _num(x: str) -> float:
+    try:
+        return float(x.replace(",", "."))
+    except ValueError:
+        return math.nan   # celda vacía, '--', 'N/A'…
+
+# Agregados por (estación, día): [tmax, tmin, hrmax, hrmin, u_sum, u_n, rs_sum, rs_n, t_n, hr_n]
+def _pm_nuevo() -> list:
+    return [-math.inf, math.inf, -math.inf, math.inf, 0.0, 0, 0.0, 0, 0, 0]
+
+def _pm_acumular_py(rows, c: dict, fija, acc: dict, st: dict):
+    for row in rows:
+        try:
+            key = (fija or row[c["estacion"]], row[c["fecha"]][:10])
+            t, hr = _num(row[c["t"]]), _num(row[c["hr"]])
+            u  = _num(row[c["u"]])  if c["u"]  is not None else math.nan
+            rs = _num(row[c["rs"]]) if c["rs"] is not None else math.nan
+        except IndexError:
+            st["descartadas"] += 1
+            continue
+        a = acc.get(key)
+        if a is None:
+            a = acc[key] = _pm_nuevo()
+        if t == t:
+            a[0] = max(a[0], t); a[1] = min(a[1], t); a[8] += 1
+        if hr == hr:
+            a[2] = max(a[2], hr); a[3] = min(a[3], hr); a[9] += 1
+        if u == u:
+            a[4] += u; a[5] += 1
+        if rs == rs:
+            a[6] += rs; a[7] += 1
+
+def _pm_columna(col) -> "np.ndarray":
+    try:
+        return np.fromiter(map(float, col), dtype=np.float64, count=len(col))
+    except ValueError:   # huecos ('', '--', 'N/A') → NaN
+        return np.fromiter(map(_num, col), dtype=np.float64, count=len(col))
+
+def _pm_columnas(texto: str, sep: str, ncols: int, ancho: int, st: dict) -> list | None:
+    # Bloque de texto → columnas. Camino rápido: un único split de todo el bloque
+    # y columnas por rebanado (sin una lista por fila: el GC no tiene que
+    # recorrer cientos de miles de objetos). Si alguna fila no tiene ncols
+    # campos, se parte línea a línea y se descartan las cortas.
+    if not texto.endswith("\n"):
+        texto += "\n"
+    campos = texto.replace("\n", sep).split(sep)
+    n = texto.count("\n")
+    if len(campos) == n * ncols + 1:
+        return [campos[i:-1:ncols] for i in range(ancho)]
+    rows = [ln.split(sep) for ln in texto.splitlines() if ln]
+    ok = [r for r in rows if len(r) >= ancho]
+    st["descartadas"] += len(rows) - len(ok)
+    return list(zip(*ok)) if ok else None
+
+def _pm_acumular_np(cols, c: dict, fija, acc: dict, st: dict):
+    if not cols:
+        return
+    dias = [x[:10] for x in cols[c["fecha"]]]
+    claves = dias if fija else [e + "\x1f" + d for e, d in zip(cols[c["estacion"]], dias)]
+    uk, inv = np.unique(np.array(claves), return_inverse=True)
+    order  = np.argsort(inv, kind="stable")
+    ks     = inv[order]
+    starts = np.flatnonzero(np.r_[True, ks[1:] != ks[:-1]])
+    vals = []
+    for k in ("t", "hr", "u", "rs"):
+        x = _pm_columna(cols[c[k]])[order] if c[k] is not None else np.full(len(dias), np.nan)
+        hay = ~np.isnan(x)
+        vals.append((np.fmax.reduceat(x, starts).tolist(), np.fmin.reduceat(x, starts).tolist(),
+                     np.add.reduceat(np.where(hay, x, 0.0), starts).tolist(),
+                     np.add.reduceat(hay.astype(np.int64), starts).tolist()))
+    t, hr, u, rs = vals
+    for j, clave in enumerate(uk.tolist()):
+        key = (fija, clave) if fija else tuple(clave.split("\x1f", 1))
+        a = acc.get(key)
+        if a is None:
+            a = acc[key] = _pm_nuevo()
+        if t[3][j]:
+            a[0] = max(a[0], t[0][j]); a[1] = min(a[1], t[1][j]); a[8] += t[3][j]
+        if hr[3][j]:
+            a[2] = max(a[2], hr[0][j]); a[3] = min(a[3], hr[1][j]); a[9] += hr[3][j]
+        a[4] += u[2][j];  a[5] += u[3][j]
+        a[6] += rs[2][j]; a[7] += rs[3][j]
+
+def eto_desde_horario(f, lat_deg: float, alt_m: float, estacion: str | None = None,
+                      z_viento: float = 2.0, chunk: int = PM_CHUNK_FILAS, st: dict | None = None) -> list[tuple]:
+    # CSV horario → [(estacion, dia, eto)] ordenado. Radiación en W/m² salvo que
+    # la cabecera diga MJ (MJ/m²/h). Días con menos de PM_HORAS_MIN registros
+    # de temperatura o HR se descartan; sin viento → 2 m/s; sin Rs → ec. 50.
+    st = st if st is not None else {}
+    for k in ("horas", "descartadas", "dias_incompletos", "rs_estimada", "u2_defecto"):
+        st.setdefault(k, 0)
+    cabecera = f.readline()
+    sep = max((";", ",", "\t"), key=cabecera.count)
+    header = next(csv.reader([cabecera], delimiter=sep), [])
+    c = {k: _eto_col(header, k, _PM_COLS) for k in _PM_COLS}
+    if c["fecha"] is None or c["t"] is None or c["hr"] is None:
+        raise ValueError(f"cabecera sin fecha, temperatura y humedad: {header}")
+    if c["estacion"] is None and not estacion:
+        raise ValueError("el fichero no trae columna de estación: indica una")
+    fija = norm_estacion(estacion) if c["estacion"] is None else None
+    rs_dia = 24.0 if c["rs"] is not None and "mj" in header[c["rs"]].lower() else 0.0864   # media → MJ/m²/día
+
+    # Se trabaja por bloques de texto: comillas y retornos de carro fuera y, si
+    # el separador no es ',', decimales con coma → punto, cada cosa en una sola
+    # operación (las exportaciones horarias no llevan separadores dentro de los
+    # campos, así que no hace falta el parser csv completo).
+    coma  = sep != ","
+    ancho = max(i for i in c.values() if i is not None) + 1
+    acc = {}
+    while True:
+        lineas = list(islice(f, chunk))
+        if not lineas:
+            break
+        st["horas"] += len(lineas)
+        texto = "".join(lineas).replace('"', "").replace("\r", "")
+        del lineas
+        if coma:
+            texto = texto.replace(",", ".")
+        if np is not None:
+            cols = _pm_columnas(texto, sep, len(header), ancho, st)
+            _pm_acumular_np(cols, c, fija, acc, st)
+        else:
+            rows = [ln.split(sep) for ln in texto.splitlines() if ln]
+            _pm_acumular_py(rows, c, fija, acc, st)
+
+    dias, cols = [], [[] for _ in range(7)]
+    fechas, nombres = {}, {}
+    for (est, txt), a in acc.items():
+        d = fechas.get(txt)
+        if d is None:
+            d = fechas[txt] = _fecha_eto(txt.strip())
+        if d is None or a[8] < PM_HORAS_MIN or a[9] < PM_HORAS_MIN:
+            st["dias_incompletos"] += 1
+            continue
+        if a[5] >= PM_HORAS_MIN:
+            u2 = pm_u2(a[4] / a[5], z_viento)
+        else:
+            u2 = PM_U2_DEFECTO
+            st["u2_defecto"] += 1
+        if a[7] >= PM_HORAS_MIN:
+            rs = a[6] / a[7] * rs_dia
+        else:
+            rs = math.nan
+            st["rs_estimada"] += 1
+        nombre = nombres.get(est)
+        if nombre is None:
+            nombre = nombres[est] = norm_estacion(est)
+        dias.append((nombre, epoch_day(d)))
+        for col, v in zip(cols, (a[0], a[1], min(a[2], 100.0), max(min(a[3], 100.0), 0.0), u2, rs,
+                                 d.timetuple().tm_yday)):
+            col.append(v)
+    if not dias:
+        return []
+    if np is not None:
+        etos = eto_pm_batch(*cols[:6], lat_deg, alt_m, cols[6]).tolist()
+    else:
+        etos = [eto_pm_dia(*v[:6], lat_deg, alt_m, v[6]) for v in zip(*cols)]
+    return sorted((e, dia, eto) for (e, dia), eto in zip(dias, etos))
+
+def import_horario(paths, lat_deg: float, alt_m: float, estacion: str | None = None,
+                   z_viento: float = 2.0, batch: int = ETO_IMPORT_BATCH) -> dict:
+    st = {"ficheros": 0, "filas": 0, "estaciones": 0}
+    tocadas = set()
+    for path in paths:
+        defecto = estacion or os.path.splitext(os.path.basename(path))[0]
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            filas = eto_desde_horario(f, lat_deg, alt_m, defecto, z_viento, st=st)
+        _guardar_eto(filas, batch, st, tocadas)
+        st["ficheros"] += 1
+    _resumir_estaciones(tocadas)
+    st["estaciones"] = len(tocadas)
+    return st
+
+def _csv_horario_fao18() -> str:
+    # Día del ejemplo 18 de FAO-56 (Bruselas, 6 de julio) como 24 registros
+    # horarios: Tmax/Tmin 21.5/12.3 °C, HR 63/84 %, viento 10 km/h a 10 m y
+    # Rs = 22.07 MJ/m²/día repartida en campana entre las 5 y las 20 h
+    campana = [math.sin(math.pi * (h - 4) / 16) if 4 < h < 20 else 0.0 for h in range(24)]
+    w = 22.07 / 0.0864 * 24 / sum(campana)
+    lineas = ["fecha_hora,temp,hr,viento,rs"]
+    for h in range(24):
+        x = (1 - math.cos(2 * math.pi * ((h - 5) % 24) / 24)) / 2   # 0 a las 5 h, 1 a las 17 h
+        lineas.append(f"2025-07-06 {h:02d}:00,{12.3 + 9.2 * x},{84 - 21 * x},{10 / 3.6},{w * campana[h]}")
+    return "\n".join(lineas) + "\n"
+
+def check_eto() -> list[tuple]:
+    # (comprobación, valor, esperado, tolerancia) con los ejemplos de FAO-56
+    ea5 = (pm_e0(18) * 82 / 100 + pm_e0(25) * 54 / 100) / 2
+    fichero = eto_desde_horario(io.StringIO(_csv_horario_fao18()), 50.8, 100, "FAO18", z_viento=10)
+    out = [
+        ("ej. 2: P a 1800 m (kPa)",          pm_presion(1800),                 81.8,  0.05),
+        ("ej. 2: γ a 1800 m (kPa/°C)",       0.665e-3 * pm_presion(1800),      0.054, 0.0005),
+        ("ej. 3: es 24.5/15 °C (kPa)",       (pm_e0(24.5) + pm_e0(15)) / 2,    2.39,  0.005),
+        ("ej. 5: ea HR 82/54 % (kPa)",       ea5,                              1.70,  0.005),
+        ("ej. 8: Ra 20°S, 3-sep (MJ/m²)",    pm_ra(-20, 246),                  32.2,  0.05),
+        ("ej. 14: u2 desde 3.2 m/s a 10 m",  pm_u2(3.2, 10),                   2.4,   0.05),
+        ("ej. 18: ETo Bruselas 6-jul (mm)",  eto_pm_dia(21.5, 12.3, 84, 63, pm_u2(10 / 3.6, 10), 22.07, 50.8, 100, 187), 3.9, 0.05),
+        ("ej. 18 desde CSV horario (mm)",    fichero[0][2] if fichero else math.nan, 3.9, 0.05),
+    ]
+    if np is not None:
+        rnd = random.Random(7)
+        filas = [(tmin + rnd.uniform(2, 18), tmin, rnd.uniform(60, 100), rnd.uniform(10, 60),
+                  rnd.uniform(0.5, 6), rnd.choice([rnd.uniform(2, 30), math.nan]), rnd.randint(1, 365))
+                 for tmin in (rnd.uniform(-5, 25) for _ in range(2000))]
+        lat = 38.0
+        vec = eto_pm_batch(*zip(*[f[:6] for f in filas]), lat, 350, [f[6] for f in filas])
+        dif = max(abs(eto_pm_dia(*f[:6], lat, 350, f[6]) - v) for f, v in zip(filas, vec.tolist()))
+        out.append(("NumPy vs escalar (máx. dif.)", dif, 0.0, 1e-9))
+    return out
+
+def bench_pm(filas: int = 1_000_000, estaciones: int = 10, memoria: bool = False) -> dict:
+    # CSV horario sintético de `estaciones` estaciones → ETo diaria en una BD
+    # temporal (db_temporal), nunca en la real. memoria=True mide el pico con tracemalloc.
+    rnd = random.Random(3)
+    por_est = -(-filas // (estaciones * 24)) * 24   # días completos
+    codigos = [f"BENCH-PM{i:02d}" for i in range(estaciones)]
+    t0_dia = datetime(2000, 1, 1)
+    with tempfile.TemporaryDirectory() as tmp, db_temporal():
+        path = os.path.join(tmp, "horario.csv")
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            f.write("estacion;fecha_hora;temp;hr;viento;radiacion (W/m2)\n")
+            for cod in codigos:
+                for h in range(por_est):
+                    ts = t0_dia + timedelta(hours=h)
+                    sol = max(0.0, math.sin(math.pi * (ts.hour - 6) / 14)) if 6 < ts.hour < 20 else 0.0
+                    f.write(f"{cod};{ts:%Y-%m-%d %H:%M};{12 + 10 * sol + rnd.uniform(-1, 1):.1f};"
+                            f"{80 - 35 * sol:.0f};{rnd.uniform(0.5, 4):.1f};{850 * sol:.0f}\n".replace(".", ","))
+        if memoria:
+            import tracemalloc
+            tracemalloc.start()
+        try:
+            t0 = time.perf_counter()
+            st = import_horario([path], 38.0, 350.0)
+            t = time.perf_counter() - t0
+            pico = tracemalloc.get_traced_memory()[1] if memoria else None
+        finally:
+            if memoria:
+                tracemalloc.stop()
+    return dict(st, t=t, pico=pico, numpy=np is not None)
+
 # =========================
 # ETo RÁPIDA
 # =========================
 async def eto_rapida(update: Update, context: ContextTypes.DEFAULT_TYPE):
     mes  = datetime.now().month
     vals = ETO_MESES.get(mes, [3.0, 4.0, 5.0])
-    kb   = kb_with_cancel([[f"{v:.1f}" for v in vals]])
-    await update.message.reply_text(f"ETo rápida — Mes {mes}. Elige un valor:", reply_markup=kb)
+    filas, aviso = await _eto_opciones(update.message.from_user.id, context)
+    kb   = kb_with_cancel(filas + [[f"{v:.1f}" for v in vals]])
+    await update.message.reply_text(aviso + f"ETo rápida — Mes {mes}. Elige un valor:", reply_markup=kb)
     return ETO_RÁPIDA_VALOR if False else ETO_RAPIDA_VALOR  # mantener nombre correcto
 
 async def eto_rapida_valor(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        eto = float(update.message.text.replace(",", "."))
-    except:
-        await update.message.reply_text("Elige un valor del teclado (ej. 3.5).", reply_markup=kb_cancel_only())
-        return ETO_RAPIDA_VALOR
+    eto = context.user_data.get("eto_opciones", {}).get(update.message.text.strip())
+    if eto is None:
+        try:
+            eto = float(update.message.text.replace(",", "."))
+        except:
+            await update.message.reply_text("Elige un valor del teclado (ej. 3.5).", reply_markup=kb_cancel_only())
+            return ETO_RAPIDA_VALOR
     context.user_data["eto"] = eto
     reply_kb = kb_with_cancel([["sin_estres","leve","moderado"]])
     await update.message.reply_text("Nivel de estrés hídrico:", reply_markup=reply_kb)
     return RIEGO_STRESS  # reutiliza riego_calc
 
+# =========================
+# ENVÍOS — limitador de salida (límites de Telegram)
+# =========================
+# Todas las llamadas del bot pasan por aquí (ApplicationBuilder.rate_limiter).
+# Un cubo de tokens global reparte SEND_RPS envíos/s; antes, los envíos a un
+# mismo chat se ponen en fila (conservan el orden) y se separan SEND_CHAT_SECS
+# (SEND_GROUP_SECS en grupos) desde el anterior. Los tokens se conceden por
+# prioridad: las respuestas interactivas adelantan a las notificaciones masivas,
+# que se marcan con rate_limit_args=PRIO_MASIVO. Un RetryAfter pausa todo el
+# cubo el tiempo indicado y la petición se reintenta (SEND_MAX_RETRIES).
+PRIO_INTERACTIVO = 0
+PRIO_MASIVO      = 1
+
+class EnvioLimiter(BaseRateLimiter[int]):
+    def __init__(self, rps:float=SEND_RPS, burst:int=SEND_BURST, chat_secs:float=SEND_CHAT_SECS,
+                 group_secs:float=SEND_GROUP_SECS, max_retries:int=SEND_MAX_RETRIES):
+        self.rps, self.burst = float(rps), max(1, int(burst))
+        self.chat_secs, self.group_secs = chat_secs, group_secs
+        self.max_retries = max_retries
+        self._tokens = float(self.burst)
+        self._t_refill = time.monotonic()
+        self._pausa_hasta = 0.0
+        self._espera: list = []                  # heap (prioridad, seq, future)
+        self._seq = 0
+        self._pump: asyncio.Task | None = None
+        self._chats: dict = {}                   # chat_id → [lock, último envío, en uso]
+        self._stats = {"enviados": 0, "retry_after": 0, "fallidos": 0, "cola_max": 0,
+                       "espera_sum": 0.0, "espera_max": 0.0, "envio_sum": 0.0, "envio_max": 0.0}
+        self._lat = deque(maxlen=1000)           # últimas esperas (p95)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        if self._pump:
+            self._pump.cancel()
+            self._pump = None
+        for _, _, fut in self._espera:
+            if not fut.done():
+                fut.cancel()
+        self._espera.clear()
+
+    # --- cubo global ---
+    def _refill(self, now:float):
+        self._tokens = min(self.burst, self._tokens + (now - self._t_refill) * self.rps)
+        self._t_refill = now
+
+    async def _token(self, prio:int):
+        now = time.monotonic()
+        self._refill(now)
+        if not self._espera and now >= self._pausa_hasta and self._tokens >= 1:
+            self._tokens -= 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._espera, (prio, self._seq, fut))
+        self._stats["cola_max"] = max(self._stats["cola_max"], len(self._espera))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._bombear())
+        await fut
+
+    async def _bombear(self):
+        # Concede tokens en orden (prioridad, llegada) al ritmo del cubo
+        while self._espera:
+            now = time.monotonic()
+            if now < self._pausa_hasta:
+                await asyncio.sleep(self._pausa_hasta - now)
+                continue
+            self._refill(now)
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rps)
+                continue
+            _, _, fut = heapq.heappop(self._espera)
+            if fut.done():                       # el llamante se canceló
+                continue
+            self._tokens -= 1
+            fut.set_result(None)
+            await asyncio.sleep(0)
+
+    # --- ritmo por chat ---
+    def _chat(self, chat_id) -> list:
+        c = self._chats.get(chat_id)
+        if c is None:
+            if len(self._chats) > 50_000:        # olvidar chats inactivos
+                lim = time.monotonic() - max(self.chat_secs, self.group_secs)
+                self._chats = {k: v for k, v in self._chats.items() if v[2] or v[1] > lim}
+            c = self._chats[chat_id] = [asyncio.Lock(), 0.0, 0]
+        return c
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint == "getUpdates":             # el long polling no cuenta para los límites
+            return await callback(*args, **kwargs)
+        prio = PRIO_INTERACTIVO if rate_limit_args is None else rate_limit_args
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await self._enviar(callback, args, kwargs, endpoint, prio, time.monotonic())
+        c = self._chat(chat_id)
+        gap = self.group_secs if isinstance(chat_id, str) or int(chat_id) < 0 else self.chat_secs
+        t0 = time.monotonic()
+        c[2] += 1
+        try:
+            async with c[0]:
+                espera = c[1] + gap - time.monotonic()
+                if espera > 0:
+                    await asyncio.sleep(espera)
+                try:
+                    return await self._enviar(callback, args, kwargs, endpoint, prio, t0)
+                finally:
+                    c[1] = time.monotonic()
+        finally:
+            c[2] -= 1
+
+    async def _enviar(self, callback, args, kwargs, endpoint, prio, t0):
+        intentos = 0
+        while True:
+            await self._token(prio)
+            t1 = time.monotonic()
+            if t1 < self._pausa_hasta:           # un RetryAfter llegó mientras esperábamos turno:
+                self._refill(t1)                 # se devuelve el token sin gastar y se vuelve a la cola
+                self._tokens = min(self.burst, self._tokens + 1)
+                continue
+            try:
+                res = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                ra = e.retry_after
+                secs = ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+                self._stats["retry_after"] += 1
+                self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + secs)
+                intentos += 1
+                if intentos > self.max_retries:
+                    self._stats["fallidos"] += 1
+                    raise
+                print(f"[envio] RetryAfter {secs:g} s en {endpoint}; reintento {intentos}/{self.max_retries}")
+                continue
+            except Exception:
+                self._stats["fallidos"] += 1
+                raise
+            espera, envio = t1 - t0, time.monotonic() - t1
+            st = self._stats
+            st["enviados"] += 1
+            st["espera_sum"] += espera
+            st["envio_sum"] += envio
+            st["espera_max"] = max(st["espera_max"], espera)
+            st["envio_max"] = max(st["envio_max"], envio)
+            self._lat.append(espera)
+            return res
+
+    def stats(self) -> dict:
+        st = dict(self._stats)
+        n = max(st["enviados"], 1)
+        lat = sorted(self._lat)
+        st.update(cola=len(self._espera), espera_media=st["espera_sum"] / n, envio_medio=st["envio_sum"] / n,
+                  espera_p95=lat[int(0.95 * (len(lat) - 1))] if lat else 0.0)
+        return st
+
+ENVIO = EnvioLimiter()
+
+def bench_envio(n:int=300, chats:int=200, interactivos:int=20, rps:float=SEND_RPS,
+                retry_cada:int=100, seed:int=1) -> dict:
+    # Bot API falsa en memoria: registra instantes por chat e inyecta un
+    # RetryAfter cada retry_cada llamadas. Mide ritmo global, separación por
+    # chat y la espera de las respuestas interactivas bajo una ráfaga masiva.
+    rnd = random.Random(seed)
+    lim = EnvioLimiter(rps=rps, burst=SEND_BURST, chat_secs=SEND_CHAT_SECS, group_secs=SEND_GROUP_SECS)
+    marcas, por_chat, llamadas = [], {}, [0]
+    pausa = [0.0]
+
+    async def fake_api(chat_id):
+        llamadas[0] += 1
+        now = time.monotonic()
+        if retry_cada and llamadas[0] % retry_cada == 0:
+            pausa[0] = now + 1
+            raise RetryAfter(1)
+        if now < pausa[0]:
+            raise RuntimeError("envío durante la pausa de RetryAfter")
+        await asyncio.sleep(rnd.uniform(0.005, 0.03))
+        marcas.append(now)
+        por_chat.setdefault(chat_id, []).append(now)
+        return True
+
+    async def enviar(chat_id, prio):
+        t0 = time.monotonic()
+        await lim.process_request(fake_api, (chat_id,), {}, "sendMessage", {"chat_id": chat_id}, prio)
+        return time.monotonic() - t0
+
+    async def run():
+        await lim.initialize()
+        masivo = [asyncio.create_task(enviar(1 + i % chats, PRIO_MASIVO)) for i in range(n)]
+        await asyncio.sleep(n / rps / 2)         # a mitad de la ráfaga llega tráfico interactivo
+        inter = await asyncio.gather(*(enviar(10**9 + i, None) for i in range(interactivos)))
+        res = await asyncio.gather(*masivo, return_exceptions=True)
+        await lim.shutdown()
+        return inter, res
+
+    t0 = time.perf_counter()
+    inter, res = asyncio.run(run())
+    t = time.perf_counter() - t0
+    marcas.sort()
+    pico, j = 0, 0
+    for i, m in enumerate(marcas):               # máx. envíos en cualquier ventana de 1 s
+        while marcas[j] <= m - 1.0:
+            j += 1
+        pico = max(pico, i - j + 1)
+    gap = min((b - a for v in por_chat.values() for a, b in zip(v, v[1:])), default=None)
+    st = lim.stats()
+    return {"n": n, "interactivos": interactivos, "t": t, "entregados": len(marcas),
+            "perdidos": sum(isinstance(r, Exception) for r in res), "pico_1s": pico, "gap_chat": gap,
+            "inter_max": max(inter, default=0.0), "retry_after": st["retry_after"], "stats": st}
+
 # =========================
 # NOTIFICACIONES — enriquecidas "Titular + Ver más"
 # =========================
@@ -1176,8 +3872,7 @@ def _kind_label(k: str) -> str:
     }
     return m.get((k or "mixto").lower(), "Mixto")
 
-def notif_status_text(uid:int):
-    s = get_settings(uid)
+def notif_status_text(s:dict):
     estado = "activas" if s['notify_enabled'] else "inactivas"
     tipo = _kind_label(s.get("notify_kind"))
     return (f"🔔 *Notificaciones*\n"
@@ -1297,47 +3992,46 @@ NOTIFICATIONS = [
 def _notif_block_line(block:str, title:str) -> str:
     return f"🧩 <b>{title}</b>\n<i>{block}</i>"
 
-def _ids_habitos(): return list(range(1, 51))
-def _ids_micro():   return list(range(51, 101))
-
-# En "mixto": alterna automáticamente día par → hábitos, día impar → micro
-def _allowed_ids(kind:str) -> list[int]:
-    k = (kind or "mixto").strip().lower()
-    # compat: 'riego' == micro-formación, 'mantenimiento' == hábitos
-    if k in ("micro", "riego"):
-        return _ids_micro()
-    if k in ("habitos", "mantenimiento"):
-        return _ids_habitos()
-    # mixto → alterna automáticamente día par/impar
-    parity = datetime.now().toordinal() % 2  # 0 par → hábitos, 1 impar → micro
-    return _ids_habitos() if parity == 0 else _ids_micro()
-
-def _day_based_start(allowed:list[int]) -> int:
-    if not allowed: return 1
-    idx = (datetime.now().toordinal() - 1) % len(allowed)
-    return allowed[idx]
-
-def _next_index_for(uid:int) -> int:
-    s = get_settings(uid)
-    last = int(s.get("notif_last_idx", -1))
-    allowed = _allowed_ids(s.get("notify_kind"))
-    if not allowed:
-        return 1
-    if last in allowed:
-        pos = allowed.index(last)
-        return allowed[(pos + 1) % len(allowed)]
-    return _day_based_start(allowed)
+# Catálogo precompilado: por id, la tupla, la cabecera HTML y el teclado
+# "Ver más" (inmutables en PTB, se reutilizan entre envíos).
+NOTIF_HEAD  = {t[0]: _notif_block_line(t[1], t[2]) for t in NOTIFICATIONS}
+NOTIF_FULL  = {t[0]: f"{NOTIF_HEAD[t[0]]}\n\n{t[3]}" for t in NOTIFICATIONS}
+NOTIF_KB    = {t[0]: InlineKeyboardMarkup([[InlineKeyboardButton("Ver más", callback_data=f"n:more:{t[0]}")]])
+               for t in NOTIFICATIONS}
+
+# Tablas de rotación por tipo: ids en orden y, para cada id, el siguiente (cíclico)
+_NOTIF_ROT = {"habitos": tuple(t[0] for t in NOTIFICATIONS if t[1] == "HÁBITOS"),
+              "micro":   tuple(t[0] for t in NOTIFICATIONS if t[1] == "MICRO-FORMACIÓN")}
+_NOTIF_SIG = {k: dict(zip(ids, ids[1:] + ids[:1])) for k, ids in _NOTIF_ROT.items()}
+# compat: 'riego' == micro-formación, 'mantenimiento' == hábitos; None = mixto
+_NOTIF_KIND = {"habitos": "habitos", "mantenimiento": "habitos",
+               "micro": "micro", "riego": "micro", "mixto": None}
+
+def notif_siguiente(kind:str|None, last:int, dia:int) -> int:
+    # Función pura: siguiente id para un usuario con tipo kind y último id last
+    # el día dia (ordinal). "mixto" alterna: día par → hábitos, impar → micro.
+    # Sin asignaciones por llamada: el despachador la usa fila a fila.
+    tabla = _NOTIF_KIND.get(kind, 0)
+    if tabla == 0:
+        tabla = _NOTIF_KIND.get((kind or "mixto").strip().lower())
+    if tabla is None:
+        tabla = "habitos" if dia % 2 == 0 else "micro"
+    nxt = _NOTIF_SIG[tabla].get(last)
+    if nxt is not None:
+        return nxt
+    ids = _NOTIF_ROT[tabla]
+    return ids[(dia - 1) % len(ids)]
+
+def _next_index_for(s:dict) -> int:
+    return notif_siguiente(s.get("notify_kind"), int(s.get("notif_last_idx", -1)),
+                           datetime.now(TZ).toordinal())
 
 def _save_last_idx(uid:int, idx:int):
-    conn = db()
-    conn.execute("UPDATE user_settings SET notif_last_idx=? WHERE user_id=?", (idx, uid))
-    conn.commit(); conn.close()
-
-def _notif_build_more_kb(nid:int) -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([[InlineKeyboardButton("Ver más", callback_data=f"n:more:{nid}")]])
+    with db_write() as conn:
+        conn.execute("UPDATE user_settings SET notif_last_idx=? WHERE user_id=?", (idx, uid))
+    invalidate_user_ctx(uid)
 
-def _notif_panel_keyboard(uid:int) -> InlineKeyboardMarkup:
-    s = get_settings(uid)
+def _notif_panel_keyboard(s:dict) -> InlineKeyboardMarkup:
     enabled = bool(s["notify_enabled"])
     onoff_text = ("🟢 Activar" if not enabled else "🔴 Desactivar")
 
@@ -1372,55 +4066,172 @@ def _notif_panel_keyboard(uid:int) -> InlineKeyboardMarkup:
 
 async def notificaciones(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.message.from_user.id
+    s = await _notif_estado(uid)
     await update.message.reply_text(
-        notif_status_text(uid),
-        reply_markup=_notif_panel_keyboard(uid)
+        notif_status_text(s),
+        reply_markup=_notif_panel_keyboard(s)
     )
 
-async def _send_enriched_notification(context: ContextTypes.DEFAULT_TYPE, uid:int):
-    s = get_settings(uid)
-    if not s or not s.get("notify_enabled"):
-        return
-    idx = _next_index_for(uid)
-    tup = next((t for t in NOTIFICATIONS if t[0]==idx), None)
-    if not tup:
-        return
-    nid, block, title, body = tup
-    head = _notif_block_line(block, title)
+async def _enviar_notif(context: ContextTypes.DEFAULT_TYPE, uid:int, nid:int, prio:int=PRIO_INTERACTIVO):
     await context.bot.send_message(
         chat_id=uid,
-        text=head,
+        text=NOTIF_HEAD[nid],
         parse_mode="HTML",
-        reply_markup=_notif_build_more_kb(nid)
+        reply_markup=NOTIF_KB[nid],
+        rate_limit_args=prio,
     )
-    _save_last_idx(uid, idx)
-
-async def notify_callback(context: ContextTypes.DEFAULT_TYPE):
-    uid = context.job.chat_id
-    await _send_enriched_notification(context, uid)
 
-def schedule_user_notifications(app, uid:int):
-    # Limpia previas
-    for job in app.job_queue.get_jobs_by_name(f"notif_{uid}"):
-        job.schedule_removal()
-    s = get_settings(uid)
+async def _send_enriched_notification(context: ContextTypes.DEFAULT_TYPE, uid:int):
+    s = await run_db(get_settings, uid)
     if not s or not s.get("notify_enabled"):
         return
-    t = parse_hhmm(s.get("notify_time") or "08:00")
-    name = f"notif_{uid}"
-    freq = (s.get("notify_freq") or "diaria").lower()
-    if freq == "diaria":
-        app.job_queue.run_daily(notify_callback, time=t, chat_id=uid, name=name)
-    else:
-        # semanal en el día actual de la semana
-        weekday = datetime.now().weekday()
-        app.job_queue.run_daily(notify_callback, time=t, days=(weekday,), chat_id=uid, name=name)
-
-async def _refresh_notif_panel(q, context, uid: int):
+    nid = _next_index_for(s)
+    await _enviar_notif(context, uid, nid)
+    await run_db(_save_last_idx, uid, nid)
+
+# --- Despacho por franja con registro de entregas ---
+# Cada lote enviado se persiste en una sola transacción (run_write): rotación
+# (notif_last_idx), entregas (día, franja, usuario) y el punto de avance. Tras
+# una caída, el despacho se reanuda desde ultimo_uid y la consulta de la
+# franja salta a quien ya tiene entrega registrada; solo el lote en vuelo
+# puede repetirse.
+_despachos_activos: set = set()
+
+def _despacho_iniciar(fecha:str, franja:str) -> tuple[int, bool]:
+    with db_write() as conn:
+        conn.execute("""
+            INSERT INTO notif_despacho(dia, franja, inicio) VALUES (?,?,?)
+            ON CONFLICT(dia, franja) DO NOTHING""",
+            (fecha, franja, datetime.now().isoformat(timespec="seconds")))
+        ultimo, fin = conn.execute("SELECT ultimo_uid, fin FROM notif_despacho WHERE dia=? AND franja=?",
+                                   (fecha, franja)).fetchone()
+    return ultimo, fin is not None
+
+def _tx_notif_lote(conn, fecha:str, franja:str, entregas:list[tuple], ultimo_uid:int):
+    # entregas: [(user_id, nid)] enviadas con éxito en el lote
+    conn.executemany("UPDATE user_settings SET notif_last_idx=? WHERE user_id=?",
+                     [(nid, uid) for uid, nid in entregas])
+    conn.executemany("INSERT OR IGNORE INTO notif_entregas(dia, franja, user_id, nid) VALUES (?,?,?,?)",
+                     [(fecha, franja, uid, nid) for uid, nid in entregas])
+    conn.execute("UPDATE notif_despacho SET ultimo_uid=?, enviadas=enviadas+? WHERE dia=? AND franja=?",
+                 (ultimo_uid, len(entregas), fecha, franja))
+
+def _despacho_cerrar(fecha:str, franja:str):
+    corte = (date.fromisoformat(fecha) - timedelta(days=NOTIFY_LOG_DIAS)).isoformat()
+    with db_write() as conn:
+        conn.execute("UPDATE notif_despacho SET fin=? WHERE dia=? AND franja=?",
+                     (datetime.now().isoformat(timespec="seconds"), fecha, franja))
+        conn.execute("DELETE FROM notif_entregas WHERE dia<?", (corte,))
+        conn.execute("DELETE FROM notif_despacho WHERE dia<?", (corte,))
+
+def notify_resumen() -> dict:
+    # Suscriptores por franja; recorre el índice parcial con el cursor, sin fetchall
+    with db_read() as conn:
+        return {t: n for t, n in conn.execute(SQL_NOTIFY_RESUMEN)}
+
+def get_despachos_pendientes(fecha:str) -> list[tuple]:
+    with db_read() as conn:
+        return conn.execute(SQL_DESPACHO_PENDIENTES, (fecha,)).fetchall()
+
+async def _despachar(context: ContextTypes.DEFAULT_TYPE, slot:str, fecha:str):
+    # Diarios de esa hora + semanales cuyo día es fecha. Se pagina por user_id
+    # para no cargar todos los suscriptores en memoria.
+    if (fecha, slot) in _despachos_activos:
+        return
+    _despachos_activos.add((fecha, slot))
+    try:
+        after, terminado = await run_db(_despacho_iniciar, fecha, slot)
+        if terminado:
+            return
+        d = date.fromisoformat(fecha)
+        weekday, dia = d.weekday(), d.toordinal()
+        t0 = time.perf_counter()
+        enviadas, errores, reanudado = 0, 0, after
+        while True:
+            page = await run_db(get_notify_slot_page, slot, weekday, fecha, after, NOTIFY_PAGE)
+            if not page:
+                break
+            for k in range(0, len(page), NOTIFY_BATCH):
+                lote = page[k:k + NOTIFY_BATCH]
+                nids = [notif_siguiente(kind, last, dia) for _, kind, last in lote]
+                res = await asyncio.gather(*(
+                    _enviar_notif(context, r[0], nid, PRIO_MASIVO) for r, nid in zip(lote, nids)),
+                    return_exceptions=True)
+                entregas = [(r[0], nid) for r, nid, e in zip(lote, nids, res) if not isinstance(e, Exception)]
+                after = lote[-1][0]
+                await run_write(_tx_notif_lote, fecha, slot, entregas, after)
+                for uid, _ in entregas:
+                    invalidate_user_ctx(uid)
+                enviadas += len(entregas)
+                errores += len(lote) - len(entregas)
+            if len(page) < NOTIFY_PAGE:
+                break
+        await run_db(_despacho_cerrar, fecha, slot)
+        if enviadas or errores:
+            print(f"[notif] {slot}: {enviadas} enviadas, {errores} errores "
+                  f"en {time.perf_counter() - t0:.1f} s" + (f" (reanudado tras user_id={reanudado})" if reanudado else ""))
+    finally:
+        _despachos_activos.discard((fecha, slot))
+
+async def notify_slot_job(context: ContextTypes.DEFAULT_TYPE):
+    # Un job por franja (run_daily); data = "HH:MM"
+    await _despachar(context, context.job.data, datetime.now(TZ).date().isoformat())
+
+async def _reanudar_job(context: ContextTypes.DEFAULT_TYPE):
+    slot, fecha = context.job.data
+    await _despachar(context, slot, fecha)
+
+def schedule_notification_slots(app) -> dict:
+    # Coste de arranque O(franjas): los suscriptores se leen al disparar
+    t0 = time.perf_counter()
+    for slot in NOTIFY_SLOTS:
+        name = f"notif_slot_{slot}"
+        if not app.job_queue.get_jobs_by_name(name):
+            app.job_queue.run_daily(notify_slot_job, time=parse_hhmm(slot), name=name, data=slot)
+    # Despachos de hoy que quedaron a medias (caída a mitad de envío)
+    fecha = datetime.now(TZ).date().isoformat()
+    for slot, ultimo in get_despachos_pendientes(fecha):
+        print(f"[notif] reanudando franja {slot} de {fecha} tras user_id={ultimo}")
+        app.job_queue.run_once(_reanudar_job, when=5, data=(slot, fecha), name=f"notif_reanudar_{slot}")
+    t_prog = time.perf_counter() - t0
+    resumen = notify_resumen()
+    t = time.perf_counter() - t0
+    franjas = ", ".join(f"{slot} {resumen.get(slot, 0)}" for slot in NOTIFY_SLOTS)
+    print(f"[notif] {len(NOTIFY_SLOTS)} franjas programadas en {t_prog*1000:.1f} ms "
+          f"({sum(resumen.values())} suscriptores: {franjas}; recuento en {(t - t_prog)*1000:.1f} ms)")
+    return {"t_programar": t_prog, "t_total": t, "suscriptores": sum(resumen.values())}
+
+def bench_arranque(n:int=50_000) -> dict:
+    # Con n suscriptores sintéticos en una BD temporal (db_temporal, nunca la
+    # real) mide el arranque de notificaciones por franjas frente al antiguo
+    # recorrido usuario a usuario (lista de ids + get_settings por cada uno).
+    class _Jobs:
+        def __init__(self): self.jobs = []
+        def get_jobs_by_name(self, name): return []
+        def run_daily(self, cb, **kw): self.jobs.append(kw["name"])
+        def run_once(self, cb, **kw): self.jobs.append(kw["name"])
+    with db_temporal():
+        with db_write() as conn:
+            conn.executemany("""
+                INSERT INTO user_settings(user_id, notify_enabled, notify_time, notify_kind, notify_freq, notify_weekday)
+                VALUES (?,1,?,?,?,?)""",
+                ((u, NOTIFY_SLOTS[u % len(NOTIFY_SLOTS)], ("habitos", "micro", "mixto")[u % 3],
+                  "semanal" if u % 5 == 0 else "diaria", u % 7) for u in range(1, n + 1)))
+        jq = _Jobs()
+        r = schedule_notification_slots(type("App", (), {"job_queue": jq})())
+        t0 = time.perf_counter()
+        with db_read() as conn:
+            antiguos = [row[0] for row in conn.execute("SELECT user_id FROM user_settings WHERE notify_enabled=1").fetchall()]
+        for uid in antiguos:
+            get_settings(uid)
+        t_antiguo = time.perf_counter() - t0
+    return dict(r, n=n, jobs=len(jq.jobs), t_antiguo=t_antiguo)
+
+async def _refresh_notif_panel(q, context, s: dict):
     try:
         await q.edit_message_text(
-            notif_status_text(uid),
-            reply_markup=_notif_panel_keyboard(uid)
+            notif_status_text(s),
+            reply_markup=_notif_panel_keyboard(s)
         )
     except Exception:
         try:
@@ -1429,46 +4240,107 @@ async def _refresh_notif_panel(q, context, uid: int):
             pass
         await context.bot.send_message(
             chat_id=q.message.chat_id,
-            text=notif_status_text(uid),
-            reply_markup=_notif_panel_keyboard(uid)
+            text=notif_status_text(s),
+            reply_markup=_notif_panel_keyboard(s)
         )
 
+# Borradores del panel /notificaciones: cada toque cambia el estado en memoria
+# y repinta el panel; los cambios se guardan en una sola escritura tras
+# NOTIF_PANEL_QUIET s sin toques, al pulsar "✅ OK" o al apagar el bot.
+_NOTIF_CAMPOS = ("notify_enabled", "notify_time", "notify_kind", "notify_freq")
+_notif_borradores: dict = {}    # uid → {"orig", "s", "hasta"}
+# Serializa creación y guardado del borrador de cada usuario: sin él dos toques
+# seguidos crean dos borradores, o un toque durante el guardado se pierde
+_notif_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def _notif_lock(uid:int) -> asyncio.Lock:
+    lk = _notif_locks.get(uid)
+    if lk is None:
+        lk = _notif_locks[uid] = asyncio.Lock()
+    return lk
+
+async def _notif_estado(uid:int) -> dict:
+    b = _notif_borradores.get(uid)
+    return b["s"] if b else await run_db(get_settings, uid)
+
+def _notif_cambios(b:dict) -> dict:
+    return {k: b["s"][k] for k in _NOTIF_CAMPOS if b["s"][k] != b["orig"][k]}
+
+def _notif_guardar(uid:int, cambios:dict):
+    # Las semanales quedan ancladas al día en que se tocó el panel
+    if cambios:
+        save_settings(uid, **cambios, notify_weekday=datetime.now(TZ).weekday())
+
+async def _notif_flush(uid:int):
+    async with _notif_lock(uid):
+        b = _notif_borradores.get(uid)
+        if b:
+            # Se retira solo tras guardar: un toque concurrente espera al lock
+            # y parte de lo ya guardado en vez de un borrador obsoleto
+            await run_db(_notif_guardar, uid, _notif_cambios(b))
+            _notif_borradores.pop(uid, None)
+
+async def _notif_flush_job(context: ContextTypes.DEFAULT_TYPE):
+    uid = context.job.data
+    b = _notif_borradores.get(uid)
+    if not b:
+        return
+    resto = b["hasta"] - time.monotonic()
+    if resto > 0:               # hubo toques después de programar: esperar el resto
+        context.job_queue.run_once(_notif_flush_job, when=resto, data=uid, name=f"notif_panel_{uid}")
+        return
+    await _notif_flush(uid)
+
+def notif_flush_all():
+    # Apagado: guarda los borradores pendientes sin esperar al periodo de calma
+    for uid, b in list(_notif_borradores.items()):
+        try:
+            _notif_guardar(uid, _notif_cambios(b))
+        except Exception as e:
+            print(f"[WARN] no se pudo guardar el panel de notificaciones de {uid}:", e)
+    _notif_borradores.clear()
+
 async def notif_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q   = update.callback_query
     uid = q.from_user.id
     await q.answer()
     data = q.data or ""
 
+    campo, valor = None, None
     if data == "notif_toggle":
-        s = get_settings(uid)
-        save_settings(uid, notify_enabled=0 if s["notify_enabled"] else 1)
-        schedule_user_notifications(context.application, uid)
-        await _refresh_notif_panel(q, context, uid); return
-
-    if data.startswith("notif_time:"):
-        hhmm = data.split(":", 1)[1]
-        save_settings(uid, notify_time=hhmm)
-        schedule_user_notifications(context.application, uid)
-        await _refresh_notif_panel(q, context, uid); return
-
-    if data.startswith("notif_kind:"):
-        kind = data.split(":", 1)[1]
-        save_settings(uid, notify_kind=kind)
-        schedule_user_notifications(context.application, uid)
-        await _refresh_notif_panel(q, context, uid); return
-
-    if data.startswith("notif_freq:"):
-        freq = data.split(":", 1)[1]
-        save_settings(uid, notify_freq=freq)
-        schedule_user_notifications(context.application, uid)
-        await _refresh_notif_panel(q, context, uid); return
+        campo = "notify_enabled"
+    elif data.startswith(("notif_time:", "notif_kind:", "notif_freq:")):
+        pref, valor = data.split(":", 1)
+        campo = {"notif_time": "notify_time", "notif_kind": "notify_kind", "notif_freq": "notify_freq"}[pref]
+
+    if campo:
+        async with _notif_lock(uid):
+            b = _notif_borradores.get(uid)
+            if b is None:
+                orig = await run_db(get_settings, uid)
+                b = _notif_borradores[uid] = {"orig": orig, "s": dict(orig), "hasta": 0.0}
+            s = b["s"]
+            if campo == "notify_enabled":
+                valor = 0 if s["notify_enabled"] else 1
+            nuevo = s[campo] != valor
+            s[campo] = valor
+            pendiente = b["hasta"] > 0
+            b["hasta"] = time.monotonic() + NOTIF_PANEL_QUIET
+            s = dict(s)         # copia para repintar fuera del lock
+        if not pendiente:
+            context.job_queue.run_once(_notif_flush_job, when=NOTIF_PANEL_QUIET, data=uid, name=f"notif_panel_{uid}")
+        if nuevo:               # pulsar la opción ya marcada no repinta
+            await _refresh_notif_panel(q, context, s)
+        return
 
     if data == "notif_test_now":
+        await _notif_flush(uid)
         await _send_enriched_notification(context, uid)
         await q.answer("Enviada una notificación de prueba.", show_alert=False)
         return
 
     if data == "notif_ok":
+        await _notif_flush(uid)
         try:
             await q.delete_message()
         except Exception:
@@ -1488,11 +4360,9 @@ async def notif_more_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         nid = int(data.split(":")[2])
     except Exception:
         return
-    tup = next((t for t in NOTIFICATIONS if t[0]==nid), None)
-    if not tup:
+    full = NOTIF_FULL.get(nid)
+    if full is None:
         return
-    _id, block, title, body = tup
-    full = f"{_notif_block_line(block, title)}\n\n{body}"
     try:
         await q.edit_message_text(full, parse_mode="HTML")
     except Exception:
@@ -1505,30 +4375,7 @@ import io  # Asegúrate de tener este import arriba del todo
 
 async def exportar_sistema_txt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.message.from_user.id
-    conn = db()
-
-    est = conn.execute("""
-        SELECT fecha, presion, filtros, COALESCE(valvulas,''), COALESCE(goteros,''), COALESCE(nota,'')
-          FROM sys_estado
-         WHERE user_id=?
-         ORDER BY id DESC LIMIT 10
-    """, (uid,)).fetchall()
-
-    mant = conn.execute("""
-        SELECT fecha, tarea, COALESCE(comentario,'')
-          FROM sys_mant
-         WHERE user_id=?
-         ORDER BY id DESC LIMIT 10
-    """, (uid,)).fetchall()
-
-    alr = conn.execute("""
-        SELECT fecha, descripcion, COALESCE(sector,''), COALESCE(resuelta,0)
-          FROM sys_alerta
-         WHERE user_id=?
-         ORDER BY id DESC LIMIT 10
-    """, (uid,)).fetchall()
-
-    conn.close()
+    est, mant, alr = await run_db(get_sistema, uid, 10)
 
     # Construir contenido
     lines = []
@@ -1598,7 +4445,7 @@ async def reset_datos(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "⚠️ *Reiniciar datos*\n"
         "Elige qué quieres borrar para este usuario.\n\n"
         "• 🧹 *Solo registros*: Riegos + Estado + Mantenimiento + Alertas\n"
-        "• 🧨 *Todo*: Lo anterior *+ Perfil + Ajustes*\n\n"
+        "• 🧨 *Todo*: Lo anterior *+ Perfil + Ajustes + Sectores*\n\n"
         "_Acción irreversible._"
     )
     kb = InlineKeyboardMarkup([
@@ -1623,31 +4470,17 @@ async def reset_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Ejecutar borrado
-    conn = db()
     try:
         if data == "reset_do:reg":
-            conn.execute("DELETE FROM logs WHERE user_id=?", (uid,))
-            conn.execute("DELETE FROM sys_estado WHERE user_id=?", (uid,))
-            conn.execute("DELETE FROM sys_mant WHERE user_id=?", (uid,))
-            conn.execute("DELETE FROM sys_alerta WHERE user_id=?", (uid,))
-            conn.commit()
+            await run_db(reset_user, uid, todo=False)
             msg = "🧹 Listo. Se han borrado *riegos* y *registros de sistema*."
         elif data == "reset_do:all":
-            conn.execute("DELETE FROM logs WHERE user_id=?", (uid,))
-            conn.execute("DELETE FROM sys_estado WHERE user_id=?", (uid,))
-            conn.execute("DELETE FROM sys_mant WHERE user_id=?", (uid,))
-            conn.execute("DELETE FROM sys_alerta WHERE user_id=?", (uid,))
-            conn.execute("DELETE FROM profiles WHERE user_id=?", (uid,))
-            conn.execute("DELETE FROM user_settings WHERE user_id=?", (uid,))
-            conn.commit()
+            await run_db(reset_user, uid, todo=True)
             msg = "🧨 Reinicio completo. Se han borrado *registros*, *perfil* y *ajustes*."
         else:
             msg = "Nada que hacer."
     except Exception as e:
-        conn.rollback()
         msg = f"❌ Error al borrar: {e}"
-    finally:
-        conn.close()
 
     try:
         await q.edit_message_text(msg, parse_mode="Markdown")
@@ -1660,8 +4493,57 @@ async def reset_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # =========================
 # App
 # =========================
+async def _checkpoint_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        busy, log_pages, ckpt_pages = await run_db(db_checkpoint)
+        if busy:
+            print(f"[db] checkpoint parcial: {ckpt_pages}/{log_pages} páginas")
+    except Exception as e:
+        print("[WARN] checkpoint WAL fallido:", e)
+
+async def _ref_reload_job(context: ContextTypes.DEFAULT_TYPE):
+    # Lectura/parseo de CSV en un hilo: el event loop sigue atendiendo mensajes
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, ref_reload)
+    except Exception as e:
+        print("[WARN] recarga de tablas de referencia fallida:", e)
+
+async def _stats_job(context: ContextTypes.DEFAULT_TYPE):
+    st = user_cache_stats()
+    print(f"[cache] usuarios: {st['hits']} hits / {st['misses']} misses "
+          f"({st['hit_ratio']:.0%}), {st['invalidations']} invalidaciones, {st['size']} en memoria")
+    ss = sector_cache_stats()
+    print(f"[cache] sectores: {ss['hits']} hits / {ss['misses']} misses, "
+          f"{ss['invalidations']} invalidaciones, {ss['size']} en memoria")
+    rs = ref_stats()
+    print(f"[ref] tablas {rs['version']}: {rs['reloads']} recargas, {rs['rejected']} rechazadas")
+    es = ENVIO.stats()
+    print(f"[envio] {es['enviados']} enviados, {es['fallidos']} fallidos, {es['retry_after']} RetryAfter, "
+          f"cola {es['cola']} (máx {es['cola_max']}), espera media {es['espera_media']*1000:.0f} ms "
+          f"(p95 {es['espera_p95']*1000:.0f} ms), envío medio {es['envio_medio']*1000:.0f} ms")
+    t = _telemetry_stats
+    print(f"[logger] telemetría: {t['sent']} enviados, {t['replayed']} reenviados, "
+          f"{t['spilled']} al outbox, {_tq.qsize()} en cola")
+
+async def _on_init(app):
+    telemetry_start()
+
+async def _on_shutdown(app):
+    await run_db(notif_flush_all)
+    await asyncio.get_running_loop().run_in_executor(None, telemetry_stop)
+    write_queue_drain()
+    _DB_EXECUTOR.shutdown(wait=True)
+    db_close_all()
+
 def build_app():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    migrate_db()
+    ok, bad = backfill_fecha_dia()
+    if ok or bad:
+        print(f"[db] backfill logs.fecha_dia: {ok} filas, {bad} sin interpretar")
+    if np is None:
+        print("[INFO] numpy no instalado: cálculos por lotes en Python puro (mismo resultado, más lento)")
+    app = (ApplicationBuilder().token(BOT_TOKEN).rate_limiter(ENVIO)
+           .post_init(_on_init).post_shutdown(_on_shutdown).build())
 
     # Menús secciones
     app.add_handler(CommandHandler(["start"], start))
@@ -1709,6 +4591,22 @@ def build_app():
     app.add_handler(perfil_avz_conv)
 
     app.add_handler(CommandHandler("perfil_ver", perfil_ver))
+    app.add_handler(CommandHandler("sectores", sectores))
+
+    sector_conv = ConversationHandler(
+        entry_points=[CommandHandler("sector", sector_cmd)],
+        states={
+            SECTOR_NOMBRE: [MessageHandler(filters.TEXT & ~filters.COMMAND, sector_nombre)],
+            SECTOR_CULTIVO:[MessageHandler(filters.TEXT & ~filters.COMMAND, sector_cultivo)],
+            SECTOR_AREA:   [MessageHandler(filters.TEXT & ~filters.COMMAND, sector_area)],
+            SECTOR_CAUDAL: [MessageHandler(filters.TEXT & ~filters.COMMAND, sector_caudal)],
+            SECTOR_COPA:   [MessageHandler(filters.TEXT & ~filters.COMMAND, sector_copa)],
+            SECTOR_MARCO:  [MessageHandler(filters.TEXT & ~filters.COMMAND, sector_marco)],
+        },
+        fallbacks=[CommandHandler("cancelar", cancelar)],
+        allow_reentry=True,
+    )
+    app.add_handler(sector_conv)
 
     # RIEGO
     riego_conv = ConversationHandler(
@@ -1736,6 +4634,36 @@ def build_app():
     )
     app.add_handler(eto_rapida_conv)
 
+    riego_todos_conv = ConversationHandler(
+        entry_points=[CommandHandler("riego_todos", riego_todos_cmd)],
+        states={
+            RIEGO_ETO:    [MessageHandler(filters.TEXT & ~filters.COMMAND, riego_eto)],
+            RIEGO_STRESS: [MessageHandler(filters.TEXT & ~filters.COMMAND, riego_todos_calc)],
+        },
+        fallbacks=[CommandHandler("cancelar", cancelar)],
+        allow_reentry=True,
+    )
+    app.add_handler(riego_todos_conv)
+
+    estacion_conv = ConversationHandler(
+        entry_points=[CommandHandler("estacion", estacion_cmd)],
+        states={ESTACION_ELEGIR: [MessageHandler(filters.TEXT & ~filters.COMMAND, estacion_elegir)]},
+        fallbacks=[CommandHandler("cancelar", cancelar)],
+        allow_reentry=True,
+    )
+    app.add_handler(estacion_conv)
+
+    turnos_conv = ConversationHandler(
+        entry_points=[CommandHandler("turnos", turnos), CommandHandler("ajustes_turnos", ajustes_turnos)],
+        states={
+            TURNOS_CAUDAL: [MessageHandler(filters.TEXT & ~filters.COMMAND, turnos_caudal)],
+            TURNOS_VALLE:  [MessageHandler(filters.TEXT & ~filters.COMMAND, turnos_valle)],
+        },
+        fallbacks=[CommandHandler("cancelar", cancelar)],
+        allow_reentry=True,
+    )
+    app.add_handler(turnos_conv)
+
     # Registro de riegos (SIN cultivo)
     reg_conv = ConversationHandler(
         entry_points=[CommandHandler("registrar", registrar)],
@@ -1798,6 +4726,8 @@ def build_app():
 
     # Mi Agua + Ajustes Agua
     app.add_handler(CommandHandler("mi_agua", mi_agua))
+    app.add_handler(CommandHandler("temporada", temporada))
+    app.add_handler(CommandHandler("balance", balance))
     ajustes_agua_conv = ConversationHandler(
         entry_points=[CommandHandler("ajustes_agua", ajustes_agua_start)],
         states={
@@ -1814,44 +4744,484 @@ def build_app():
     app.add_handler(CallbackQueryHandler(notif_cb, pattern=r"^notif_(toggle|time:.*|kind:.*|freq:.*|test_now|ok)$"))
     app.add_handler(CallbackQueryHandler(notif_more_cb, pattern=r"^n:more:\d+$"))
 
-    # Reprogramar notificaciones activas al arrancar
-    try:
-        conn = db()
-        uids = [r[0] for r in conn.execute("SELECT user_id FROM user_settings WHERE notify_enabled=1").fetchall()]
-        conn.close()
-        for uid in uids:
-            schedule_user_notifications(app, uid)
-    except Exception as e:
-        print("[WARN] No se pudieron programar notificaciones al inicio:", e)
+    # Checkpoint periódico del WAL
+    if DB_CHECKPOINT_SECS > 0 and DB_JOURNAL_MODE.upper() == "WAL":
+        app.job_queue.run_repeating(_checkpoint_job, interval=DB_CHECKPOINT_SECS,
+                                    first=DB_CHECKPOINT_SECS, name="db_checkpoint")
+
+    if STATS_LOG_SECS > 0:
+        app.job_queue.run_repeating(_stats_job, interval=STATS_LOG_SECS, first=STATS_LOG_SECS, name="stats")
+    if REF_RELOAD_SECS > 0:
+        app.job_queue.run_repeating(_ref_reload_job, interval=REF_RELOAD_SECS, first=REF_RELOAD_SECS, name="ref_reload")
+
+    # Un despachador por franja horaria (los suscriptores se leen al disparar)
+    schedule_notification_slots(app)
 
     return app
 
 # --- AgriWise: registro remoto en tu WordPress ---
+# log_event() solo encola: un hilo de fondo recoge hasta TELEMETRY_BATCH eventos
+# y hace un POST por evento (el endpoint admite uno por petición) sobre una
+# sesión keep-alive, reintenta con backoff y, si el endpoint no responde, guarda
+# los eventos en telemetry_outbox para reenviarlos al arrancar o cuando vuelva.
 import os, json, requests
+from requests.adapters import HTTPAdapter
 
 WEB_ENDPOINT = os.getenv("WEB_ENDPOINT", "https://domiperez.com/wp-json/agriwise/v1/log")
 API_KEY      = os.getenv("API_KEY", "AGRIWISE_3kF2p9L0_2025")
 
+TELEMETRY_BATCH        = int(os.getenv("TELEMETRY_BATCH", "50"))
+TELEMETRY_FLUSH_SECS   = float(os.getenv("TELEMETRY_FLUSH_SECS", "2"))
+TELEMETRY_RETRIES      = int(os.getenv("TELEMETRY_RETRIES", "3"))
+TELEMETRY_BACKOFF_SECS = float(os.getenv("TELEMETRY_BACKOFF_SECS", "0.5"))
+TELEMETRY_REPLAY_SECS  = float(os.getenv("TELEMETRY_REPLAY_SECS", "60"))
+TELEMETRY_QUEUE_MAX    = int(os.getenv("TELEMETRY_QUEUE_MAX", "10000"))
+TELEMETRY_TIMEOUT      = float(os.getenv("TELEMETRY_TIMEOUT", "6"))
+
+_tq        = queue.Queue(maxsize=TELEMETRY_QUEUE_MAX)
+_tq_thread = None
+_TQ_STOP   = object()
+_telemetry_stats = {"sent": 0, "spilled": 0, "replayed": 0, "failed_posts": 0}
+
+def _tx_outbox_add(conn, bodies:list[str]):
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn.executemany("INSERT INTO telemetry_outbox(created, body) VALUES (?,?)", [(now, b) for b in bodies])
+
+def _outbox_spill(bodies:list[str]):
+    if not bodies:
+        return
+    try:
+        write_behind(_tx_outbox_add, bodies).result()
+        _telemetry_stats["spilled"] += len(bodies)
+    except Exception as e:
+        print(f"[logger] no se pudo guardar en outbox ({len(bodies)} eventos): {e}")
+
+def _telemetry_session() -> requests.Session:
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+    session.mount("http://",  HTTPAdapter(pool_connections=1, pool_maxsize=2))
+    session.headers.update({"X-AgriWise-Key": API_KEY, "Content-Type": "application/json"})
+    return session
+
+def _post_event(session, body:str) -> bool:
+    delay = TELEMETRY_BACKOFF_SECS
+    for attempt in range(TELEMETRY_RETRIES + 1):
+        try:
+            r = session.post(WEB_ENDPOINT, data=body, timeout=TELEMETRY_TIMEOUT)
+            r.raise_for_status()
+            return True
+        except Exception as e:
+            _telemetry_stats["failed_posts"] += 1
+            if attempt == TELEMETRY_RETRIES:
+                print(f"[logger] fallo enviando evento: {e}")
+                return False
+            time.sleep(delay)
+            delay *= 2
+    return False
+
+def _ship(session, bodies:list[str]) -> list[str]:
+    # Devuelve los que no se enviaron: al primer fallo definitivo se asume caído
+    for i, body in enumerate(bodies):
+        if not _post_event(session, body):
+            return bodies[i:]
+        _telemetry_stats["sent"] += 1
+    return []
+
+def _outbox_replay(session) -> bool:
+    # Reenvía el outbox por bloques; True si quedó vacío
+    while True:
+        with db_read() as conn:
+            rows = conn.execute("SELECT id, body FROM telemetry_outbox ORDER BY id LIMIT ?",
+                                (TELEMETRY_BATCH,)).fetchall()
+        if not rows:
+            return True
+        sent_ids = []
+        for rid, body in rows:
+            if not _post_event(session, body):
+                break
+            sent_ids.append((rid,))
+        if sent_ids:
+            with db_write() as conn:
+                conn.executemany("DELETE FROM telemetry_outbox WHERE id=?", sent_ids)
+            _telemetry_stats["replayed"] += len(sent_ids)
+        if len(sent_ids) < len(rows):
+            return False
+
+def _telemetry_loop():
+    session = _telemetry_session()
+    try:
+        outbox_vacio = _outbox_replay(session)
+    except Exception as e:
+        print(f"[logger] no se pudo reenviar el outbox: {e}")
+        outbox_vacio = False
+    next_replay = time.monotonic() + TELEMETRY_REPLAY_SECS
+    stop = False
+    while not stop:
+        batch = []
+        try:
+            item = _tq.get(timeout=TELEMETRY_FLUSH_SECS)
+            if item is _TQ_STOP:
+                stop = True
+            else:
+                batch.append(item)
+        except queue.Empty:
+            pass
+        while not stop and len(batch) < TELEMETRY_BATCH:
+            try:
+                item = _tq.get_nowait()
+            except queue.Empty:
+                break
+            if item is _TQ_STOP:
+                stop = True
+                break
+            batch.append(item)
+
+        if stop:
+            # Apagado: lo pendiente va al outbox sin esperar a la red
+            while True:
+                try:
+                    item = _tq.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not _TQ_STOP:
+                    batch.append(item)
+            _outbox_spill(batch)
+            break
+
+        if batch:
+            pendientes = _ship(session, batch)
+            if pendientes:
+                _outbox_spill(pendientes)
+                outbox_vacio = False
+        if not outbox_vacio and time.monotonic() >= next_replay:
+            try:
+                outbox_vacio = _outbox_replay(session)
+            except Exception as e:
+                print(f"[logger] no se pudo reenviar el outbox: {e}")
+            next_replay = time.monotonic() + TELEMETRY_REPLAY_SECS
+    session.close()
+
+def telemetry_start():
+    global _tq_thread
+    if _tq_thread is None:
+        _tq_thread = threading.Thread(target=_telemetry_loop, name="agriwise-telemetry", daemon=True)
+        _tq_thread.start()
+
+def telemetry_stop():
+    global _tq_thread
+    if _tq_thread is not None:
+        _tq.put(_TQ_STOP)
+        _tq_thread.join()
+        _tq_thread = None
+
 def log_event(user_id, event, payload=None):
+    data = {
+        "user_id": str(user_id),
+        "event": str(event),
+        "payload": payload or {}
+    }
+    body = json.dumps(data)
     try:
-        data = {
-            "user_id": str(user_id),
-            "event": str(event),
-            "payload": payload or {}
-        }
-        headers = {"X-AgriWise-Key": API_KEY, "Content-Type": "application/json"}
-        r = requests.post(WEB_ENDPOINT, headers=headers, data=json.dumps(data), timeout=6)
-        r.raise_for_status()
+        _tq.put_nowait(body)
         return True
-    except Exception as e:
-        # Si falla el registro remoto, no paramos el bot
-        print(f"[logger] fallo enviando evento: {e}")
+    except queue.Full:
+        # Cola llena (endpoint muy lento): directo al outbox sin bloquear
+        write_behind(_tx_outbox_add, [body])
+        _telemetry_stats["spilled"] += 1
         return False
 
-if __name__ == "__main__":
+def check_telemetry(n:int=100, timeout:float=30.0) -> dict:
+    # Ejercita el envío contra un endpoint HTTP local (http.server) que cae y se
+    # recupera, con el outbox en una BD temporal (db_temporal):
+    #   1) arranque con outbox previo → se reenvía; n eventos con el endpoint arriba
+    #   2) endpoint caído: n eventos → backoff y al outbox
+    #   3) recuperado: el outbox se vacía (replay periódico) y n eventos más
+    #   4) caído y apagado inmediato: n eventos al outbox sin esperar a la red
+    #   5) rearranque con el endpoint arriba: el outbox se reenvía
+    # Cada evento debe acabar exactamente una vez en el servidor o en el outbox.
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    global WEB_ENDPOINT, TELEMETRY_BACKOFF_SECS, TELEMETRY_REPLAY_SECS, TELEMETRY_FLUSH_SECS, TELEMETRY_RETRIES
+    recibidos, caido, lock = [], [False], threading.Lock()
+
+    class _Endpoint(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if caido[0]:
+                self.send_response(503)
+            else:
+                with lock:
+                    recibidos.append(json.loads(body)["payload"]["i"])
+                self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        def log_message(self, *args):
+            pass
+
+    def outbox() -> list[int]:
+        with db_read() as conn:
+            return [json.loads(b)["payload"]["i"] for (b,) in conn.execute("SELECT body FROM telemetry_outbox")]
+
+    def esperar(cond, fase):
+        limite = time.monotonic() + timeout
+        while not cond():
+            if time.monotonic() > limite:
+                raise TimeoutError(f"fase {fase}: tiempo agotado ({len(recibidos)} recibidos, {len(outbox())} en outbox)")
+            time.sleep(0.02)
+
+    siguiente = [0]
+    def emitir(k):
+        for _ in range(k):
+            log_event(0, "check_telemetry", {"i": siguiente[0]})
+            siguiente[0] += 1
+
+    previo = (WEB_ENDPOINT, TELEMETRY_BACKOFF_SECS, TELEMETRY_REPLAY_SECS, TELEMETRY_FLUSH_SECS, TELEMETRY_RETRIES)
+    stats0 = dict(_telemetry_stats)
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _Endpoint)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    t0 = time.perf_counter()
+    try:
+        WEB_ENDPOINT = f"http://127.0.0.1:{srv.server_address[1]}/log"
+        TELEMETRY_BACKOFF_SECS, TELEMETRY_REPLAY_SECS, TELEMETRY_FLUSH_SECS, TELEMETRY_RETRIES = 0.01, 0.2, 0.05, 2
+        with db_temporal():
+            try:
+                previos = [json.dumps({"user_id": "0", "event": "check_telemetry", "payload": {"i": i}}) for i in range(n)]
+                write_behind(_tx_outbox_add, previos).result()
+                siguiente[0] = n
+                telemetry_start()
+                emitir(n)
+                esperar(lambda: len(recibidos) == 2 * n and not outbox(), 1)
+                caido[0] = True
+                emitir(n)
+                esperar(lambda: len(outbox()) == n, 2)
+                caido[0] = False
+                emitir(n)
+                esperar(lambda: len(recibidos) == 4 * n and not outbox(), 3)
+                caido[0] = True
+                emitir(n)
+                telemetry_stop()
+                en_outbox = outbox()
+                tras_apagado = len(recibidos) + len(en_outbox)
+                caido[0] = False
+                telemetry_start()
+                esperar(lambda: not outbox(), 5)
+                telemetry_stop()
+                en_outbox = outbox()
+            finally:
+                telemetry_stop()    # antes de volver a la BD real
+    finally:
+        srv.shutdown()
+        srv.server_close()
+        WEB_ENDPOINT, TELEMETRY_BACKOFF_SECS, TELEMETRY_REPLAY_SECS, TELEMETRY_FLUSH_SECS, TELEMETRY_RETRIES = previo
+    st = {k: _telemetry_stats[k] - stats0[k] for k in stats0}
+    total = siguiente[0]
+    return {"eventos": total, "recibidos": len(recibidos), "duplicados": len(recibidos) - len(set(recibidos)),
+            "perdidos": total - len(set(recibidos) | set(en_outbox)), "en_outbox": len(en_outbox),
+            "tras_apagado": tras_apagado, "t": time.perf_counter() - t0, **st}
+
+# =========================
+# CLI (tareas offline)
+# =========================
+def cli_migrate(args):
+    ver = migrate_db()
+    print(f"[db] {DB_PATH}: esquema en versión {ver}")
+
+def cli_backfill_fechas(args):
+    migrate_db()
+    ok, bad = backfill_fecha_dia(batch=args.batch, todo=args.todo)
+    print(f"[db] backfill logs.fecha_dia: {ok} filas, {bad} sin interpretar")
+
+def cli_rebuild_aggregates(args):
+    migrate_db()
+    rebuild_logs_mes(args.user)
+    rebuild_balance(args.user)
+    print("[db] logs_mes y balance_sector reconstruidos" + (f" para user_id={args.user}" if args.user else ""))
+
+def cli_bench_riego(args):
+    r = bench_riego(args.n)
+    print(f"[bench] calc_riego × {r['n']}: bucle {r['t_loop']:.3f} s · lote {r['t_batch']:.3f} s "
+          f"({'numpy' if r['numpy'] else 'python'}, x{r['t_loop']/max(r['t_batch'],1e-9):.1f}) · "
+          f"diferencias: {r['mismatches']}")
+    if r["mismatches"]:
+        raise SystemExit(1)
+
+def cli_bench_turnos(args):
+    r = bench_turnos(args.n, args.granjas)
+    print(f"[bench] plan_turnos × {r['granjas']} fincas de {r['n']} sectores: "
+          f"medio {r['t_medio']*1000:.1f} ms · máx {r['t_max']*1000:.1f} ms · "
+          f"bombeo/cota inferior {r['ratio_medio']:.3f} (peor {r['ratio_max']:.3f})")
+    if r["t_max"] > 1.0:
+        raise SystemExit(1)
+
+def cli_bench_envio(args):
+    r = bench_envio(args.mensajes, args.chats, args.interactivos, args.rps)
+    gap = f"{r['gap_chat']:.2f} s" if r["gap_chat"] is not None else "—"
+    print(f"[bench] envío de {r['n']} notificaciones a {args.chats} chats ({args.rps:g}/s): {r['t']:.1f} s · "
+          f"entregados {r['entregados']}, perdidos {r['perdidos']}, {r['retry_after']} RetryAfter · "
+          f"pico {r['pico_1s']}/s · separación mín. por chat {gap} · "
+          f"interactivo máx. {r['inter_max']*1000:.0f} ms")
+    if (r["perdidos"] or r["pico_1s"] > args.rps + SEND_BURST
+            or (r["gap_chat"] is not None and r["gap_chat"] < SEND_CHAT_SECS * 0.95)):
+        raise SystemExit(1)
+
+def cli_bench_arranque(args):
+    r = bench_arranque(args.usuarios)
+    print(f"[bench] arranque de notificaciones con {r['suscriptores']} suscriptores: {r['jobs']} jobs en "
+          f"{r['t_total']*1000:.1f} ms · antes (ids + get_settings por usuario, sin crear jobs) {r['t_antiguo']:.2f} s")
+    if r["jobs"] != len(NOTIFY_SLOTS) or r["t_total"] > 1.0:
+        raise SystemExit(1)
+
+def cli_check_telemetry(args):
+    try:
+        r = check_telemetry(args.eventos)
+    except TimeoutError as e:
+        print(f"[logger] {e}")
+        raise SystemExit(1)
+    print(f"[logger] telemetría contra endpoint local: {r['eventos']} eventos en {r['t']:.1f} s · "
+          f"recibidos {r['recibidos']} ({r['sent']} directos, {r['replayed']} reenviados del outbox) · "
+          f"{r['spilled']} al outbox, {r['failed_posts']} POST fallidos · "
+          f"perdidos {r['perdidos']}, duplicados {r['duplicados']}, en outbox al final {r['en_outbox']}")
+    if (r["perdidos"] or r["duplicados"] or r["en_outbox"] or r["recibidos"] != r["eventos"]
+            or r["tras_apagado"] != r["eventos"] or not r["failed_posts"]):
+        raise SystemExit(1)
+
+def cli_check_plans(args):
+    migrate_db()
+    bad = check_query_plans()
+    for name, detail in bad:
+        print(f"[plan] {name}: {detail}")
+    print(f"[plan] {len(HOT_QUERIES)} consultas revisadas, {len(bad)} sin índice")
+    if bad:
+        raise SystemExit(1)
+
+def cli_import_eto(args):
+    migrate_db()
+    t0 = time.perf_counter()
+    try:
+        st = import_eto(args.ficheros, args.estacion, args.batch)
+    except (OSError, ValueError) as e:
+        print(f"[eto] importación interrumpida: {e}")
+        raise SystemExit(1)
+    print(f"[eto] {st['filas']} días de {st['estaciones']} estaciones desde {st['ficheros']} ficheros "
+          f"en {time.perf_counter() - t0:.2f} s ({st['descartadas']} filas descartadas)")
+
+def cli_bench_eto(args):
+    r = bench_eto(args.estaciones, args.anios)
+    print(f"[bench] import-eto {r['estaciones']} estaciones × {args.anios} años: {r['filas']} filas en "
+          f"{r['t_import']:.2f} s ({r['filas']/max(r['t_import'],1e-9):,.0f} filas/s) · "
+          f"consulta /riego {r['t_lookup']*1000:.2f} ms")
+    if r["filas"] != r["esperadas"] or r["descartadas"] or not r["media_ok"] or r["t_import"] > 10.0:
+        raise SystemExit(1)
+
+def cli_import_horario(args):
+    migrate_db()
+    t0 = time.perf_counter()
+    try:
+        st = import_horario(args.ficheros, args.lat, args.alt, args.estacion, args.altura_viento, args.batch)
+    except (OSError, ValueError) as e:
+        print(f"[eto] importación interrumpida: {e}")
+        raise SystemExit(1)
+    print(f"[eto] Penman-Monteith: {st['horas']} registros → {st['filas']} días de {st['estaciones']} estaciones "
+          f"en {time.perf_counter() - t0:.2f} s ({st['descartadas']} filas descartadas, "
+          f"{st['dias_incompletos']} días incompletos, {st['rs_estimada']} con Rs estimada, "
+          f"{st['u2_defecto']} con viento por defecto)")
+
+def cli_check_eto(args):
+    fallos = 0
+    for nombre, valor, esperado, tol in check_eto():
+        ok = abs(valor - esperado) <= tol
+        fallos += not ok
+        print(f"[eto] {'OK ' if ok else 'MAL'} {nombre}: {valor:.4g} (FAO-56: {esperado} ± {tol})")
+    if fallos:
+        raise SystemExit(1)
+
+def cli_bench_pm(args):
+    r = bench_pm(args.filas, args.estaciones, args.memoria)
+    mem = f" · pico {r['pico']/2**20:.1f} MiB" if r["pico"] is not None else ""
+    print(f"[bench] Penman-Monteith ({'numpy' if r['numpy'] else 'python'}): {r['horas']} registros horarios → "
+          f"{r['filas']} días en {r['t']:.2f} s ({r['horas']/max(r['t'],1e-9):,.0f} registros/s){mem}")
+    if r["descartadas"] or r["dias_incompletos"]:
+        raise SystemExit(1)
+
+def cli_check_ref(args):
+    # Valida los CSV de data/ tal como los cargaría la recarga en caliente
+    raw, version = _read_ref_files(REF_FILES)
+    try:
+        ref = build_ref(raw, version)
+    except ValueError as e:
+        print(f"[ref] tablas {version} NO válidas: {e}")
+        raise SystemExit(1)
+    print(f"[ref] tablas {version} válidas: {len(ref['kc_rows'])} fases Kc, "
+          f"{len(ref['kc_daily'])} cultivos, {len(ref['adj'])} ajustes, {len(ref['canopy'])} clases de copa")
+
+def run_bot():
     if not BOT_TOKEN:
         raise RuntimeError("Falta TELEGRAM_TOKEN en .env")
     app = build_app()
     print("AgriWise Bot arrancando…")
     app.run_polling()
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="main.py", description="AgriWise Bot")
+    sub = parser.add_subparsers(dest="cmd")
+    sub.add_parser("run", help="arranca el bot (por defecto)")
+    sub.add_parser("migrate", help="aplica migraciones de esquema pendientes y sale")
+    p = sub.add_parser("backfill-fechas", help="rellena logs.fecha_dia en registros antiguos")
+    p.add_argument("--batch", type=int, default=5000)
+    p.add_argument("--todo", action="store_true", help="revisa también las filas ya revisadas (no interpretables)")
+    p = sub.add_parser("rebuild-aggregates", help="recalcula logs_mes y balance_sector desde logs")
+    p.add_argument("--user", type=int, default=None)
+    p = sub.add_parser("bench-riego", help="compara calc_riego en bucle vs calc_riego_batch")
+    p.add_argument("--n", type=int, default=100_000)
+    p = sub.add_parser("bench-turnos", help="tiempo y calidad de plan_turnos en fincas sintéticas")
+    p.add_argument("--n", type=int, default=250)
+    p.add_argument("--granjas", type=int, default=20)
+    p = sub.add_parser("bench-envio", help="limitador de salida contra una Bot API falsa (ritmo, RetryAfter, prioridades)")
+    p.add_argument("--mensajes", type=int, default=300)
+    p.add_argument("--chats", type=int, default=200)
+    p.add_argument("--interactivos", type=int, default=20)
+    p.add_argument("--rps", type=float, default=SEND_RPS)
+    p = sub.add_parser("bench-arranque", help="tiempo de rehidratación de notificaciones con suscriptores sintéticos")
+    p.add_argument("--usuarios", type=int, default=50_000)
+    p = sub.add_parser("check-telemetry", help="envío de telemetría contra un endpoint local que cae y se recupera")
+    p.add_argument("--eventos", type=int, default=100, help="eventos por fase")
+    sub.add_parser("check-plans", help="EXPLAIN QUERY PLAN de las consultas calientes; sale con 1 si alguna hace SCAN")
+    sub.add_parser("check-ref", help="valida los CSV de referencia de data/; sale con 1 si no se podrían cargar")
+    p = sub.add_parser("import-eto", help="importa series diarias de ETo de estaciones (CSV)")
+    p.add_argument("ficheros", nargs="+")
+    p.add_argument("--estacion", default=None, help="código para ficheros sin columna de estación (por defecto, el nombre del fichero)")
+    p.add_argument("--batch", type=int, default=ETO_IMPORT_BATCH)
+    p = sub.add_parser("import-horario", help="calcula la ETo diaria (FAO-56 Penman-Monteith) de CSV horarios y la guarda")
+    p.add_argument("ficheros", nargs="+")
+    p.add_argument("--lat", type=float, required=True, help="latitud de la estación (grados, sur negativo)")
+    p.add_argument("--alt", type=float, required=True, help="altitud de la estación (m)")
+    p.add_argument("--estacion", default=None, help="código para ficheros sin columna de estación (por defecto, el nombre del fichero)")
+    p.add_argument("--altura-viento", type=float, default=2.0, help="altura del anemómetro (m)")
+    p.add_argument("--batch", type=int, default=ETO_IMPORT_BATCH)
+    sub.add_parser("check-eto", help="contrasta Penman-Monteith con los ejemplos de FAO-56; sale con 1 si alguno falla")
+    p = sub.add_parser("bench-pm", help="tiempo de import-horario con registros horarios sintéticos")
+    p.add_argument("--filas", type=int, default=1_000_000)
+    p.add_argument("--estaciones", type=int, default=10)
+    p.add_argument("--memoria", action="store_true", help="mide el pico de memoria (más lento)")
+    p = sub.add_parser("bench-eto", help="tiempo de import-eto con series sintéticas")
+    p.add_argument("--estaciones", type=int, default=50)
+    p.add_argument("--anios", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    cli = {"migrate": cli_migrate, "backfill-fechas": cli_backfill_fechas,
+           "rebuild-aggregates": cli_rebuild_aggregates, "check-plans": cli_check_plans,
+           "bench-riego": cli_bench_riego, "bench-turnos": cli_bench_turnos,
+           "check-ref": cli_check_ref, "import-eto": cli_import_eto, "bench-eto": cli_bench_eto,
+           "import-horario": cli_import_horario, "check-eto": cli_check_eto, "bench-pm": cli_bench_pm,
+           "bench-envio": cli_bench_envio, "bench-arranque": cli_bench_arranque,
+           "check-telemetry": cli_check_telemetry}
+    if args.cmd in cli:
+        try:
+            cli[args.cmd](args)
+        finally:
+            db_close_all()
+        return
+    run_bot()
+
+if __name__ == "__main__":
+    main()
+